@@ -0,0 +1,7 @@
+# Read by gunicorn from the directory it is started in
+
+
+def post_worker_init(worker):
+    # Build the identifier search indexes before the worker's first requests need them
+    from sickgenes.identifier_index import warm_identifier_indexes
+    warm_identifier_indexes()
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'sickgenes.apps.SickgenesConfig',
     'django_tables2',
     'django_tables2_ajax',
@@ -154,4 +155,31 @@ if not TESTING:
 DJANGO_TABLES2_TEMPLATE = "django_tables2/bootstrap5.html"
 
 # For about page
-CONTACT_EMAIL_ADDRESS = os.getenv('CONTACT_EMAIL_ADDRESS', '<Email not set>')
\ No newline at end of file
+CONTACT_EMAIL_ADDRESS = os.getenv('CONTACT_EMAIL_ADDRESS', '<Email not set>')
+
+# Answer gene/metabolite identifier searches from an in-process index
+# (see `python manage.py identifier_index_stats` for its build time and size)
+IDENTIFIER_INDEX_ENABLED = os.getenv('IDENTIFIER_INDEX', '0').lower() in ['true', 't', '1']
+# Seconds an index is used before checking whether an import has run since it was built
+IDENTIFIER_INDEX_CHECK_SECONDS = int(os.getenv('IDENTIFIER_INDEX_CHECK_SECONDS', 60))
+
+# Where import_molecule_data keeps downloaded data sources between runs
+IMPORT_CACHE_DIR = os.getenv('IMPORT_CACHE_DIR', BASE_DIR / 'import_cache')
+
+# Where update_string_data writes the memory-mapped gene adjacency the graph
+# reads. The importing process and every web process must share it, so it
+# is off by default: on hosts where each process has its own filesystem,
+# such as Heroku dynos, web processes would never see a build. Unset, the
+# graph queries the database.
+GENE_NETWORK_DIR = os.getenv('GENE_NETWORK_DIR') or None
+
+# Seconds a gene graph response stays in Django's cache; data changes
+# invalidate it sooner, as its cache key includes the DataVersion
+GRAPH_CACHE_TIMEOUT = int(os.getenv('GRAPH_CACHE_TIMEOUT', 60 * 60 * 24))
+
+# Identifiers one client may resolve through the resolve API per minute
+RESOLVE_RATE_LIMIT = int(os.getenv('RESOLVE_RATE_LIMIT', 20000))
+
+# Set behind a proxy that appends the client's address to X-Forwarded-For,
+# such as Heroku's router, so rate limits apply per client rather than per proxy
+USE_X_FORWARDED_FOR = os.getenv('USE_X_FORWARDED_FOR', '0').lower() in ['true', 't', '1']
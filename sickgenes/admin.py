@@ -4,7 +4,8 @@ from .models import (
     Study, GeneFinding, StudyCohort, Disease, HgncGene, 
     HmdbMetabolite, Ena, UniprotId, OmimId, AliasSymbol, 
     AliasName, PrevSymbol, PrevName, MetaboliteSynonym, SecondaryAccession,
-    MetaboliteFinding, StringProtein, StringInteraction, SiteConfiguration
+    MetaboliteFinding, StringProtein, StringInteraction, GeneInteraction, SiteConfiguration,
+    ImportRun,
 )
 
 from solo.admin import SingletonModelAdmin
@@ -111,4 +112,16 @@ class StringProteinAdmin(ReadOnlyAdminMixin, admin.ModelAdmin):
 class StringInteractionAdmin(ReadOnlyAdminMixin, admin.ModelAdmin):
     search_fields = ['protein1', 'protein2']
     list_select_related = ['protein1', 'protein2']
-    pass
\ No newline at end of file
+    pass
+
+@admin.register(GeneInteraction)
+class GeneInteractionAdmin(ReadOnlyAdminMixin, admin.ModelAdmin):
+    list_select_related = ['gene_a', 'gene_b']
+    pass
+
+## Imports
+
+@admin.register(ImportRun)
+class ImportRunAdmin(ReadOnlyAdminMixin, admin.ModelAdmin):
+    list_display = ['database', 'status', 'processed_count', 'created_at']
+    list_filter = ['database', 'status']
\ No newline at end of file
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class SickgenesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sickgenes'
+
+    def ready(self):
+        from sickgenes import signals  # noqa: F401
@@ -66,7 +66,7 @@ class StudyCohortForm(forms.ModelForm):
     
 class GeneFilterForm(forms.Form):
     phenotype = forms.ModelChoiceField(   
-        queryset = Disease.objects.annotate(gene_findings_count=Count('study_cohorts__gene_findings')).filter(gene_findings_count__gte=1).order_by('name'),
+        queryset = Disease.objects.filter(gene_evidence__isnull=False).distinct().order_by('name'),
         required=False,
         empty_label="All Phenotypes",
         widget=forms.Select(attrs={'class': 'form-select'})
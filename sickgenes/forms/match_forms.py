@@ -1,5 +1,9 @@
 from django import forms
 from django.forms import formset_factory
+import uuid
+
+# Terms beyond this many get no close matches suggested, bounding the work of one search
+MAX_SUGGESTED_TERMS = 100
 
 class SearchInitialForm(forms.Form):
     search_terms = forms.CharField(
@@ -12,6 +16,16 @@ class SearchInitialForm(forms.Form):
         ),
         required=False,
     )
+    suggest_similar = forms.BooleanField(
+        label='Suggest close matches for terms with no exact match',
+        required=False,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
+    # Identifies the resolution in progress, whose candidates are kept in the session
+    resolution_token = forms.CharField(
+        max_length=32, required=False,
+        widget=forms.HiddenInput()
+    )
 
     def clean_search_terms(self):
         search_terms_string = self.cleaned_data['search_terms']
@@ -71,6 +85,103 @@ class SearchOneMatchForm(forms.Form):
 
 SearchOneMatchFormSet = formset_factory(SearchOneMatchForm, extra=0)
 
+def item_choice_label(model, item, matched_fields):
+    """Label for a multiple match choice, naming the fields the search term matched on."""
+    field_labels = ', '.join(model.objects.source_field_label(field) for field in matched_fields)
+    return f'{item} (matched {field_labels})' if field_labels else str(item)
+
+def similar_match_results(model, search_terms):
+    """
+    Multiple_matches style results holding close matches for each search
+    term, found together. Only the first MAX_SUGGESTED_TERMS terms get close
+    matches; the rest get none.
+    """
+    search_terms = list(search_terms)
+    similar_items = model.objects.find_similar_items_many(search_terms[:MAX_SUGGESTED_TERMS])
+    return [
+        {
+            'search_string': search_term,
+            'items': [item for item, matched_fields in similar_items.get(search_term, [])],
+            'matched_fields': {item.id: matched_fields for item, matched_fields in similar_items.get(search_term, [])},
+        }
+        for search_term in search_terms
+    ]
+
+def add_similar_matches(search_results, model):
+    """Moves search terms with no exact match but with close matches into multiple_matches."""
+    no_matches = []
+    for result in similar_match_results(model, search_results['no_matches']):
+        if result['items']:
+            search_results['multiple_matches'].append(result)
+        else:
+            no_matches.append(result['search_string'])
+    search_results['no_matches'] = no_matches
+
+def candidate_choices(model, result):
+    """[item id, choice label, item string] for each item of a multiple_matches style result."""
+    return [
+        [item.id, item_choice_label(model, item, result['matched_fields'][item.id]), str(item)]
+        for item in result['items']
+    ]
+
+class ResolutionCandidates:
+    """
+    The choices of each multiple match search term in a resolution that is
+    in progress, kept in the session so that later POSTs don't need to
+    search for them again. One resolution is kept per model; a POST with
+    another token starts a new one.
+    """
+    def __init__(self, session, model, token):
+        self.session = session
+        self.model = model
+        self.session_key = f'identifier_resolution_{model._meta.model_name}'
+
+        stored = session.get(self.session_key, {})
+        if token and stored.get('token') == token:
+            self.token = token
+            self.choices = stored['choices']
+        else:
+            self.token = uuid.uuid4().hex
+            self.choices = {}
+
+    def __contains__(self, search_term):
+        return search_term in self.choices
+
+    def get(self, search_term):
+        return self.choices.get(search_term, [])
+
+    def add_results(self, results):
+        for result in results:
+            self.choices[result['search_string']] = candidate_choices(self.model, result)
+
+    def resolve(self, search_terms):
+        """Finds the choices of multiple match search terms that aren't stored yet."""
+        search_terms = {search_term for search_term in search_terms if search_term not in self.choices}
+        if not search_terms:
+            return
+
+        search_results = self.model.objects.find_matching_items(search_terms)
+        self.add_results(search_results['multiple_matches'])
+
+        # A term that now matches one item exactly offers just that item
+        self.add_results(
+            {
+                'search_string': result['search_string'],
+                'items': [result['item']],
+                'matched_fields': {result['item'].id: result['matched_fields']},
+            }
+            for result in search_results['one_match']
+        )
+        # The choices were close matches suggested for a term with no exact match
+        self.add_results(similar_match_results(self.model, search_results['no_matches']))
+
+    def save(self, search_terms):
+        """Stores the choices of the given search terms, dropping the rest."""
+        self.session[self.session_key] = {
+            'token': self.token,
+            'choices': {search_term: self.get(search_term) for search_term in search_terms},
+        }
+
 def prepare_identifiers(request, model):
     """Prepare forms/formsets for retrieving IDs for items (genes) from a list of search terms
     
@@ -101,13 +212,17 @@ def prepare_identifiers(request, model):
     }
     
     if request.method == 'POST':
-        form_data = process_search_forms(form_data, model)
+        candidates = ResolutionCandidates(
+            request.session, model, request.POST.get('resolution_token')
+        )
+        form_data = process_search_forms(form_data, model, candidates)
 
     return form_data
 
 def process_search_forms(
             form_data,
             model,
+            candidates,
         ):
     
     search_initial_form = form_data['search_initial_form']
@@ -115,16 +230,21 @@ def process_search_forms(
     search_multiple_matches_formset = form_data['search_multiple_matches_formset']
     search_one_match_formset = form_data['search_one_match_formset']
 
-    # Retrieve matches for search term in each form to generate choices
+    # Generate choices for each form, from the session or for any terms not stored there
+    candidates.resolve(
+        form['search_term'].value() for form in search_multiple_matches_formset.forms
+        if form['search_term'].value()
+    )
     for form in search_multiple_matches_formset.forms:
         search_term = form['search_term'].value()
+        form.item_strings = {}
 
         if search_term:
-            search_results = model.objects.find_matching_items({search_term})
-            if search_results['multiple_matches'] and search_results['multiple_matches'][0]['search_string'] == search_term:
-                result_items = search_results['multiple_matches'][0]['items']
-                item_choices = [(item.id, str(item)) for item in result_items]
-                form.fields['item_id'].choices = form.fields['item_id'].choices + item_choices
+            choices = candidates.get(search_term)
+            form.fields['item_id'].choices = form.fields['item_id'].choices + [
+                (item_id, label) for item_id, label, item_string in choices
+            ]
+            form.item_strings = {item_id: item_string for item_id, label, item_string in choices}
 
     if all([
         search_initial_form.is_valid(),
@@ -140,6 +260,7 @@ def process_search_forms(
 
         # Process selections from multiple_matches forms
         selections_from_multiple_matches_formset = []
+        unselected_terms = []
         for form in search_multiple_matches_formset:
             search_term = form.cleaned_data.get('search_term')
             if not search_term or form.cleaned_data.get('delete'):
@@ -148,35 +269,46 @@ def process_search_forms(
             if form.cleaned_data.get('item_id'):
                 # User made a selection, process it
                 selected_id = int(form.cleaned_data['item_id'])
-                choices_dict = dict(form.fields['item_id'].choices)
-                item_string = choices_dict.get(selected_id)
+                item_string = form.item_strings.get(selected_id)
                 selections_from_multiple_matches_formset.append(
                     (search_term, selected_id, item_string)
                 )
-            else:
-                # No selection was made, add this term to be re-shown
-                search_terms.add(search_term)
+            elif search_term not in unselected_terms:
+                # No selection was made, re-show this term with its stored choices
+                unselected_terms.append(search_term)
 
         # Find matches for the new terms
-        search_results = model.objects.find_matching_items(search_terms)
+        search_results = model.objects.find_matching_items(search_terms - set(unselected_terms))
+
+        suggest_similar = search_initial_form.cleaned_data.get('suggest_similar')
+        if suggest_similar:
+            add_similar_matches(search_results, model)
+
+        candidates.add_results(search_results['multiple_matches'])
+        multiple_matches_terms = unselected_terms + [
+            result['search_string'] for result in search_results['multiple_matches']
+        ]
+        candidates.save(multiple_matches_terms)
 
         # Regenerate forms for the next page view
         # Blank initial form
-        search_initial_form = SearchInitialForm() # Clear the initial form
+        search_initial_form = SearchInitialForm(initial={
+            'suggest_similar': suggest_similar,
+            'resolution_token': candidates.token,
+        }) # Clear the initial form
 
         # No matches formset from no_matches in search_results
         no_matches_initial = [{"search_term": term} for term in search_results['no_matches']]
         search_no_matches_formset = SearchNoMatchesFormSet(initial=no_matches_initial, prefix="no_matches")
 
-        # Multiple matches formset from multiple_matches in search_results
-        multiple_matches_data = search_results['multiple_matches']
+        # Multiple matches formset from the unselected and newly found multiple matches
         multiple_matches_initial = []
-        for result in multiple_matches_data:
-            initial_data = {'search_term': result['search_string']}
+        for search_term in multiple_matches_terms:
+            initial_data = {'search_term': search_term}
             # Check for an exact case-insensitive match to set as a default
-            for item in result['items']:
-                if str(item).lower() == result['search_string'].lower():
-                    initial_data['item_id'] = item.id
+            for item_id, label, item_string in candidates.get(search_term):
+                if item_string.lower() == search_term.lower():
+                    initial_data['item_id'] = item_id
                     break
             multiple_matches_initial.append(initial_data)
         
@@ -185,10 +317,10 @@ def process_search_forms(
         )
 
         # Populate choices for the new multiple matches formset
-        for i, form in enumerate(search_multiple_matches_formset):
-            result_items = multiple_matches_data[i]['items']
-            item_choices = [(item.id, str(item)) for item in result_items]
-            form.fields['item_id'].choices += item_choices
+        for search_term, form in zip(multiple_matches_terms, search_multiple_matches_formset):
+            form.fields['item_id'].choices += [
+                (item_id, label) for item_id, label, item_string in candidates.get(search_term)
+            ]
 
 
 
@@ -0,0 +1,218 @@
+"""
+On-disk gene adjacency for the STRING network.
+
+build_gene_network writes the GeneInteraction rows, the STRING interactions
+collapsed to one per pair of genes, in CSR form to GENE_NETWORK_DIR: the
+sorted HgncGene pks, each gene's offset into the neighbor arrays, and the
+neighbors' gene positions and scores, strongest first, along with a
+force-directed layout of the whole network that graph layouts start from.
+Each build gets its own directory, and the `current` file names the latest one. Every process
+memory-maps the arrays read-only, so the operating system shares one copy
+of them between web workers, and reloads them once a newer build is current.
+"""
+import itertools
+import os
+import shutil
+import threading
+import logging
+import time
+import numpy as np
+from django.conf import settings
+from sickgenes.graph_layout import force_layout
+from sickgenes.models import GeneInteraction
+
+ARRAY_NAMES = ['genes', 'offsets', 'neighbors', 'scores', 'layout']
+CURRENT_FILE = 'current'
+# Weaker interactions don't pull genes together in the network's layout,
+# as the graph doesn't show them by default
+LAYOUT_MIN_SCORE = 700
+
+logger = logging.getLogger(__name__)
+
+_network = None
+_network_lock = threading.Lock()
+
+
+class GeneNetwork:
+    """ The gene adjacency arrays of one build, memory-mapped from its directory. """
+
+    def __init__(self, path):
+        self.path = path
+        # HgncGene pks, ascending; a gene's position in it is its index in the other arrays
+        self.genes = np.load(os.path.join(path, 'genes.npy'), mmap_mode='r')
+        # Gene i's neighbors are neighbors[offsets[i]:offsets[i + 1]]
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.neighbors = np.load(os.path.join(path, 'neighbors.npy'), mmap_mode='r')
+        self.scores = np.load(os.path.join(path, 'scores.npy'), mmap_mode='r')
+        # Each gene's position in the network's layout, if this build has one
+        layout_path = os.path.join(path, 'layout.npy')
+        self.layout = np.load(layout_path, mmap_mode='r') if os.path.exists(layout_path) else None
+
+    @property
+    def interaction_count(self):
+        return len(self.neighbors) // 2
+
+    def interactions(self, gene_pks, min_score=0):
+        """
+        Returns (gene pk, gene pk, combined score) for the interactions
+        between the given genes scoring at least min_score, the smaller
+        gene pk first.
+        """
+        gene_pks = np.unique(np.asarray(list(gene_pks), dtype=np.int64))
+        positions = np.searchsorted(self.genes, gene_pks)
+        found = positions < len(self.genes)
+        found[found] = self.genes[positions[found]] == gene_pks[found]
+        positions = positions[found]
+
+        selected = np.zeros(len(self.genes), dtype=bool)
+        selected[positions] = True
+
+        # Scores are descending, so each gene's neighbors scoring at least
+        # min_score come first: binary searches for where they end, all genes at once
+        starts = self.offsets[positions]
+        low, high = starts.copy(), self.offsets[positions + 1].copy()
+        while (low < high).any():
+            searching = low < high
+            middle = (low + high) // 2
+            strong = np.zeros(len(positions), dtype=bool)
+            strong[searching] = self.scores[middle[searching]] >= min_score
+            low = np.where(strong, middle + 1, low)
+            high = np.where(searching & ~strong, middle, high)
+
+        # The strong neighbors' indexes into the neighbor arrays, gene by gene
+        counts = low - starts
+        indexes = np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+        sources = np.repeat(positions, counts)
+        neighbors = self.neighbors[indexes]
+        # Each interaction is kept by its gene with the lower position
+        keep = (neighbors > sources) & selected[neighbors]
+
+        return list(zip(
+            self.genes[sources[keep]].tolist(),
+            self.genes[neighbors[keep]].tolist(),
+            self.scores[indexes[keep]].tolist(),
+        ))
+
+    def layout_positions(self, gene_pks):
+        """
+        Returns a (len(gene_pks), 2) array of the genes' positions in the
+        network's layout, NaN for genes without interactions.
+        """
+        gene_pks = np.asarray(list(gene_pks), dtype=np.int64)
+        positions = np.full((len(gene_pks), 2), np.nan)
+        if self.layout is None or not len(self.genes):
+            return positions
+        indexes = np.minimum(np.searchsorted(self.genes, gene_pks), len(self.genes) - 1)
+        found = self.genes[indexes] == gene_pks
+        positions[found] = self.layout[indexes[found]]
+        return positions
+
+
+def build_gene_network(directory=None, using='default'):
+    """
+    Writes the gene adjacency of the current GeneInteraction rows to a new
+    build directory, makes it current and removes older builds. Returns the
+    new GeneNetwork.
+    """
+    directory = str(directory or settings.GENE_NETWORK_DIR)
+    os.makedirs(directory, exist_ok=True)
+
+    rows = GeneInteraction.objects.using(using).values_list('gene_a', 'gene_b', 'combined_score').order_by()
+    pairs = np.fromiter(
+        itertools.chain.from_iterable(rows.iterator(chunk_size=100000)), dtype=np.int64
+    ).reshape(-1, 3)
+
+    genes = np.unique(pairs[:, :2])
+    # Both directions of each interaction, grouped by gene and strongest first
+    sources = np.searchsorted(genes, np.concatenate([pairs[:, 0], pairs[:, 1]]))
+    targets = np.searchsorted(genes, np.concatenate([pairs[:, 1], pairs[:, 0]]))
+    scores = np.concatenate([pairs[:, 2], pairs[:, 2]])
+    order = np.lexsort((targets, -scores, sources))
+
+    offsets = np.zeros(len(genes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(genes)), out=offsets[1:])
+
+    strong = pairs[:, 2] >= LAYOUT_MIN_SCORE
+    layout = force_layout(
+        len(genes),
+        np.searchsorted(genes, pairs[strong, 0]),
+        np.searchsorted(genes, pairs[strong, 1]),
+        weights=pairs[strong, 2] / 1000,
+    )
+
+    build_name = f'build-{time.time_ns()}'
+    path = os.path.join(directory, build_name)
+    os.makedirs(path)
+    arrays = {
+        'genes': genes.astype(np.int32),
+        'offsets': offsets,
+        'neighbors': targets[order].astype(np.int32),
+        'scores': scores[order].astype(np.uint16),
+        'layout': layout.astype(np.float32),
+    }
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(path, f'{name}.npy'), arrays[name])
+
+    # Replacing the current file is atomic, so readers see the old or the new build
+    current_path = os.path.join(directory, CURRENT_FILE)
+    previous_build_name = read_current_build(directory)
+    with open(f'{current_path}.tmp', 'w', encoding='utf-8') as file:
+        file.write(build_name)
+    os.replace(f'{current_path}.tmp', current_path)
+
+    # The previous build is kept for processes that have just read its name
+    # from the current file, and removed by the next build
+    for name in os.listdir(directory):
+        if name.startswith('build-') and name not in (build_name, previous_build_name):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    return GeneNetwork(path)
+
+
+def read_current_build(directory):
+    """ The name of the current build in directory, or None if there is none. """
+    try:
+        with open(os.path.join(directory, CURRENT_FILE), encoding='utf-8') as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def get_gene_network():
+    """
+    Returns the current GeneNetwork, loading it if this process hasn't yet
+    or a newer one was built since, or None if none has been built or it
+    can't be read, for the graph to query the database instead.
+    """
+    global _network
+    if not settings.GENE_NETWORK_DIR:
+        return None
+
+    directory = str(settings.GENE_NETWORK_DIR)
+    network = _network
+    # A build can be removed between reading its name and loading it, if
+    # two newer ones were built meanwhile, so the name is read again once
+    for attempt in range(2):
+        build_name = read_current_build(directory)
+        if build_name is None:
+            return None
+
+        path = os.path.join(directory, build_name)
+        if network is not None and network.path == path:
+            return network
+
+        with _network_lock:
+            if _network is None or _network.path != path:
+                try:
+                    _network = GeneNetwork(path)
+                except OSError:
+                    logger.warning('Could not load the gene network build %s', path, exc_info=True)
+                    continue
+            return _network
+    return None
+
+
+def clear_gene_network():
+    global _network
+    with _network_lock:
+        _network = None
@@ -0,0 +1,166 @@
+"""
+Force-directed layout of gene graphs, computed on the server.
+
+force_layout is a vectorised Fruchterman-Reingold layout: linked nodes
+attract each other in proportion to their edge weights, all nodes repel
+each other, and a weak pull towards the centre keeps unlinked nodes from
+drifting away. Repulsion is computed exactly for graphs of up to
+EXACT_REPULSION_NODES nodes and on a mesh otherwise: nodes are spread
+onto a grid whose convolution with the repulsion kernel, done with FFTs,
+gives the force at every grid point, so a whole STRING network can be
+laid out in seconds. Layouts are seeded, so the same graph always gets
+the same positions.
+"""
+import numpy as np
+
+LAYOUT_SEED = 0
+# Iterations from random positions, and from positions of an earlier layout
+COLD_ITERATIONS = 200
+WARM_ITERATIONS = 50
+# Largest step a node takes in the first iteration, as a fraction of the layout's size
+COLD_TEMPERATURE = 0.1
+WARM_TEMPERATURE = 0.02
+GRAVITY = 0.1
+# Larger graphs get their repulsion computed on a mesh
+EXACT_REPULSION_NODES = 250
+MESH_SIZE = 128
+# Rows of nodes whose exact repulsion is computed together
+REPULSION_CHUNK_NODES = 256
+# Stops coincident nodes exerting infinite forces
+MIN_DISTANCE = 1e-4
+
+
+def force_layout(node_count, sources, targets, weights=None, initial=None, iterations=None, seed=LAYOUT_SEED):
+    """
+    Lays out a graph of node_count nodes whose edges link nodes sources[i]
+    and targets[i], with weights between 0 and 1. Starts from initial,
+    an array of a position per node with NaN for nodes to place at random,
+    if given. Returns a (node_count, 2) array of positions from 0 to 1.
+    """
+    rng = np.random.default_rng(seed)
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    weights = np.ones(len(sources)) if weights is None else np.asarray(weights, dtype=np.float64)
+    if node_count == 0:
+        return np.zeros((0, 2))
+
+    if initial is None or np.isnan(initial).all():
+        positions = rng.random((node_count, 2))
+        temperature = COLD_TEMPERATURE
+        iterations = COLD_ITERATIONS if iterations is None else iterations
+    else:
+        positions = scale_positions(np.array(initial, dtype=np.float64))
+        missing = np.isnan(positions).any(axis=1)
+        positions[missing] = rng.random((missing.sum(), 2))
+        # Separates nodes that started in the same place
+        positions += rng.normal(scale=MIN_DISTANCE, size=positions.shape)
+        temperature = WARM_TEMPERATURE
+        iterations = WARM_ITERATIONS if iterations is None else iterations
+
+    # The ideal distance between nodes, if they evenly filled the unit square
+    k = np.sqrt(1 / node_count)
+    repulsion = exact_repulsion if node_count <= EXACT_REPULSION_NODES else mesh_repulsion
+
+    for iteration in range(iterations):
+        displacement = repulsion(positions, k)
+
+        delta = positions[sources] - positions[targets]
+        distance = np.maximum(np.hypot(delta[:, 0], delta[:, 1]), MIN_DISTANCE)
+        attraction = delta * (distance * weights / k)[:, None]
+        for axis in range(2):
+            displacement[:, axis] -= np.bincount(sources, attraction[:, axis], minlength=node_count)
+            displacement[:, axis] += np.bincount(targets, attraction[:, axis], minlength=node_count)
+
+        centre = positions.mean(axis=0)
+        displacement -= GRAVITY * (positions - centre) / k
+
+        # Each node moves along its force, by at most the temperature, which cools linearly
+        step = temperature * (1 - iteration / iterations)
+        length = np.maximum(np.hypot(displacement[:, 0], displacement[:, 1]), MIN_DISTANCE)
+        positions += displacement * (np.minimum(length, step) / length)[:, None]
+
+    return scale_positions(positions)
+
+
+def scale_positions(positions):
+    """ Scales positions to fit from 0 to 1, keeping their aspect ratio. NaN positions stay NaN. """
+    if np.isnan(positions).all():
+        return positions
+    low = np.nanmin(positions, axis=0)
+    extent = (np.nanmax(positions, axis=0) - low).max()
+    if extent == 0:
+        return np.where(np.isnan(positions), np.nan, 0.5)
+    return (positions - low) / extent
+
+
+def exact_repulsion(positions, k):
+    """ The repulsion, k² / distance, on each node from every other node. """
+    x, y = positions[:, 0], positions[:, 1]
+    forces = np.empty_like(positions)
+    for start in range(0, len(positions), REPULSION_CHUNK_NODES):
+        end = start + REPULSION_CHUNK_NODES
+        dx = x[start:end, None] - x[None, :]
+        dy = y[start:end, None] - y[None, :]
+        strength = dx * dx + dy * dy
+        np.maximum(strength, MIN_DISTANCE ** 2, out=strength)
+        # A node's delta to itself is zero, so it doesn't repel itself
+        np.divide(k * k, strength, out=strength)
+        forces[start:end, 0] = (dx * strength).sum(axis=1)
+        forces[start:end, 1] = (dy * strength).sum(axis=1)
+    return forces
+
+
+def mesh_repulsion(positions, k, mesh_size=MESH_SIZE):
+    """
+    Approximates exact_repulsion on a mesh_size by mesh_size grid over the
+    nodes. Each node's weight is spread over the four grid points around it,
+    and its force is interpolated from theirs the same way.
+    """
+    low = positions.min(axis=0)
+    spacing = max((positions.max(axis=0) - low).max(), MIN_DISTANCE) / (mesh_size - 1)
+    grid_positions = (positions - low) / spacing
+    cells = np.minimum(grid_positions.astype(np.int64), mesh_size - 2)
+    fractions = grid_positions - cells
+
+    corners = []
+    for dx in (0, 1):
+        for dy in (0, 1):
+            indexes = (cells[:, 0] + dx) * mesh_size + cells[:, 1] + dy
+            corner_weights = (
+                (fractions[:, 0] if dx else 1 - fractions[:, 0]) * (fractions[:, 1] if dy else 1 - fractions[:, 1])
+            )
+            corners.append((indexes, corner_weights))
+
+    density = np.zeros(mesh_size * mesh_size)
+    for indexes, corner_weights in corners:
+        density += np.bincount(indexes, corner_weights, minlength=mesh_size * mesh_size)
+
+    # Linear convolution of the density with the kernel of every grid offset
+    shape = (2 * mesh_size, 2 * mesh_size)
+    density_transform = np.fft.rfft2(density.reshape(mesh_size, mesh_size), s=shape)
+    forces = np.zeros_like(positions)
+    for axis, kernel_transform in enumerate(repulsion_kernel_transforms(mesh_size)):
+        field = np.fft.irfft2(density_transform * kernel_transform, s=shape)
+        field = field[mesh_size - 1:2 * mesh_size - 1, mesh_size - 1:2 * mesh_size - 1].ravel()
+        for indexes, corner_weights in corners:
+            forces[:, axis] += field[indexes] * corner_weights
+    # The kernel is for grid points one unit apart
+    return forces * (k * k / spacing)
+
+
+_kernel_transforms = {}
+
+
+def repulsion_kernel_transforms(mesh_size):
+    """ FFTs of the x and y repulsion between grid points one unit apart, for every offset between them. """
+    if mesh_size not in _kernel_transforms:
+        offsets = np.arange(-mesh_size + 1, mesh_size, dtype=np.float64)
+        x, y = np.meshgrid(offsets, offsets, indexing='ij')
+        distance_squared = x * x + y * y
+        distance_squared[mesh_size - 1, mesh_size - 1] = np.inf
+        shape = (2 * mesh_size, 2 * mesh_size)
+        _kernel_transforms[mesh_size] = (
+            np.fft.rfft2(x / distance_squared, s=shape),
+            np.fft.rfft2(y / distance_squared, s=shape),
+        )
+    return _kernel_transforms[mesh_size]
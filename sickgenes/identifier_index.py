@@ -0,0 +1,290 @@
+"""
+In-process indexes for molecule lookups.
+
+IdentifierIndex holds the IdentifierLookup rows of one molecule type in a
+dictionary, so find_matching_ids can be answered from memory instead of
+Postgres. TrigramIndex answers find_similar_items when the pg_trgm extension
+is not installed. An index is tied to the latest ImportRun of its source
+database and is rebuilt the next time it is used after a new import, which
+is checked for at most every IDENTIFIER_INDEX_CHECK_SECONDS. Trigram indexes
+are rebuilt in a background thread, and warm_identifier_indexes starts
+building them as each web worker starts, so fuzzy searches never wait for one.
+"""
+import logging
+import re
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from sickgenes.models.managers import IdentifierSearchKeys, SIMILARITY_THRESHOLD, MIN_PREFIX_LENGTH
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+# Held while an index is being built, one lock per index
+_build_locks = {}
+
+logger = logging.getLogger(__name__)
+
+
+class IdentifierIndex:
+    """ Normalized value -> (source field, primary key) pairs for one molecule model. """
+
+    def __init__(self, model, version):
+        self.model = model
+        self.version = version
+        # When the version was last checked against the latest import run
+        self.checked_at = None
+        # {normalized value: ((source field, pk), ...)}
+        self.values = {}
+        self.build_seconds = None
+        self.memory_bytes = None
+
+    def build(self):
+        start_time = time.perf_counter()
+        IdentifierLookup = apps.get_model('sickgenes', 'IdentifierLookup')
+
+        rows = IdentifierLookup.objects.filter(
+            molecule_type=self.model.objects.molecule_type
+        ).order_by().values_list('normalized_value', 'source_field', 'molecule_id')
+
+        source_fields = {}
+        matches_by_value = defaultdict(list)
+        for normalized_value, source_field, molecule_id in rows.iterator(chunk_size=20000):
+            # Share one string object per source field
+            source_field = source_fields.setdefault(source_field, source_field)
+            matches_by_value[normalized_value].append((source_field, molecule_id))
+        # Tuples take less memory than lists
+        self.values = {value: tuple(matches) for value, matches in matches_by_value.items()}
+
+        self.build_seconds = time.perf_counter() - start_time
+        self.memory_bytes = self._measure_memory()
+        return self
+
+    def find_matching_ids(self, search_strings):
+        """ Same contract as BaseMoleculeManager.find_matching_ids, answered from memory. """
+        search_keys = IdentifierSearchKeys(self.model.objects, search_strings)
+        search_keys.add_rows(
+            (value, source_field, pk)
+            for value in search_keys.values
+            for source_field, pk in self.values.get(value, ())
+        )
+        return search_keys.matching_ids
+
+    @property
+    def entry_count(self):
+        return sum(len(matches) for matches in self.values.values())
+
+    def _measure_memory(self):
+        """ Approximate size in bytes of the index dictionary and its contents. """
+        total = sys.getsizeof(self.values)
+        for value, matches in self.values.items():
+            total += sys.getsizeof(value) + sys.getsizeof(matches)
+            for match in matches:
+                total += sys.getsizeof(match) + sys.getsizeof(match[1])
+        return total
+
+
+class TrigramIndex:
+    """
+    Trigram postings over the name-like IdentifierLookup values of one
+    molecule model, for prefix and similarity searches without pg_trgm.
+    """
+    # Caps the postings scanned per search so common trigrams can't make it slow
+    max_postings_scanned = 200000
+
+    def __init__(self, model, version):
+        self.model = model
+        self.version = version
+        # When the version was last checked against the latest import run
+        self.checked_at = None
+        # Sorted unique values, so prefix matches are a contiguous range
+        self.values = []
+        # Per value: ((source field, pk), ...) and its trigram count
+        self.matches = []
+        self.trigram_counts = array('H')
+        # {trigram: array of value positions}
+        self.postings = {}
+        self.build_seconds = None
+
+    def build(self):
+        start_time = time.perf_counter()
+        IdentifierLookup = apps.get_model('sickgenes', 'IdentifierLookup')
+        manager = self.model.objects
+
+        rows = IdentifierLookup.objects.filter(
+            molecule_type=manager.molecule_type,
+            source_field__in=manager.fuzzy_fields,
+        ).order_by().values_list('normalized_value', 'source_field', 'molecule_id')
+
+        matches_by_value = defaultdict(list)
+        for normalized_value, source_field, molecule_id in rows.iterator(chunk_size=20000):
+            matches_by_value[normalized_value].append((source_field, molecule_id))
+
+        # Sorted in Python rather than by the database collation, for bisect
+        self.values = sorted(matches_by_value)
+        for position, normalized_value in enumerate(self.values):
+            self.matches.append(tuple(matches_by_value[normalized_value]))
+
+            value_trigrams = trigrams(normalized_value)
+            self.trigram_counts.append(min(len(value_trigrams), 65535))
+            for trigram in value_trigrams:
+                self.postings.setdefault(trigram, array('I')).append(position)
+
+        self.build_seconds = time.perf_counter() - start_time
+        return self
+
+    def find_similar(self, value, limit):
+        """
+        Returns (source field, pk) rows for values starting with the value,
+        then for values similar to it, most similar first.
+        """
+        ranked_positions = []
+
+        if len(value) >= MIN_PREFIX_LENGTH:
+            position = bisect_left(self.values, value)
+            while (position < len(self.values)
+                   and self.values[position].startswith(value)
+                   and len(ranked_positions) < limit):
+                ranked_positions.append(position)
+                position += 1
+
+        if len(ranked_positions) < limit:
+            query_trigrams = trigrams(value)
+            shared_counts = Counter()
+            postings_scanned = 0
+            # Rare trigrams first, as they are the most selective
+            for postings in sorted(
+                (self.postings[trigram] for trigram in query_trigrams if trigram in self.postings),
+                key=len,
+            ):
+                if postings_scanned + len(postings) > self.max_postings_scanned:
+                    break
+                shared_counts.update(postings)
+                postings_scanned += len(postings)
+
+            similar = []
+            for position, shared in shared_counts.items():
+                similarity = shared / (len(query_trigrams) + self.trigram_counts[position] - shared)
+                if similarity >= SIMILARITY_THRESHOLD and position not in ranked_positions:
+                    similar.append((-similarity, self.values[position], position))
+            similar.sort()
+            ranked_positions.extend(position for _, _, position in similar[:limit - len(ranked_positions)])
+
+        return [match for position in ranked_positions for match in self.matches[position]]
+
+
+def trigrams(value):
+    """ The trigrams pg_trgm extracts: per alphanumeric word, lower-cased and padded. """
+    result = set()
+    for word in re.findall(r'[^\W_]+', value.lower()):
+        padded = f'  {word} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def _index_key(index_class, model):
+    return (index_class.__name__, model._meta.label)
+
+
+def _build_lock(key):
+    with _indexes_lock:
+        return _build_locks.setdefault(key, threading.Lock())
+
+
+def _get_index(index_class, model, wait=True):
+    """
+    Returns an index of index_class for a molecule model, building it if it
+    doesn't exist or if an import has run since it was built. Whether an
+    import has run is checked at most every IDENTIFIER_INDEX_CHECK_SECONDS.
+
+    Without wait, an outdated index is returned while its replacement is
+    built in a background thread, and None while the first one is. The index
+    is only built in the calling thread if no other thread is building it.
+    """
+    key = _index_key(index_class, model)
+    index = _indexes.get(key)
+    now = time.monotonic()
+    if index is not None and now - index.checked_at < settings.IDENTIFIER_INDEX_CHECK_SECONDS:
+        return index
+
+    ImportRun = apps.get_model('sickgenes', 'ImportRun')
+    version = ImportRun.latest_id(model.objects.import_database)
+    if index is not None and index.version == version:
+        index.checked_at = now
+        return index
+
+    build_lock = _build_lock(key)
+    if not wait and (index is not None or build_lock.locked()):
+        _build_in_background(index_class, model, version)
+        return index
+
+    with build_lock:
+        index = _indexes.get(key)
+        if index is None or index.version != version:
+            index = index_class(model, version).build()
+            _indexes[key] = index
+        index.checked_at = now
+    return index
+
+
+def _build_in_background(index_class, model, version):
+    """ Builds an index in a new thread, unless it is already being built. """
+    key = _index_key(index_class, model)
+    build_lock = _build_lock(key)
+    if not build_lock.acquire(blocking=False):
+        return
+
+    def build():
+        try:
+            index = index_class(model, version).build()
+            index.checked_at = time.monotonic()
+            _indexes[key] = index
+        except Exception:
+            logger.exception('Building the %s of %s failed', index_class.__name__, model._meta.label)
+        finally:
+            build_lock.release()
+            connections.close_all()
+
+    threading.Thread(target=build, name=f'build-{index_class.__name__}', daemon=True).start()
+
+
+def get_identifier_index(model):
+    return _get_index(IdentifierIndex, model)
+
+
+def get_trigram_index(model, wait=True):
+    return _get_index(TrigramIndex, model, wait)
+
+
+def warm_identifier_indexes():
+    """
+    Starts building, in background threads, the indexes this process will
+    search: identifier indexes if IDENTIFIER_INDEX_ENABLED, and trigram
+    indexes if the database has no pg_trgm extension. Called by gunicorn
+    as each worker starts.
+    """
+    ImportRun = apps.get_model('sickgenes', 'ImportRun')
+    IdentifierLookup = apps.get_model('sickgenes', 'IdentifierLookup')
+    index_classes = []
+    if settings.IDENTIFIER_INDEX_ENABLED:
+        index_classes.append(IdentifierIndex)
+    if not IdentifierLookup.objects.trigram_search_available():
+        index_classes.append(TrigramIndex)
+
+    for model in apps.get_app_config('sickgenes').get_models():
+        import_database = getattr(model._default_manager, 'import_database', None)
+        if import_database is None or not index_classes:
+            continue
+        version = ImportRun.latest_id(import_database)
+        for index_class in index_classes:
+            _build_in_background(index_class, model, version)
+
+
+def clear_identifier_indexes():
+    with _indexes_lock:
+        _indexes.clear()
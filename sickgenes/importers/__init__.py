@@ -1,3 +1,3 @@
-from .update_hgnc import update_hgnc_data
-from .update_hmdb import update_hmdb_data
+from .update_hgnc import update_hgnc_data, update_hgnc_data_incremental
+from .update_hmdb import update_hmdb_data, update_hmdb_data_checkpointed
 from .update_string import update_string_data
\ No newline at end of file
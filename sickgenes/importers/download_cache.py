@@ -0,0 +1,104 @@
+"""
+Local cache for importer data sources downloaded over HTTP.
+
+Each download is kept in the cache directory with a metadata file holding
+its URL, ETag, Last-Modified date and SHA-256 checksum. Later fetches send a
+conditional GET, so an unchanged source is not downloaded again. Importers
+record the checksums they imported on their ImportRun, so an unchanged
+source need not be imported again.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import requests
+from urllib.parse import urlparse
+from .helper_functions import REQUEST_TIMEOUT
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class CachedDownload:
+    """ A data source file in the download cache and its metadata. """
+
+    def __init__(self, url, path, meta):
+        self.url = url
+        self.path = path
+        self.meta_path = f'{path}.meta.json'
+        self.meta = meta
+
+    @property
+    def sha256(self):
+        return self.meta.get('sha256')
+
+    def save_meta(self):
+        with open(self.meta_path, 'w', encoding='utf-8') as file:
+            json.dump(self.meta, file, indent=2)
+
+
+class DownloadCache:
+    """ Downloads data sources into a directory, re-downloading them only when they change upstream. """
+
+    def __init__(self, directory, session=None, timeout=REQUEST_TIMEOUT):
+        self.directory = directory
+        self.session = session or requests.Session()
+        self.timeout = timeout
+
+    def cache_path(self, url):
+        """ The cache file for a URL: its file name, prefixed by a hash of the full URL. """
+        file_name = os.path.basename(urlparse(url).path) or 'download'
+        url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.directory, f'{url_hash}-{file_name}')
+
+    def get(self, url):
+        """ The cached download of a URL, without checking whether it changed upstream. """
+        path = self.cache_path(url)
+        meta = {}
+        if os.path.exists(path) and os.path.exists(f'{path}.meta.json'):
+            with open(f'{path}.meta.json', encoding='utf-8') as file:
+                meta = json.load(file)
+        return CachedDownload(url, path, meta)
+
+    def fetch(self, url):
+        """
+        Returns the cached download of a URL, downloading it first if it
+        isn't cached or changed upstream since it was cached.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        download = self.get(url)
+
+        headers = {}
+        if download.meta.get('etag'):
+            headers['If-None-Match'] = download.meta['etag']
+        if download.meta.get('last_modified'):
+            headers['If-Modified-Since'] = download.meta['last_modified']
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304 and download.sha256:
+                return download
+            response.raise_for_status()
+
+            checksum = hashlib.sha256()
+            size = 0
+            # Written to a temporary file first so a failed download doesn't replace the cached one
+            temp_file = tempfile.NamedTemporaryFile(dir=self.directory, delete=False)
+            try:
+                with temp_file:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        temp_file.write(chunk)
+                        checksum.update(chunk)
+                        size += len(chunk)
+                os.replace(temp_file.name, download.path)
+            except BaseException:
+                os.remove(temp_file.name)
+                raise
+
+        download.meta.update({
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': checksum.hexdigest(),
+            'size': size,
+        })
+        download.save_meta()
+        return download
@@ -1,8 +1,21 @@
+import io
 import json
+import re
 import requests
+from contextlib import contextmanager
 from pathlib import Path
 from urllib.parse import urlparse
 
+# Seconds to wait for a data source to connect or send data
+REQUEST_TIMEOUT = 60
+
+def is_url(path):
+    try:
+        result = urlparse(path)
+        return all([result.scheme, result.netloc])
+    except:
+        return False
+
 def get_json_from_source(source_path):
     """
     Get JSON data from either a URL or file path.
@@ -13,13 +26,6 @@ def get_json_from_source(source_path):
     Returns:
         dict: Parsed JSON data
     """
-    def is_url(path):
-        try:
-            result = urlparse(path)
-            return all([result.scheme, result.netloc])
-        except:
-            return False
-    
     if is_url(source_path):
         # Handle URL
         response = requests.get(source_path)
@@ -36,4 +42,139 @@ def get_json_from_source(source_path):
         
 def output_progress(processed_count, stdout):
     if stdout:
-        stdout.write(f"\rProcessed {processed_count} items", ending='')
\ No newline at end of file
+        stdout.write(f"\rProcessed {processed_count} items", ending='')
+
+
+@contextmanager
+def open_text_source(source_path):
+    """
+    Opens a URL or file path as a text stream, without reading it all into memory.
+    """
+    if is_url(source_path):
+        with requests.get(source_path, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            # Undo any Content-Encoding (e.g. gzip) while reading
+            response.raw.decode_content = True
+            yield io.TextIOWrapper(response.raw, encoding='utf-8')
+    else:
+        file_path = Path(source_path)
+        if not file_path.exists():
+            raise FileNotFoundError(f"File not found: {source_path}")
+
+        with open(file_path, 'r', encoding='utf-8') as file:
+            yield file
+
+def iter_json_items(source_path, path, chunk_size=65536):
+    """
+    Yields the items of a JSON array inside a JSON document one at a time,
+    reading the document in chunks so memory use doesn't grow with its size.
+
+    Args:
+        source_path (str): Either a URL or file path to JSON data
+        path (tuple): Keys leading from the top-level object to the array,
+            e.g. ('response', 'docs')
+    """
+    with open_text_source(source_path) as file:
+        stream = JsonStream(file, chunk_size)
+
+        for key in path:
+            stream.find_key(key)
+
+        stream.expect('[')
+        if stream.peek() == ']':
+            return
+
+        while True:
+            yield stream.read_value()
+
+            separator = stream.peek()
+            stream.expect(separator)
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {separator!r}")
+
+class JsonStream:
+    """
+    Reads JSON values one at a time from a text file, keeping only the
+    unread part of the current chunk in memory.
+    """
+    whitespace = ' \t\n\r'
+    literals = ('true', 'false', 'null', 'NaN', 'Infinity', '-Infinity')
+    number_tail = re.compile(r'[-+.eE0-9]*')
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+
+    def read_chunk(self):
+        """Appends the next chunk to the unread part of the buffer. Returns False at the end of the file."""
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character, or '' at the end of the file."""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in self.whitespace:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read_chunk():
+                return ''
+
+    def expect(self, character):
+        found = self.peek()
+        if found != character:
+            raise ValueError(f"Expected {character!r} in JSON document, found {found or 'end of file'!r}")
+        self.position += 1
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError as error:
+                # The value may continue in the next chunk; anything else is malformed
+                if not self.is_truncated(error) or not self.read_chunk():
+                    raise
+                continue
+
+            # A number at the end of the buffer may continue in the next chunk
+            if self.number_tail.fullmatch(self.buffer, end) and self.read_chunk():
+                continue
+
+            self.position = end
+            return value
+
+    def is_truncated(self, error):
+        """Whether a decoding error could be from the buffer ending partway through a valid value."""
+        rest = error.doc[error.pos:]
+        return (
+            # Reported at the start of the string, which runs to the end of the buffer
+            error.msg.startswith('Unterminated string')
+            or (error.msg.startswith('Invalid \\uXXXX escape') and len(rest) <= len('uXXXX'))
+            # Nothing after the error position but the start of a literal or a number's tail
+            or any(literal.startswith(rest) for literal in self.literals)
+            or self.number_tail.fullmatch(rest) is not None
+        )
+
+    def find_key(self, key):
+        """Moves to the value of a key in the object that starts at the current position."""
+        self.expect('{')
+        while self.peek() == '"':
+            name = self.read_value()
+            self.expect(':')
+            if name == key:
+                return
+
+            self.read_value()
+            if self.peek() == ',':
+                self.expect(',')
+        raise ValueError(f"Key {key!r} not found in JSON document")
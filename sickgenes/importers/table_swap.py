@@ -0,0 +1,303 @@
+"""
+Bulk loading of whole tables through shadow tables.
+
+On PostgreSQL, TableReplacement loads rows with COPY into empty copies of
+models' tables that have no indexes or constraints, builds the live tables'
+constraints and indexes on them once they are loaded, then swaps them all
+in together by renaming and drops the old tables. Readers of the live
+tables only wait for the renames, never for the load, and the old rows are
+never deleted one by one. Other databases get the rows deleted from and
+inserted into the live tables instead.
+"""
+import hashlib
+import itertools
+import re
+from django.db import connections
+from sickgenes.models.managers import insert_rows
+
+# Rows encoded together when streaming COPY data
+COPY_CHUNK_ROWS = 10000
+
+
+def replace_table_rows(model, field_names, rows, using='default'):
+    """
+    Replaces all rows of a model's table with rows of values for the given
+    fields. Returns the number of rows loaded.
+    """
+    replacement = TableReplacement(using)
+    row_count = replacement.load(model, field_names, rows)
+    replacement.commit()
+    return row_count
+
+
+class TableReplacement:
+    """
+    Replaces the rows of one or more models' tables, which all change when
+    commit is called. A table that other tables have foreign keys to can
+    only be replaced along with them, loaded before them.
+    """
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.connection = connections[using]
+        self.use_shadow_tables = self.connection.vendor == 'postgresql'
+        # {model: ShadowTable}, in the order the tables were loaded
+        self.shadows = {}
+
+    def load(self, model, field_names, rows):
+        """ Loads the new rows of a model's table. Returns the number of rows loaded. """
+        if not self.use_shadow_tables:
+            model.objects.using(self.using).all().delete()
+            return insert_rows(model, field_names, rows, using=self.using)
+
+        shadow = ShadowTable(model, self.using)
+        shadow.create()
+        self.shadows[model] = shadow
+        return shadow.copy_rows(field_names, rows)
+
+    def values_list(self, model, field_names):
+        """ Tuples of the given fields' values of a model's rows, the new ones if it has been loaded. """
+        if model in self.shadows:
+            return self.shadows[model].values_list(field_names)
+        return list(model.objects.using(self.using).values_list(*field_names))
+
+    def commit(self):
+        """ Builds the shadow tables' constraints and indexes, then swaps them in. """
+        if not self.shadows:
+            return
+
+        shadows = list(self.shadows.values())
+        shadow_names = {shadow.table: shadow.name for shadow in shadows}
+        for shadow in shadows:
+            shadow.check_referencing_tables(shadow_names)
+        for shadow in shadows:
+            shadow.build_indexes(shadow_names)
+            # Queries right after the swap would otherwise be planned without statistics
+            shadow.analyze()
+
+        # Runs deferred foreign key checks now, as a table with pending ones can't be dropped
+        self.connection.check_constraints()
+        quote = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            tables = ', '.join(quote(shadow.table) for shadow in shadows)
+            cursor.execute(f'LOCK TABLE {tables} IN ACCESS EXCLUSIVE MODE')
+            for shadow in shadows:
+                shadow.swap(cursor)
+            # Tables with foreign keys go before the tables they refer to
+            for shadow in reversed(shadows):
+                cursor.execute(f'DROP TABLE {quote(shadow.old_name)}')
+            for shadow in shadows:
+                shadow.restore_names(cursor)
+        self.shadows = {}
+
+
+class CopyFile:
+    """ A read-only file of rows in PostgreSQL's COPY text format, for cursor.copy_expert. """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = b''
+        self.offset = 0
+        self.row_count = 0
+
+    def read(self, size=-1):
+        if self.offset >= len(self.buffer):
+            lines = [
+                '\t'.join(copy_value(value) for value in row)
+                for row in itertools.islice(self.rows, COPY_CHUNK_ROWS)
+            ]
+            self.row_count += len(lines)
+            self.buffer = ''.join(line + '\n' for line in lines).encode('utf-8')
+            self.offset = 0
+
+        if size < 0:
+            size = len(self.buffer) - self.offset
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+def copy_value(value):
+    """ A value as a COPY text format column. """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return (
+        str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    )
+
+
+class ShadowTable:
+    """
+    An empty copy of a model's PostgreSQL table with the same columns,
+    defaults and NOT NULL constraints, but no indexes or other constraints
+    until build_indexes is called.
+    """
+
+    def __init__(self, model, using='default'):
+        self.model = model
+        self.connection = connections[using]
+        self.table = model._meta.db_table
+        self.name = f'{self.table}__shadow'
+        self.old_name = f'{self.table}__old'
+        # (temporary name, live name, is a constraint) of each built constraint and index
+        self.renames = []
+
+    def quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def create(self):
+        with self.connection.cursor() as cursor:
+            # Also drops foreign keys to a shadow table left by a failed load
+            cursor.execute(f'DROP TABLE IF EXISTS {self.quote(self.name)} CASCADE')
+            cursor.execute(
+                f'CREATE TABLE {self.quote(self.name)} (LIKE {self.quote(self.table)} '
+                f'INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING GENERATED)'
+            )
+
+    def columns(self, field_names):
+        return ', '.join(self.quote(self.model._meta.get_field(name).column) for name in field_names)
+
+    def copy_rows(self, field_names, rows):
+        """ Loads rows of values for the given fields with COPY. Returns the number of rows. """
+        copy_file = CopyFile(rows)
+        with self.connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {self.quote(self.name)} ({self.columns(field_names)}) FROM STDIN', copy_file
+            )
+        return copy_file.row_count
+
+    def values_list(self, field_names):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'SELECT {self.columns(field_names)} FROM {self.quote(self.name)}')
+            return cursor.fetchall()
+
+    def check_referencing_tables(self, shadow_names):
+        """
+        Raises ValueError if a table that isn't being replaced, one not in
+        shadow_names, has a foreign key to the live table, as dropping the
+        live table would drop that foreign key.
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT DISTINCT referencing.relname
+                FROM pg_constraint
+                JOIN pg_class referencing ON referencing.oid = pg_constraint.conrelid
+                WHERE pg_constraint.contype = 'f' AND pg_constraint.confrelid = %s::regclass
+                """,
+                [self.table],
+            )
+            for (referencing_table,) in cursor.fetchall():
+                if referencing_table not in shadow_names:
+                    raise ValueError(
+                        f'{self.table} can only be replaced together with {referencing_table}, '
+                        f'which has a foreign key to it.'
+                    )
+
+    def build_indexes(self, shadow_names=None):
+        """
+        Adds the live table's constraints and indexes under temporary names:
+        primary key, unique and check constraints first, then indexes, then
+        foreign keys, which are checked against the loaded rows. Foreign keys
+        to a table in shadow_names, {live table: shadow table}, refer to its
+        shadow table instead, and so to the new rows once it is swapped in.
+        """
+        shadow_names = shadow_names or {}
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT conname, contype, pg_get_constraintdef(pg_constraint.oid), referenced.relname
+                FROM pg_constraint
+                LEFT JOIN pg_class referenced ON referenced.oid = pg_constraint.confrelid
+                WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'c', 'x', 'f')
+                ORDER BY contype = 'f', conname
+                """,
+                [self.table],
+            )
+            constraints = cursor.fetchall()
+
+            cursor.execute(
+                """
+                SELECT index_class.relname, pg_get_indexdef(pg_index.indexrelid)
+                FROM pg_index
+                JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+                WHERE pg_index.indrelid = %s::regclass
+                AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = pg_index.indexrelid)
+                ORDER BY index_class.relname
+                """,
+                [self.table],
+            )
+            indexes = cursor.fetchall()
+
+            for name, contype, definition, referenced_table in constraints:
+                if contype != 'f':
+                    self._add_constraint(cursor, name, definition)
+
+            for name, definition in indexes:
+                temporary_name = self.temporary_name(name)
+                cursor.execute(re.sub(
+                    r' INDEX \S+ ON (ONLY )?\S+ ',
+                    f' INDEX {self.quote(temporary_name)} ON {self.quote(self.name)} ',
+                    definition,
+                    count=1,
+                ))
+                self.renames.append((temporary_name, name, False))
+
+            for name, contype, definition, referenced_table in constraints:
+                if contype == 'f':
+                    if referenced_table in shadow_names:
+                        definition = re.sub(
+                            r'REFERENCES \S+?\(',
+                            f'REFERENCES {self.quote(shadow_names[referenced_table])}(',
+                            definition,
+                            count=1,
+                        )
+                    self._add_constraint(cursor, name, definition)
+
+    def analyze(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {self.quote(self.name)}')
+
+    def _add_constraint(self, cursor, name, definition):
+        temporary_name = self.temporary_name(name)
+        cursor.execute(
+            f'ALTER TABLE {self.quote(self.name)} ADD CONSTRAINT {self.quote(temporary_name)} {definition}'
+        )
+        self.renames.append((temporary_name, name, True))
+
+    def temporary_name(self, name):
+        """ A name for a shadow constraint or index that fits PostgreSQL's 63 character limit. """
+        return f"shadow_{hashlib.md5(name.encode('utf-8')).hexdigest()[:16]}"
+
+    def swap(self, cursor):
+        """
+        Renames the live table to the old name and the shadow table to the
+        live name. The live table must be locked first.
+        """
+        pk_column = self.model._meta.pk.column
+        cursor.execute(f'ALTER TABLE {self.quote(self.table)} RENAME TO {self.quote(self.old_name)}')
+        cursor.execute(f'ALTER TABLE {self.quote(self.name)} RENAME TO {self.quote(self.table)}')
+
+        # A serial key's sequence is owned by the old table and shared by the new one
+        cursor.execute(
+            'SELECT pg_get_serial_sequence(%s, %s), pg_get_serial_sequence(%s, %s)',
+            [self.quote(self.old_name), pk_column, self.quote(self.table), pk_column],
+        )
+        old_sequence, new_sequence = cursor.fetchone()
+        if old_sequence and not new_sequence:
+            cursor.execute(
+                f'ALTER SEQUENCE {old_sequence} OWNED BY {self.quote(self.table)}.{self.quote(pk_column)}'
+            )
+
+    def restore_names(self, cursor):
+        """ Gives the swapped in table's constraints and indexes the names the old table's had. """
+        for temporary_name, name, is_constraint in self.renames:
+            if is_constraint:
+                cursor.execute(
+                    f'ALTER TABLE {self.quote(self.table)} '
+                    f'RENAME CONSTRAINT {self.quote(temporary_name)} TO {self.quote(name)}'
+                )
+            else:
+                cursor.execute(f'ALTER INDEX {self.quote(temporary_name)} RENAME TO {self.quote(name)}')
@@ -1,7 +1,14 @@
+import hashlib
+import json
+import requests
 from django.db import transaction
 from django.core.management.base import CommandError
-from sickgenes.models import HgncGene, Ena, UniprotId, OmimId, AliasSymbol, AliasName, PrevSymbol, PrevName
-from .helper_functions import get_json_from_source, output_progress
+from sickgenes.models import (
+    HgncGene, Ena, UniprotId, OmimId, AliasSymbol, AliasName, PrevSymbol, PrevName, IdentifierLookup, GeneFinding,
+    DataVersion,
+)
+from sickgenes.models.managers import insert_rows
+from .helper_functions import iter_json_items, output_progress
 
 RELATED_MODELS = {
     'ena': Ena,
@@ -13,55 +20,154 @@ RELATED_MODELS = {
     'prev_name': PrevName,
 }
 
+MAIN_FIELDS = ['symbol', 'name', 'entrez_id', 'ensembl_gene_id', 'vega_id', 'ucsc_id']
+
+# Number of genes upserted together
+BATCH_SIZE = 2000
+
 @transaction.atomic
-def update_hgnc_data(hgnc_data_paths, stdout=None):
+def update_hgnc_data(hgnc_data_paths, stdout=None, batch_size=BATCH_SIZE):
     """
     Updates HgncGene records and their related tables from a JSON data source.
+
+    Genes are read from the data source one at a time and upserted in
+    batches, and the related values of each batch are replaced with one
+    delete and one insert per related table. Related fields missing from a
+    gene's data are emptied, as HGNC leaves out empty fields.
     """
     for hgnc_data_path in hgnc_data_paths:
-        
-        try:
-            hgnc_data = get_json_from_source(hgnc_data_path)
-            hgnc_genes = hgnc_data['response']['docs']
-        except Exception as e:
-            raise CommandError(f'Failed to retrieve or parse HGNC JSON data: {e}')
-
         processed_count = 0
+        batch = {}
+
+        for hgnc_id, gene_data in iter_genes(hgnc_data_path):
+            batch[hgnc_id] = gene_data
+
+            if len(batch) >= batch_size:
+                processed_count += len(save_gene_batch(batch))
+                output_progress(processed_count, stdout)
+                batch = {}
+
+        if batch:
+            processed_count += len(save_gene_batch(batch))
+            output_progress(processed_count, stdout)
+
+        stdout.write() if stdout else None
 
-        for gene_data in hgnc_genes:
+    IdentifierLookup.objects.rebuild(HgncGene)
+    # Gene symbols label the graph's nodes
+    DataVersion.bump()
+
+    return processed_count
+
+@transaction.atomic
+def update_hgnc_data_incremental(hgnc_data_paths, stdout=None, batch_size=BATCH_SIZE):
+    """
+    Updates only the HgncGene records whose content hash differs from the
+    stored one, and removes genes no longer in the data source unless they
+    are used by a GeneFinding.
+
+    Returns a dictionary with the number of genes inserted, updated,
+    unchanged and removed, and the number of missing genes kept because
+    findings use them.
+    """
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'kept': 0}
+    stored_hashes = dict(HgncGene.objects.exclude(hgnc_id__isnull=True).values_list('hgnc_id', 'content_hash'))
+    source_hgnc_ids = set()
+    changed_gene_ids = []
+    batch = {}
+
+    for hgnc_data_path in hgnc_data_paths:
+        for hgnc_id, gene_data in iter_genes(hgnc_data_path):
+            source_hgnc_ids.add(hgnc_id)
+
+            if hgnc_id not in stored_hashes:
+                counts['inserted'] += 1
+            elif stored_hashes[hgnc_id] != gene_content_hash(gene_data):
+                counts['updated'] += 1
+            else:
+                counts['unchanged'] += 1
+                continue
+
+            batch[hgnc_id] = gene_data
+
+            if len(batch) >= batch_size:
+                changed_gene_ids.extend(save_gene_batch(batch))
+                output_progress(len(source_hgnc_ids), stdout)
+                batch = {}
+
+    if batch:
+        changed_gene_ids.extend(save_gene_batch(batch))
+    output_progress(len(source_hgnc_ids), stdout)
+
+    # Genes withdrawn from HGNC are removed, unless findings use them
+    missing_genes = HgncGene.objects.filter(hgnc_id__in=stored_hashes.keys() - source_hgnc_ids)
+    used_gene_ids = GeneFinding.objects.filter(hgnc_gene__isnull=False).values('hgnc_gene_id')
+    counts['kept'] = missing_genes.filter(pk__in=used_gene_ids).count()
+
+    removed_gene_ids = list(missing_genes.exclude(pk__in=used_gene_ids).values_list('pk', flat=True))
+    if removed_gene_ids:
+        HgncGene.objects.filter(pk__in=removed_gene_ids).delete()
+    counts['removed'] = len(removed_gene_ids)
+
+    IdentifierLookup.objects.rebuild(HgncGene, changed_gene_ids + removed_gene_ids)
+    DataVersion.bump()
+
+    stdout.write() if stdout else None
+
+    return counts
+
+def iter_genes(hgnc_data_path):
+    """
+    Yields (hgnc_id, gene data) for each gene document with an HGNC id,
+    reading the JSON data source one document at a time.
+    """
+    try:
+        for gene_data in iter_json_items(hgnc_data_path, ('response', 'docs')):
             hgnc_id = int(gene_data.get('hgnc_id').split(':')[1])
             if not hgnc_id:
                 continue
+            yield hgnc_id, gene_data
+    except (OSError, ValueError, requests.RequestException) as e:
+        raise CommandError(f'Failed to retrieve or parse HGNC JSON data: {e}')
+
+def gene_content_hash(gene_data):
+    """SHA-256 of the imported fields of a gene document."""
+    content = [gene_data.get(field) for field in MAIN_FIELDS] + [
+        sorted(str(item) for item in gene_data.get(field_name, []) if item is not None)
+        for field_name in RELATED_MODELS
+    ]
+    return hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()
 
-            main_fields = {
-                'symbol': gene_data.get('symbol'),
-                'name': gene_data.get('name'),
-                'entrez_id': gene_data.get('entrez_id'),
-                'ensembl_gene_id': gene_data.get('ensembl_gene_id'),
-                'vega_id': gene_data.get('vega_id'),
-                'ucsc_id': gene_data.get('ucsc_id'),
-            }
-            gene_obj, _ = HgncGene.objects.update_or_create(
+def save_gene_batch(batch):
+    """
+    Upserts a batch of {hgnc_id: gene data} and replaces all of their
+    related values, so that they match the content hash. Returns the ids of
+    the saved genes.
+    """
+    HgncGene.objects.bulk_create(
+        [
+            HgncGene(
                 hgnc_id=hgnc_id,
-                defaults=main_fields
+                content_hash=gene_content_hash(gene_data),
+                **{field: gene_data.get(field) for field in MAIN_FIELDS},
             )
+            for hgnc_id, gene_data in batch.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['hgnc_id'],
+        update_fields=MAIN_FIELDS + ['content_hash', 'updated_at'],
+    )
+    gene_ids = dict(HgncGene.objects.filter(hgnc_id__in=batch).values_list('hgnc_id', 'id'))
 
-            for field_name, model_class in RELATED_MODELS.items():
-                if field_name in gene_data:
-                    model_class.objects.filter(gene=gene_obj).delete()
-
-                    # Bulk create new entries for efficiency
-                    items_to_create = [
-                        model_class(gene=gene_obj, value=item)
-                        for item in gene_data[field_name] if item is not None
-                    ]
-                    if items_to_create:
-                        model_class.objects.bulk_create(items_to_create, ignore_conflicts=True)
-            
-            processed_count += 1
-
-            output_progress(processed_count, stdout)
+    for field_name, model_class in RELATED_MODELS.items():
+        rows = []
+        for hgnc_id, gene_data in batch.items():
+            rows.extend(
+                (gene_ids[hgnc_id], item)
+                for item in dict.fromkeys(gene_data.get(field_name, [])) if item is not None
+            )
 
-        stdout.write() if stdout else None
+        model_class.objects.filter(gene_id__in=gene_ids.values()).delete()
+        insert_rows(model_class, ['gene', 'value'], rows, ignore_conflicts=True)
 
-    return processed_count
\ No newline at end of file
+    return list(gene_ids.values())
@@ -1,8 +1,21 @@
+import hashlib
+import json
+import multiprocessing
+import queue
+import re
+import threading
+import time
 import zipfile
 import xml.etree.ElementTree as ET
-from django.db import transaction
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.db import connections, transaction
 from django.core.management.base import CommandError
-from sickgenes.models import HmdbMetabolite, MetaboliteSynonym, SecondaryAccession
+from sickgenes.models import (
+    HmdbMetabolite, MetaboliteSynonym, SecondaryAccession, IdentifierLookup, ImportRun, StagedMetabolite,
+)
+from sickgenes.models.managers import insert_rows
 from .helper_functions import output_progress
 
 RELATED_MODELS = {
@@ -20,9 +33,8 @@ RELATED_MODELS = {
     },
 }
 
-def _get_field_value(element, tag, namespace, cast_type=str, max_len=None):
-    """Helper to find text in an element, cast it, and check its length."""
-    node = element.find(tag, namespace)
+def _get_field_value(node, cast_type=str, max_len=None):
+    """Helper to read the text of an element, cast it, and check its length."""
     if node is not None and node.text:
         value = node.text.strip()
         if max_len and len(value) > max_len:
@@ -33,80 +45,505 @@ def _get_field_value(element, tag, namespace, cast_type=str, max_len=None):
             return None
     return None
 
+# Number of metabolites upserted together
+BATCH_SIZE = 1000
+
+MAIN_FIELDS = {
+    'name': {},
+    'cas_registry_number': {},
+    'drugbank_id': {},
+    'foodb_id': {},
+    'knapsack_id': {},
+    'biocyc_id': {},
+    'wikipedia_id': {},
+    'iupac_name': {'max_len': 255},
+    'traditional_iupac': {'max_len': 255},
+    'bigg_id': {'cast_type': int},
+    'pubchem_compound_id': {'cast_type': int},
+    'chemspider_id': {'cast_type': int},
+    'chebi_id': {'cast_type': int},
+}
+
+# Metabolites parsed together by one worker process
+METABOLITES_PER_CHUNK = 100
+# Parsed batches waiting to be saved, so parsing can't run far ahead of the database
+QUEUE_SIZE = 4
+
+NAMESPACE = {'hmdb': 'http://www.hmdb.ca'}
+METABOLITE_TAG = f"{{{NAMESPACE['hmdb']}}}metabolite"
+ACCESSION_TAG = f"{{{NAMESPACE['hmdb']}}}accession"
+# Fully qualified tags of the main fields and related values, so parsing a
+# metabolite is one pass over its children with dictionary lookups
+FIELD_TAGS = {f"{{{NAMESPACE['hmdb']}}}{field}": field for field in MAIN_FIELDS}
+RELATED_TAGS = {f"{{{NAMESPACE['hmdb']}}}{parent_tag}": parent_tag for parent_tag in RELATED_MODELS}
+RELATED_CHILD_TAGS = {
+    parent_tag: f"{{{NAMESPACE['hmdb']}}}{config['child_tag']}" for parent_tag, config in RELATED_MODELS.items()
+}
+ROOT_TAG_PATTERN = re.compile(rb'<(?:([\w.-]+):)?hmdb[\s>]')
+
 @transaction.atomic
-def update_hmdb_data(hmdb_data_path, hmdb_xml_name, stdout=None):
+def update_hmdb_data(hmdb_data_path, hmdb_xml_name, stdout=None, batch_size=BATCH_SIZE, workers=1,
+                     skip_unchanged=True):
     """
     Updates HmdbMetabolite records and their related tables from a zipped XML source.
+
+    A background thread parses the XML into batches of metabolites while
+    this thread saves them, with a bounded queue between the two. With more
+    than one worker, the XML is split into chunks of <metabolite> elements
+    that are parsed by a pool of processes.
+
+    Metabolites are upserted in batches, and the related values of each
+    batch are replaced with one delete and one insert per related table.
+    With skip_unchanged, metabolites whose content hash matches the stored
+    one are not written at all. Returns the number of metabolites processed
+    and saved, as a dict with 'processed' and 'saved' keys.
     """
-    processed_count = 0
-    namespace = {'hmdb': 'http://www.hmdb.ca'}
-    metabolite_tag = f"{{{namespace['hmdb']}}}metabolite"
+    timings = {'parse': 0.0, 'wait': 0.0, 'write': 0.0, 'lookup': 0.0}
+    saved_ids = []
+
+    def save_batch(batch, parsed_count):
+        changed = changed_metabolites(batch) if skip_unchanged else batch
+        if changed:
+            saved_ids.extend(save_metabolite_batch(changed))
+        return len(batch)
+
+    try:
+        processed_count = run_import_pipeline(
+            hmdb_data_path, hmdb_xml_name, save_batch, stdout, batch_size, workers, timings,
+        )
+
+        start_time = time.perf_counter()
+        rebuild_identifier_lookup(saved_ids if skip_unchanged else None, batch_size)
+        timings['lookup'] += time.perf_counter() - start_time
+
+    except (zipfile.BadZipFile, KeyError, ET.ParseError) as e:
+        raise CommandError(f'Failed to read or parse HMDB data: {e}')
+    except Exception as e:
+        raise CommandError(f'An unexpected error occurred while processing HMDB data: {e}')
+
+    _output_timings(timings, stdout)
+    if stdout:
+        stdout.write(f'Saved {len(saved_ids)} new or changed metabolites, skipped {processed_count - len(saved_ids)}.')
+
+    return {'processed': processed_count, 'saved': len(saved_ids)}
+
+def update_hmdb_data_checkpointed(hmdb_data_path, hmdb_xml_name, stdout=None, batch_size=BATCH_SIZE, workers=1,
+                                  resume=False, skip_unchanged=True):
+    """
+    Imports HMDB data in two phases, so that a failed import can be resumed.
+
+    Parsed metabolites are first staged in StagedMetabolite rows, committing
+    each batch together with the number of metabolites parsed so far and the
+    last staged accession on an in-progress ImportRun. Once the whole source
+    is staged, it is merged into HmdbMetabolite in one transaction, so
+    readers see either the old data or all of the new data.
+
+    With resume, the latest in-progress HMDB import is continued instead of
+    starting a new one. The source is parsed again from the start, as it is
+    a compressed stream, but metabolites already staged are not saved again.
+    With skip_unchanged, metabolites whose content hash matches the stored
+    one are not staged, and the ImportRun is deleted instead of completed if
+    none changed. Returns the number of metabolites processed and saved, as
+    a dict with 'processed' and 'saved' keys.
+    """
+    timings = {'parse': 0.0, 'wait': 0.0, 'write': 0.0, 'lookup': 0.0}
+
+    if resume:
+        import_run = ImportRun.objects.filter(
+            database='hmdb', status=ImportRun.IN_PROGRESS
+        ).order_by('-id').first()
+        if import_run is None:
+            raise CommandError('There is no unfinished HMDB import to resume.')
+        skip_count = import_run.processed_count or 0
+    else:
+        # A new import replaces any unfinished one
+        ImportRun.objects.filter(database='hmdb', status=ImportRun.IN_PROGRESS).delete()
+        import_run = ImportRun.objects.create(database='hmdb', status=ImportRun.IN_PROGRESS, processed_count=0)
+        skip_count = 0
+
+    def stage_batch(batch, parsed_count):
+        changed = changed_metabolites(batch) if skip_unchanged else batch
+        with transaction.atomic():
+            StagedMetabolite.objects.bulk_create([
+                StagedMetabolite(import_run=import_run, accession=accession, data=metabolite_data)
+                for accession, metabolite_data in changed.items()
+            ])
+            import_run.processed_count = parsed_count
+            import_run.checkpoint = next(reversed(batch))
+            import_run.save(update_fields=['processed_count', 'checkpoint', 'updated_at'])
+        return len(batch)
 
     try:
-        with zipfile.ZipFile(hmdb_data_path, 'r') as zip_file:
-            with zip_file.open(hmdb_xml_name) as xml_file:
-                for event, elem in ET.iterparse(xml_file, events=("end",)):
-                    if elem.tag == metabolite_tag:
-
-                        primary_accession_element = elem.find('hmdb:accession', namespace)
-                        if primary_accession_element is None or not primary_accession_element.text:
-                            elem.clear()
-                            continue
-                        
-                        primary_accession = primary_accession_element.text
-
-                        # Map all single-value fields from the XML to the model
-                        main_fields = {
-                            'name': _get_field_value(elem, 'hmdb:name', namespace),
-                            'cas_registry_number': _get_field_value(elem, 'hmdb:cas_registry_number', namespace),
-                            'drugbank_id': _get_field_value(elem, 'hmdb:drugbank_id', namespace),
-                            'foodb_id': _get_field_value(elem, 'hmdb:foodb_id', namespace),
-                            'knapsack_id': _get_field_value(elem, 'hmdb:knapsack_id', namespace),
-                            'biocyc_id': _get_field_value(elem, 'hmdb:biocyc_id', namespace),
-                            'wikipedia_id': _get_field_value(elem, 'hmdb:wikipedia_id', namespace),
-                            'iupac_name': _get_field_value(elem, 'hmdb:iupac_name', namespace, max_len=255),
-                            'traditional_iupac': _get_field_value(elem, 'hmdb:traditional_iupac', namespace, max_len=255),
-                            'bigg_id': _get_field_value(elem, 'hmdb:bigg_id', namespace, cast_type=int),
-                            'pubchem_compound_id': _get_field_value(elem, 'hmdb:pubchem_compound_id', namespace, cast_type=int),
-                            'chemspider_id': _get_field_value(elem, 'hmdb:chemspider_id', namespace, cast_type=int),
-                            'chebi_id': _get_field_value(elem, 'hmdb:chebi_id', namespace, cast_type=int),
-                        }
-                        
-                        metabolite_obj, _ = HmdbMetabolite.objects.update_or_create(
-                            accession=primary_accession,
-                            defaults=main_fields
-                        )
-
-                        for parent_tag, config in RELATED_MODELS.items():
-                            parent_element = elem.find(f'hmdb:{parent_tag}', namespace)
-                            if parent_element is not None:
-                                model_class = config['model']
-                                model_class.objects.filter(metabolite=metabolite_obj).delete()
-
-                                items_to_create = []
-                                for item in parent_element.findall(f"hmdb:{config['child_tag']}", namespace):
-                                    if item.text:
-                                        value = item.text.strip()
-                                        if config['max_length'] and len(value) > config['max_length']:
-                                            continue
-                                        
-                                        items_to_create.append(
-                                            model_class(metabolite=metabolite_obj, **{config['value_field']: value})
-                                        )
-                                
-                                if items_to_create:
-                                    model_class.objects.bulk_create(items_to_create, ignore_conflicts=True)
-
-                        processed_count += 1
-                        elem.clear()
-
-                        output_progress(processed_count, stdout)
+        run_import_pipeline(
+            hmdb_data_path, hmdb_xml_name, stage_batch, stdout, batch_size, workers, timings,
+            skip_count=skip_count, checkpoint=import_run.checkpoint,
+        )
+
+        with transaction.atomic():
+            start_time = time.perf_counter()
+            saved_ids = merge_staged_metabolites(import_run, batch_size)
+            timings['write'] += time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            rebuild_identifier_lookup(saved_ids if skip_unchanged else None, batch_size)
+            timings['lookup'] += time.perf_counter() - start_time
+
+            # A run that changed nothing isn't recorded, so indexes of the data aren't rebuilt
+            if saved_ids:
+                import_run.status = ImportRun.COMPLETE
+                import_run.save(update_fields=['status', 'updated_at'])
+            else:
+                import_run.delete()
 
     except (zipfile.BadZipFile, KeyError, ET.ParseError) as e:
         raise CommandError(f'Failed to read or parse HMDB data: {e}')
+    except CommandError:
+        raise
     except Exception as e:
         raise CommandError(f'An unexpected error occurred while processing HMDB data: {e}')
-    
-    stdout.write() if stdout else None
 
-    return processed_count
\ No newline at end of file
+    _output_timings(timings, stdout)
+
+    return {'processed': import_run.processed_count, 'saved': len(saved_ids)}
+
+def merge_staged_metabolites(import_run, batch_size=BATCH_SIZE):
+    """
+    Saves the staged metabolites of an import run in batches, then deletes
+    them. Returns the ids of the saved metabolites.
+    """
+    staged = import_run.staged_metabolites.order_by('id').values_list('accession', 'data')
+    saved_ids = []
+    batch = {}
+
+    for accession, metabolite_data in staged.iterator(chunk_size=batch_size):
+        batch[accession] = metabolite_data
+        if len(batch) >= batch_size:
+            saved_ids.extend(save_metabolite_batch(batch))
+            batch = {}
+
+    if batch:
+        saved_ids.extend(save_metabolite_batch(batch))
+
+    import_run.staged_metabolites.all().delete()
+    return saved_ids
+
+def rebuild_identifier_lookup(metabolite_ids=None, batch_size=BATCH_SIZE):
+    """
+    Rebuilds the lookup rows of the given metabolites, a batch at a time, or
+    of all metabolites if metabolite_ids is None.
+    """
+    if metabolite_ids is None:
+        IdentifierLookup.objects.rebuild(HmdbMetabolite)
+        return
+
+    for start in range(0, len(metabolite_ids), batch_size):
+        IdentifierLookup.objects.rebuild(HmdbMetabolite, metabolite_ids[start:start + batch_size])
+
+def run_import_pipeline(hmdb_data_path, hmdb_xml_name, save_batch, stdout=None, batch_size=BATCH_SIZE, workers=1,
+                        timings=None, skip_count=0, checkpoint=None):
+    """
+    Parses metabolites in a background thread and calls
+    save_batch(batch, parsed_count) in this thread for each batch, where
+    parsed_count is the number of metabolites parsed up to the end of the
+    batch. The first skip_count metabolites are parsed but not saved, and
+    the last of them must have the accession checkpoint, if given.
+    Returns the total of the save_batch return values.
+    """
+    timings = timings if timings is not None else {'parse': 0.0, 'wait': 0.0, 'write': 0.0}
+    processed_count = 0
+    batches = queue.Queue(maxsize=QUEUE_SIZE)
+    stop_parsing = threading.Event()
+
+    parser_thread = threading.Thread(
+        target=_parse_into_queue,
+        args=(hmdb_data_path, hmdb_xml_name, batch_size, workers, batches, stop_parsing, timings,
+              skip_count, checkpoint),
+        daemon=True,
+    )
+    parser_thread.start()
+
+    try:
+        while True:
+            start_time = time.perf_counter()
+            item = batches.get()
+            timings['wait'] += time.perf_counter() - start_time
+
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            batch, parsed_count = item
+            start_time = time.perf_counter()
+            processed_count += save_batch(batch, parsed_count)
+            timings['write'] += time.perf_counter() - start_time
+            output_progress(parsed_count, stdout)
+    finally:
+        stop_parsing.set()
+        # Unblocks the parser thread if it is waiting for room in the queue
+        while parser_thread.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    return processed_count
+
+def _output_timings(timings, stdout):
+    if stdout:
+        stdout.write()
+        stdout.write(
+            f"Parsing {timings['parse']:.1f}s, waiting for parser {timings['wait']:.1f}s, "
+            f"database writes {timings['write']:.1f}s, identifier lookup {timings['lookup']:.1f}s"
+        )
+
+def _parse_into_queue(hmdb_data_path, hmdb_xml_name, batch_size, workers, batches, stop_parsing, timings,
+                      skip_count=0, checkpoint=None):
+    """
+    Puts (batch, parsed count) pairs of parsed metabolites on the queue,
+    then None when done, or the exception if parsing fails. Stops early if
+    stop_parsing is set.
+    """
+    metabolites = iter_parsed_metabolites(hmdb_data_path, hmdb_xml_name, workers)
+    try:
+        batch = {}
+        parsed_count = 0
+        while not stop_parsing.is_set():
+            start_time = time.perf_counter()
+            metabolite_data = next(metabolites, None)
+            timings['parse'] += time.perf_counter() - start_time
+
+            if metabolite_data is None:
+                break
+            parsed_count += 1
+
+            if parsed_count <= skip_count:
+                if parsed_count == skip_count and checkpoint and metabolite_data['accession'] != checkpoint:
+                    raise CommandError(
+                        f"HMDB data changed since the interrupted import: expected {checkpoint} "
+                        f"at metabolite {skip_count}, found {metabolite_data['accession']}. "
+                        f"Start a new import without --resume."
+                    )
+                continue
+
+            batch[metabolite_data['accession']] = metabolite_data
+
+            if len(batch) >= batch_size:
+                batches.put((batch, parsed_count))
+                batch = {}
+
+        if parsed_count < skip_count and not stop_parsing.is_set():
+            raise CommandError(
+                f'HMDB data changed since the interrupted import: it has {parsed_count} metabolites, '
+                f'but {skip_count} were already imported. Start a new import without --resume.'
+            )
+
+        if batch and not stop_parsing.is_set():
+            batches.put((batch, parsed_count))
+        batches.put(None)
+    except Exception as e:
+        batches.put(e)
+    finally:
+        metabolites.close()
+
+def iter_parsed_metabolites(hmdb_data_path, hmdb_xml_name, workers=1):
+    """Yields the parsed data of each <metabolite> element with an accession."""
+    with zipfile.ZipFile(hmdb_data_path, 'r') as zip_file:
+        with zip_file.open(hmdb_xml_name) as xml_file:
+            if workers > 1:
+                yield from _parse_chunks_in_processes(xml_file, workers)
+                return
+
+            events = ET.iterparse(xml_file, events=("start", "end"))
+            event, root = next(events)
+            for event, elem in events:
+                if elem.tag == METABOLITE_TAG and event == "end":
+                    metabolite_data = parse_metabolite(elem)
+                    # Releases the parsed metabolite, which the root still references
+                    root.clear()
+                    if metabolite_data is not None:
+                        yield metabolite_data
+
+def _parse_chunks_in_processes(xml_file, workers):
+    """
+    Parses chunks of <metabolite> elements in a pool of processes, yielding
+    the results in document order. Only a few chunks per worker are in
+    flight at a time.
+
+    The workers are spawned rather than forked, as forking from a thread
+    would copy the parent's open database connections and any locks held
+    by its other threads. Spawned workers import this module, so they set
+    up Django first.
+    """
+    # The parsing needs no database connection in this thread either
+    connections.close_all()
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup,
+    ) as executor:
+        pending = deque()
+        for chunk in iter_metabolite_chunks(xml_file, METABOLITES_PER_CHUNK):
+            pending.append(executor.submit(parse_metabolite_chunk, *chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+def iter_metabolite_chunks(xml_file, metabolites_per_chunk, read_size=1024 * 1024):
+    """
+    Splits the HMDB XML into byte ranges of whole <metabolite> elements.
+    Yields (root start tag, root end tag, chunk), which together form a
+    well-formed document with the original namespace declarations.
+    """
+    buffer = b''
+    root_match = None
+    while root_match is None or buffer.find(b'>', root_match.start()) == -1:
+        data = xml_file.read(read_size)
+        if not data:
+            raise ET.ParseError('HMDB XML has no <hmdb> root element')
+        buffer += data
+        root_match = ROOT_TAG_PATTERN.search(buffer)
+
+    root_start_end = buffer.find(b'>', root_match.start()) + 1
+    root_start = buffer[root_match.start():root_start_end]
+    prefix = root_match.group(1) + b':' if root_match.group(1) else b''
+    root_end = b'</' + prefix + b'hmdb>'
+    close_tag = b'</' + prefix + b'metabolite>'
+
+    buffer = buffer[root_start_end:]
+    position = 0
+    count = 0
+    while True:
+        index = buffer.find(close_tag, position)
+        if index == -1:
+            data = xml_file.read(read_size)
+            if not data:
+                break
+            # The close tag may straddle the end of the buffer
+            position = max(len(buffer) - len(close_tag), position)
+            buffer += data
+            continue
+
+        position = index + len(close_tag)
+        count += 1
+        if count >= metabolites_per_chunk:
+            yield root_start, root_end, buffer[:position]
+            buffer = buffer[position:]
+            position = 0
+            count = 0
+
+    if count:
+        yield root_start, root_end, buffer[:position]
+
+def parse_metabolite_chunk(root_start, root_end, chunk):
+    """Parses a chunk of <metabolite> elements. Runs in a worker process."""
+    root = ET.fromstring(root_start + chunk + root_end)
+    parsed = []
+    for elem in root:
+        if elem.tag == METABOLITE_TAG:
+            metabolite_data = parse_metabolite(elem)
+            if metabolite_data is not None:
+                parsed.append(metabolite_data)
+    return parsed
+
+def parse_metabolite(elem):
+    """
+    Reads a <metabolite> element into a dictionary of its accession, its
+    main fields and, for each related table whose parent element is present,
+    its related values. Returns None if it has no accession.
+
+    Walks the element's children once, using the first child with each tag.
+    """
+    children = {}
+    for child in elem:
+        if child.tag not in children:
+            children[child.tag] = child
+
+    primary_accession_element = children.get(ACCESSION_TAG)
+    if primary_accession_element is None or not primary_accession_element.text:
+        return None
+
+    metabolite_data = {
+        'accession': primary_accession_element.text,
+        # Map all single-value fields from the XML to the model
+        'fields': {
+            field: _get_field_value(children.get(tag), **MAIN_FIELDS[field])
+            for tag, field in FIELD_TAGS.items()
+        },
+        'related': {},
+    }
+
+    for tag, parent_tag in RELATED_TAGS.items():
+        parent_element = children.get(tag)
+        if parent_element is None:
+            continue
+
+        child_tag = RELATED_CHILD_TAGS[parent_tag]
+        max_length = RELATED_MODELS[parent_tag]['max_length']
+        values = []
+        for item in parent_element:
+            if item.tag == child_tag and item.text:
+                value = item.text.strip()
+                if max_length and len(value) > max_length:
+                    continue
+                values.append(value)
+        metabolite_data['related'][parent_tag] = values
+
+    return metabolite_data
+
+def metabolite_content_hash(metabolite_data):
+    """SHA-256 of the imported fields and related values of a parsed metabolite."""
+    content = [
+        metabolite_data['fields'],
+        {parent_tag: sorted(set(values)) for parent_tag, values in metabolite_data['related'].items()},
+    ]
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+def changed_metabolites(batch):
+    """The metabolites of a batch that are new or whose content hash differs from the stored one."""
+    stored_hashes = dict(
+        HmdbMetabolite.objects.filter(accession__in=batch).values_list('accession', 'content_hash')
+    )
+    return {
+        accession: metabolite_data
+        for accession, metabolite_data in batch.items()
+        if stored_hashes.get(accession) != metabolite_content_hash(metabolite_data)
+    }
+
+def save_metabolite_batch(batch):
+    """
+    Upserts a batch of {accession: metabolite data} and replaces the related
+    values present in each metabolite's data. Returns the ids of the saved metabolites.
+    """
+    HmdbMetabolite.objects.bulk_create(
+        [
+            HmdbMetabolite(
+                accession=accession,
+                content_hash=metabolite_content_hash(metabolite_data),
+                **metabolite_data['fields'],
+            )
+            for accession, metabolite_data in batch.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['accession'],
+        update_fields=list(MAIN_FIELDS) + ['content_hash', 'updated_at'],
+    )
+    metabolite_ids = dict(HmdbMetabolite.objects.filter(accession__in=batch).values_list('accession', 'id'))
+
+    for parent_tag, config in RELATED_MODELS.items():
+        model_class = config['model']
+        replaced_metabolite_ids = []
+        rows = []
+        for accession, metabolite_data in batch.items():
+            if parent_tag not in metabolite_data['related']:
+                continue
+
+            metabolite_id = metabolite_ids[accession]
+            replaced_metabolite_ids.append(metabolite_id)
+            rows.extend((metabolite_id, value) for value in dict.fromkeys(metabolite_data['related'][parent_tag]))
+
+        if replaced_metabolite_ids:
+            model_class.objects.filter(metabolite_id__in=replaced_metabolite_ids).delete()
+        insert_rows(model_class, ['metabolite', config['value_field']], rows, ignore_conflicts=True)
+
+    return list(metabolite_ids.values())
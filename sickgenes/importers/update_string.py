@@ -1,9 +1,14 @@
 from django.db import transaction
 from django.core.management.base import CommandError
-from sickgenes.models import StringProtein, StringInteraction, HgncGene
+from sickgenes.models import StringProtein, StringInteraction, GeneInteraction, HgncGene, DataVersion
+from .table_swap import TableReplacement
 from django.conf import settings
+from sickgenes.gene_network import build_gene_network
 import os
 import gzip
+import time
+import numpy as np
+from array import array
 
 BASE_DIR = settings.BASE_DIR
 
@@ -13,20 +18,38 @@ STRING_ALIAS_PATH = os.path.join(BASE_DIR, 'approved_data/9606.protein.aliases.v
 SAMPLE_STRING_INTERACTION_PATH = os.path.join(BASE_DIR, 'sample_data/sample_9606.protein.links.v12.0.txt.gz')
 STRING_INTERACTION_PATH = os.path.join(BASE_DIR, 'approved_data/9606.protein.links.v12.0.txt.gz')
 
-def process_string_aliases(file_path, stdout):
+# Number of missing HGNC ids listed in the alias import warning
+MISSING_IDS_SHOWN = 20
+
+# Bits of a packed interaction key used by each protein pk and by the score
+PK_BITS = 27
+SCORE_BITS = 10
+MAX_PACKED_PK = (1 << PK_BITS) - 1
+MAX_SCORE = (1 << SCORE_BITS) - 1
+# Packed interaction keys compared or unpacked together
+UNPACK_CHUNK_SIZE = 1000000
+
+def process_string_aliases(file_path, stdout, replacement=None):
     """
-    Process STRING alias file and create StringProtein records in batches.
+    Process STRING alias file and load StringProtein records.
+
+    HgncGene ids are resolved through a map loaded in one query, and HGNC ids
+    without a gene are reported together at the end.
+
+    The proteins are loaded into replacement, a TableReplacement, which
+    must also replace StringInteraction before it is committed. Without
+    one, the proteins are swapped in straight away and the interactions
+    of the old proteins, and of their genes, are emptied.
     """
     if not os.path.exists(file_path):
         raise CommandError(f'STRING alias file not found at: {file_path}')
     
-    created_count = 0
-    error_count = 0
     processed_count = 0
-    batch_size = 1000
-    batch_data = []
-    
-    StringProtein.objects.all().delete()
+    # {protein_id: (hgnc_id, gene_id)}, keeping the first HGNC id of each protein
+    proteins = {}
+    missing_hgnc_ids = {}
+
+    gene_ids = dict(HgncGene.objects.filter(hgnc_id__isnull=False).values_list('hgnc_id', 'id'))
     
     try:
         with gzip.open(file_path, 'rt', encoding='utf-8') as file:
@@ -50,154 +73,153 @@ def process_string_aliases(file_path, stdout):
                             protein_id = string_protein_id
                         
                         hgnc_id = int(alias.split(':')[1])
-                        
-                        try:
-                            hgnc_gene = HgncGene.objects.get(hgnc_id=hgnc_id)
-                            
-                            batch_data.append(StringProtein(
-                                protein_id=protein_id,
-                                hgnc_id=hgnc_id,
-                                hgnc_gene=hgnc_gene
-                            ))
-                            
-                            if len(batch_data) >= batch_size:
-                                StringProtein.objects.bulk_create(batch_data, ignore_conflicts=True)
-                                created_count += len(batch_data)
-                                batch_data = []
-                                
-                        except HgncGene.DoesNotExist:
-                            if stdout:
-                                stdout.write(f"Warning: HgncGene with ID {hgnc_id} not found for protein {protein_id}")
-                            error_count += 1
-                            continue
-                        except Exception as e:
-                            if stdout:
-                                stdout.write(f"Error processing alias line {line_num}: {e}")
-                            error_count += 1
-                            continue
+                        gene_id = gene_ids.get(hgnc_id)
+
+                        if gene_id is None:
+                            missing_hgnc_ids.setdefault(hgnc_id, protein_id)
+                        else:
+                            proteins.setdefault(protein_id, (hgnc_id, gene_id))
                 
                 processed_count += 1
                 
                 if processed_count % 1000 == 0 and stdout:
                     stdout.write(f"Processed {processed_count} alias lines...")
-        
-        if batch_data:
-            StringProtein.objects.bulk_create(batch_data, ignore_conflicts=True)
-            created_count += len(batch_data)
+
+        standalone = replacement is None
+        if standalone:
+            replacement = TableReplacement()
+        created_count = replacement.load(
+            StringProtein,
+            ['protein_id', 'hgnc_id', 'hgnc_gene'],
+            ((protein_id, hgnc_id, gene_id) for protein_id, (hgnc_id, gene_id) in proteins.items()),
+        )
+        if standalone:
+            replacement.load(StringInteraction, ['protein1', 'protein2', 'combined_score'], [])
+            replacement.load(GeneInteraction, ['gene_a', 'gene_b', 'combined_score'], [])
+            replacement.commit()
     
     except Exception as e:
         raise CommandError(f'Failed to process STRING alias file: {e}')
+
+    if missing_hgnc_ids and stdout:
+        examples = ', '.join(
+            f'{hgnc_id} (protein {protein_id})'
+            for hgnc_id, protein_id in list(missing_hgnc_ids.items())[:MISSING_IDS_SHOWN]
+        )
+        more = len(missing_hgnc_ids) - MISSING_IDS_SHOWN
+        stdout.write(
+            f"Warning: {len(missing_hgnc_ids)} HGNC IDs have no HgncGene: {examples}"
+            + (f" and {more} more" if more > 0 else "")
+        )
     
     stdout.write(f"\nString alias import completed:")
     stdout.write(f"  Total lines processed: {processed_count}")
     stdout.write(f"  Records created: {created_count}")
-    stdout.write(f"  Errors: {error_count}")
+    stdout.write(f"  Errors: {len(missing_hgnc_ids)}")
     stdout.write("")
     
     return True
 
-def process_string_interactions(file_path, stdout=None):
+def process_string_interactions(file_path, stdout=None, min_score=0, top_k=None, replacement=None):
     """
     Process STRING interaction file and save to database, preventing duplicate pairs
     before they are sent to the database.
+
+    The file is streamed once, protein ids are mapped to StringProtein pks
+    with an in-memory dictionary, and each interaction is kept as a packed
+    64-bit key, so de-duplicating pairs takes about 8 bytes per interaction.
+    The unique interactions are loaded into replacement, a TableReplacement,
+    which uses COPY into an unindexed shadow table on PostgreSQL, along with
+    the StringProtein rows if it is replacing them too. Without one, the
+    interactions are swapped in straight away. GeneInteraction is replaced
+    with the interactions collapsed to their proteins' genes.
+
+    Interactions scoring below min_score are not stored. With top_k, an
+    interaction is only stored if it is among the top_k highest scoring
+    interactions of at least one of its proteins.
     """
     if not os.path.exists(file_path):
         raise CommandError(f'STRING interaction file not found at: {file_path}')
 
-    # Step 1: Pre-scan the file to find all unique protein IDs needed.
-    stdout.write("Step 1: Reading all protein IDs from the file...")
-    protein_ids_to_fetch = set()
-    with gzip.open(file_path, 'rt', encoding='utf-8') as file:
-        for line in file:
-            if line.startswith('protein1') or line.startswith('#') or not line.strip():
-                continue
-            parts = line.split()
-            if len(parts) >= 2:
-                # Strip the species ID (e.g., '9606.') from the protein identifier
-                protein1_id = parts[0].split('.', 1)[-1]
-                protein2_id = parts[1].split('.', 1)[-1]
-                protein_ids_to_fetch.add(protein1_id)
-                protein_ids_to_fetch.add(protein2_id)
-    
-    # Step 2: Fetch all required proteins from the DB in a single query.
-    stdout.write(f"Step 2: Fetching {len(protein_ids_to_fetch)} unique proteins from the database...")
-    protein_cache = {p.protein_id: p for p in StringProtein.objects.filter(protein_id__in=list(protein_ids_to_fetch))}
-    stdout.write(f"Found {len(protein_cache)} proteins in the database.")
+    standalone = replacement is None
+    if standalone:
+        replacement = TableReplacement()
+    proteins = replacement.values_list(StringProtein, ['protein_id', 'id', 'hgnc_gene'])
+    protein_pks = {protein_id: pk for protein_id, pk, gene_id in proteins}
+    # Indexed by StringProtein pk
+    protein_genes = np.zeros(max(protein_pks.values(), default=0) + 1, dtype=np.uint64)
+    for protein_id, pk, gene_id in proteins:
+        protein_genes[pk] = gene_id
+    del proteins
+    stdout.write(f"Loaded {len(protein_pks)} proteins from the database.")
 
-    # Step 3: Process interactions and perform batch inserts.
-    stdout.write("Step 3: Processing interactions and batch inserting...")
-    
-    batch_size = 5000
-    batch_data = []
-    created_count = 0
     processed_count = 0
     skipped_count = 0
+    below_min_score_count = 0
     missing_proteins = set()
-    
-    processed_pairs = set()
+    keys = array('Q')
 
-    StringInteraction.objects.all().delete()
-    
+    stdout.write("Reading interactions...")
     try:
-
         with gzip.open(file_path, 'rt', encoding='utf-8') as file:
             for line_num, line in enumerate(file, 1):
                 if line.startswith('protein1') or line.startswith('#') or not line.strip():
                     continue
-                
+
                 processed_count += 1
+                if processed_count % 1000000 == 0:
+                    stdout.write(f"Processed {processed_count} lines...")
                 parts = line.split()
 
                 try:
                     protein1_id = parts[0].split('.', 1)[-1]
                     protein2_id = parts[1].split('.', 1)[-1]
                     combined_score = int(parts[2])
+                    if not 0 <= combined_score <= MAX_SCORE:
+                        raise ValueError(f'combined_score must be between 0 and {MAX_SCORE}')
+                except (ValueError, IndexError) as e:
+                    stdout.write(f"Warning: Skipping malformed line {line_num}: {line.strip()} | Error: {e}")
+                    skipped_count += 1
+                    continue
 
-                    protein1 = protein_cache.get(protein1_id)
-                    protein2 = protein_cache.get(protein2_id)
-
-                    if not protein1 or not protein2:
-                        skipped_count += 1
-                        if not protein1 and protein1_id not in missing_proteins:
-                            stdout.write(f"Warning: Protein not found in cache for ID {protein1_id}")
-                            missing_proteins.add(protein1_id)
-                        if not protein2 and protein2_id not in missing_proteins:
-                            stdout.write(f"Warning: Protein not found in cache for ID {protein2_id}")
-                            missing_proteins.add(protein2_id)
-                        continue
+                if combined_score < min_score:
+                    below_min_score_count += 1
+                    continue
 
-                    p1, p2 = (protein1, protein2) if protein1.id <= protein2.id else (protein2, protein1)
-                    
-                    pair_key = (p1.id, p2.id)
+                protein1_pk = protein_pks.get(protein1_id)
+                protein2_pk = protein_pks.get(protein2_id)
 
-                    if pair_key in processed_pairs:
-                        skipped_count += 1
-                        continue
-                    
-                    processed_pairs.add(pair_key)
+                if protein1_pk is None or protein2_pk is None:
+                    skipped_count += 1
+                    for protein_id, pk in ((protein1_id, protein1_pk), (protein2_id, protein2_pk)):
+                        if pk is None and protein_id not in missing_proteins:
+                            stdout.write(f"Warning: Protein not found in cache for ID {protein_id}")
+                            missing_proteins.add(protein_id)
+                    continue
 
-                    batch_data.append(StringInteraction(
-                        protein1=p1,
-                        protein2=p2,
-                        combined_score=combined_score
-                    ))
+                keys.append(pack_interaction(protein1_pk, protein2_pk, combined_score))
 
-                    if len(batch_data) >= batch_size:
-                        StringInteraction.objects.bulk_create(batch_data, ignore_conflicts=True)
-                        created_count += len(batch_data)
-                        batch_data = []
-                        stdout.write(f"Processed {processed_count} lines, inserted {created_count} unique interactions...")
+        unique_keys = unique_interaction_keys(keys)
+        del keys
+        skipped_count += processed_count - below_min_score_count - skipped_count - len(unique_keys)
 
-                except (ValueError, IndexError) as e:
-                    stdout.write(f"Warning: Skipping malformed line {line_num}: {line.strip()} | Error: {e}")
-                    skipped_count += 1
-                    continue
+        pruned_count = 0
+        if top_k is not None:
+            pruned_keys = top_k_interaction_keys(unique_keys, top_k)
+            pruned_count = len(unique_keys) - len(pruned_keys)
+            unique_keys = pruned_keys
 
-            # Insert any remaining records in the final batch.
-            if batch_data:
-                StringInteraction.objects.bulk_create(batch_data, ignore_conflicts=True)
-                created_count += len(batch_data)
+        stdout.write("Loading interactions...")
+        created_count = replacement.load(
+            StringInteraction, ['protein1', 'protein2', 'combined_score'], iter_unpacked_interactions(unique_keys)
+        )
 
+        gene_keys = gene_interaction_keys(unique_keys, protein_genes)
+        gene_created_count = replacement.load(
+            GeneInteraction, ['gene_a', 'gene_b', 'combined_score'], iter_unpacked_interactions(gene_keys)
+        )
+        if standalone:
+            replacement.commit()
     except Exception as e:
         raise CommandError(f'Failed to process STRING interaction file: {e}')
 
@@ -205,19 +227,125 @@ def process_string_interactions(file_path, stdout=None):
     stdout.write(f"  - Total lines processed: {processed_count}")
     stdout.write(f"  - Unique interactions created: {created_count}")
     stdout.write(f"  - Skipped (duplicate, malformed, missing protein): {skipped_count}")
+    if min_score:
+        stdout.write(f"  - Below the minimum score of {min_score}: {below_min_score_count}")
+    if top_k is not None:
+        stdout.write(f"  - Pruned, not among the top {top_k} of either protein: {pruned_count}")
     stdout.write(f"  - Unique missing protein IDs encountered: {len(missing_proteins)}")
+    stdout.write(f"  - Gene interactions created: {gene_created_count}")
     stdout.write("")
 
     return True
 
+def pack_interaction(protein1_pk, protein2_pk, combined_score):
+    """
+    Packs an interaction into a 64-bit key of the smaller protein pk, the
+    larger protein pk and the score, so that sorting keys groups each pair
+    with its scores in ascending order.
+    """
+    if protein1_pk > protein2_pk:
+        protein1_pk, protein2_pk = protein2_pk, protein1_pk
+    if protein2_pk > MAX_PACKED_PK:
+        raise ValueError(f'StringProtein pk {protein2_pk} is too large to pack')
+    return (protein1_pk << (PK_BITS + SCORE_BITS)) | (protein2_pk << SCORE_BITS) | combined_score
+
+def unique_interaction_keys(keys):
+    """
+    Sorts packed interaction keys in place and returns one key per protein
+    pair, the one with the highest score.
+    """
+    keys = np.frombuffer(keys, dtype=np.uint64) if len(keys) else np.empty(0, dtype=np.uint64)
+    keys.sort()
+
+    # Each pair's last key has its highest score. Compared a chunk at a time
+    # so the comparison doesn't need temporary arrays the size of the input.
+    keep = np.ones(len(keys), dtype=bool)
+    for start in range(0, len(keys) - 1, UNPACK_CHUNK_SIZE):
+        stop = min(start + UNPACK_CHUNK_SIZE, len(keys) - 1)
+        keep[start:stop] = (keys[start:stop] >> SCORE_BITS) != (keys[start + 1:stop + 1] >> SCORE_BITS)
+    return keys[keep]
+
+def top_k_interaction_keys(keys, top_k):
+    """
+    Returns the packed interaction keys that are among the top_k highest
+    scoring interactions of either of their proteins. Ties are broken by
+    the other protein's pk.
+    """
+    if not len(keys):
+        return keys
+
+    # One sort key per interaction and protein: the protein's pk, then the
+    # inverted score, so each protein's interactions sort strongest first
+    inverted_scores = MAX_SCORE - (keys & MAX_SCORE)
+    endpoint_keys = np.concatenate([
+        ((keys >> (PK_BITS + SCORE_BITS)) << SCORE_BITS) | inverted_scores,
+        (((keys >> SCORE_BITS) & MAX_PACKED_PK) << SCORE_BITS) | inverted_scores,
+    ])
+    order = np.argsort(endpoint_keys, kind='stable')
+    sorted_proteins = endpoint_keys[order] >> SCORE_BITS
+    del endpoint_keys, inverted_scores
+
+    positions = np.arange(len(order))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = sorted_proteins[1:] != sorted_proteins[:-1]
+    ranks = positions - np.maximum.accumulate(np.where(is_first, positions, 0))
+
+    keep = np.zeros(len(keys), dtype=bool)
+    keep[order[ranks < top_k] % len(keys)] = True
+    return keys[keep]
+
+def gene_interaction_keys(keys, protein_genes):
+    """
+    Returns packed keys of the interactions between the genes of packed
+    protein interaction keys, one per gene pair with its highest score.
+    Interactions between proteins of the same gene are left out.
+    protein_genes holds each protein's HgncGene pk at its StringProtein pk.
+    """
+    if len(protein_genes) and protein_genes.max() > MAX_PACKED_PK:
+        raise ValueError('HgncGene pks are too large to pack')
+
+    # Packed a chunk at a time so the temporary arrays stay small
+    gene_keys = np.empty(len(keys), dtype=np.uint64)
+    count = 0
+    for start in range(0, len(keys), UNPACK_CHUNK_SIZE):
+        chunk = keys[start:start + UNPACK_CHUNK_SIZE]
+        genes1 = protein_genes[chunk >> (PK_BITS + SCORE_BITS)]
+        genes2 = protein_genes[(chunk >> SCORE_BITS) & MAX_PACKED_PK]
+        between_genes = genes1 != genes2
+        genes1, genes2 = genes1[between_genes], genes2[between_genes]
+        gene_keys[count:count + len(genes1)] = (
+            (np.minimum(genes1, genes2) << (PK_BITS + SCORE_BITS))
+            | (np.maximum(genes1, genes2) << SCORE_BITS)
+            | (chunk[between_genes] & MAX_SCORE)
+        )
+        count += len(genes1)
+    return unique_interaction_keys(gene_keys[:count])
+
+def iter_unpacked_interactions(keys):
+    """ Yields (protein1 pk, protein2 pk, combined_score) for each packed interaction key. """
+    for start in range(0, len(keys), UNPACK_CHUNK_SIZE):
+        chunk = keys[start:start + UNPACK_CHUNK_SIZE]
+        yield from zip(
+            (chunk >> (PK_BITS + SCORE_BITS)).tolist(),
+            ((chunk >> SCORE_BITS) & MAX_PACKED_PK).tolist(),
+            (chunk & MAX_SCORE).tolist(),
+        )
+
 @transaction.atomic
-def update_string_data(stdout, use_test_data):
+def update_string_data(stdout, use_test_data, min_score=0, top_k=None):
     """
     Updates StringProtein and StringInteraction records from STRING data files.
+
+    Both tables are loaded into shadow tables on PostgreSQL and swapped in
+    together at the end, so the graph keeps reading the old rows until then.
+    Once the import is committed, the gene network the graph reads is
+    rebuilt from the new interactions.
     
     Args:
         stdout: Output stream for progress messages
         use_test_data: If True, use sample data files; if False, use full data files
+        min_score: Interactions with a lower combined_score are not stored
+        top_k: If set, only store interactions among the top_k of either protein
     """
     results = {}
     
@@ -225,10 +353,31 @@ def update_string_data(stdout, use_test_data):
     alias_file_path = SAMPLE_STRING_ALIAS_PATH if use_test_data else STRING_ALIAS_PATH
     interaction_file_path = SAMPLE_STRING_INTERACTION_PATH if use_test_data else STRING_INTERACTION_PATH
     
+    replacement = TableReplacement()
+
     stdout.write("Starting STRING alias import...")
-    alias_results = process_string_aliases(alias_file_path, stdout)
+    alias_results = process_string_aliases(alias_file_path, stdout, replacement=replacement)
 
     stdout.write("Starting STRING interaction import...")
-    interaction_results = process_string_interactions(interaction_file_path, stdout)
+    interaction_results = process_string_interactions(
+        interaction_file_path, stdout, min_score=min_score, top_k=top_k, replacement=replacement
+    )
+
+    stdout.write("Swapping in the new STRING tables...")
+    replacement.commit()
+    DataVersion.bump()
+
+    if settings.GENE_NETWORK_DIR:
+        transaction.on_commit(lambda: write_gene_network(stdout))
     
-    return True
\ No newline at end of file
+    return True
+
+def write_gene_network(stdout):
+    """ Rebuilds the gene network from the imported interactions. """
+    stdout.write("Building the gene network...")
+    start_time = time.perf_counter()
+    network = build_gene_network()
+    stdout.write(
+        f"Gene network built in {time.perf_counter() - start_time:.2f}s: "
+        f"{len(network.genes)} genes, {network.interaction_count} gene interactions."
+    )
@@ -0,0 +1,398 @@
+import gzip
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import tracemalloc
+import zipfile
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from sickgenes.importers import update_hgnc_data, update_hmdb_data
+from sickgenes.importers import update_hgnc, update_hmdb
+from sickgenes.importers.update_string import process_string_interactions
+from sickgenes.importers.helper_functions import get_json_from_source
+from sickgenes.models import HgncGene, HmdbMetabolite, IdentifierLookup, StringProtein, StringInteraction
+
+SAMPLE_HGNC_PATH = os.path.join(settings.BASE_DIR, 'sample_data/sample_hgnc.json')
+SAMPLE_HMDB_PATH = os.path.join(settings.BASE_DIR, 'sample_data/sample_hmdb.zip')
+HMDB_XML_NAME = 'hmdb_metabolites.xml'
+# Proteins in the synthetic STRING links file, about as many as in the human alias file
+STRING_PROTEIN_COUNT = 19000
+
+# Tables each benchmark writes to, which must be empty to benchmark in place
+BENCHMARKED_MODELS = {
+    'hgnc': [HgncGene, IdentifierLookup],
+    'hmdb': [HmdbMetabolite, IdentifierLookup],
+    'string': [HgncGene, StringProtein, StringInteraction],
+}
+
+
+def legacy_update_hgnc_data(hgnc_data_paths):
+    """ The per-gene HGNC import the bulk importer replaced, kept as a reference. """
+    processed_count = 0
+    for hgnc_data_path in hgnc_data_paths:
+        for gene_data in get_json_from_source(hgnc_data_path)['response']['docs']:
+            hgnc_id = int(gene_data.get('hgnc_id').split(':')[1])
+            gene_obj, _ = HgncGene.objects.update_or_create(
+                hgnc_id=hgnc_id,
+                defaults={field: gene_data.get(field) for field in update_hgnc.MAIN_FIELDS},
+            )
+            for field_name, model_class in update_hgnc.RELATED_MODELS.items():
+                if field_name in gene_data:
+                    model_class.objects.filter(gene=gene_obj).delete()
+                    model_class.objects.bulk_create(
+                        [model_class(gene=gene_obj, value=item) for item in gene_data[field_name] if item is not None],
+                        ignore_conflicts=True,
+                    )
+            processed_count += 1
+
+    IdentifierLookup.objects.rebuild(HgncGene)
+    return processed_count
+
+
+def legacy_update_hmdb_data(hmdb_data_path, hmdb_xml_name):
+    """ The per-metabolite HMDB import the batched importer replaced, kept as a reference. """
+    processed_count = 0
+    namespace = {'hmdb': 'http://www.hmdb.ca'}
+    with zipfile.ZipFile(hmdb_data_path) as zip_file, zip_file.open(hmdb_xml_name) as xml_file:
+        for event, elem in ET.iterparse(xml_file, events=("end",)):
+            if elem.tag != '{http://www.hmdb.ca}metabolite':
+                continue
+            metabolite_data = legacy_parse_metabolite(elem, namespace)
+            elem.clear()
+            metabolite_obj, _ = HmdbMetabolite.objects.update_or_create(
+                accession=metabolite_data['accession'],
+                defaults=metabolite_data['fields'],
+            )
+            for parent_tag, values in metabolite_data['related'].items():
+                config = update_hmdb.RELATED_MODELS[parent_tag]
+                config['model'].objects.filter(metabolite=metabolite_obj).delete()
+                config['model'].objects.bulk_create(
+                    [config['model'](metabolite=metabolite_obj, value=value) for value in values],
+                    ignore_conflicts=True,
+                )
+            processed_count += 1
+
+    IdentifierLookup.objects.rebuild(HmdbMetabolite)
+    return processed_count
+
+
+def legacy_parse_metabolite(elem, namespace):
+    """ The find()-based metabolite parser the single-pass parser replaced, kept as a reference. """
+    primary_accession_element = elem.find('hmdb:accession', namespace)
+    if primary_accession_element is None or not primary_accession_element.text:
+        return None
+
+    metabolite_data = {
+        'accession': primary_accession_element.text,
+        'fields': {
+            field: update_hmdb._get_field_value(elem.find(f'hmdb:{field}', namespace), **options)
+            for field, options in update_hmdb.MAIN_FIELDS.items()
+        },
+        'related': {},
+    }
+    for parent_tag, config in update_hmdb.RELATED_MODELS.items():
+        parent_element = elem.find(f'hmdb:{parent_tag}', namespace)
+        if parent_element is None:
+            continue
+        values = []
+        for item in parent_element.findall(f"hmdb:{config['child_tag']}", namespace):
+            if item.text:
+                value = item.text.strip()
+                if config['max_length'] and len(value) > config['max_length']:
+                    continue
+                values.append(value)
+        metabolite_data['related'][parent_tag] = values
+    return metabolite_data
+
+
+def legacy_iter_parsed_metabolites(hmdb_data_path, hmdb_xml_name):
+    """ Parses metabolites the way the importer did before the single-pass parser. """
+    namespace = {'hmdb': 'http://www.hmdb.ca'}
+    with zipfile.ZipFile(hmdb_data_path) as zip_file, zip_file.open(hmdb_xml_name) as xml_file:
+        for event, elem in ET.iterparse(xml_file, events=("end",)):
+            if elem.tag == '{http://www.hmdb.ca}metabolite':
+                metabolite_data = legacy_parse_metabolite(elem, namespace)
+                elem.clear()
+                if metabolite_data is not None:
+                    yield metabolite_data
+
+
+def count_xml_elements(hmdb_data_path, hmdb_xml_name):
+    """ Number of elements in the zipped XML. """
+    with zipfile.ZipFile(hmdb_data_path) as zip_file, zip_file.open(hmdb_xml_name) as xml_file:
+        element_count = 0
+        for event, elem in ET.iterparse(xml_file, events=("end",)):
+            element_count += 1
+            if elem.tag == update_hmdb.METABOLITE_TAG:
+                elem.clear()
+        return element_count
+
+
+def legacy_process_string_interactions(file_path):
+    """ The two-pass, bulk_create STRING interaction import the COPY loader replaced, kept as a reference. """
+    protein_ids = set()
+    with gzip.open(file_path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            if line.startswith('protein1') or not line.strip():
+                continue
+            parts = line.split()
+            protein_ids.add(parts[0].split('.', 1)[-1])
+            protein_ids.add(parts[1].split('.', 1)[-1])
+    protein_cache = {p.protein_id: p for p in StringProtein.objects.filter(protein_id__in=list(protein_ids))}
+
+    StringInteraction.objects.all().delete()
+    batch_data = []
+    processed_pairs = set()
+    with gzip.open(file_path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            if line.startswith('protein1') or not line.strip():
+                continue
+            parts = line.split()
+            protein1 = protein_cache.get(parts[0].split('.', 1)[-1])
+            protein2 = protein_cache.get(parts[1].split('.', 1)[-1])
+            if not protein1 or not protein2:
+                continue
+            p1, p2 = (protein1, protein2) if protein1.id <= protein2.id else (protein2, protein1)
+            if (p1.id, p2.id) in processed_pairs:
+                continue
+            processed_pairs.add((p1.id, p2.id))
+            batch_data.append(StringInteraction(protein1=p1, protein2=p2, combined_score=int(parts[2])))
+            if len(batch_data) >= 5000:
+                StringInteraction.objects.bulk_create(batch_data, ignore_conflicts=True)
+                batch_data = []
+    if batch_data:
+        StringInteraction.objects.bulk_create(batch_data, ignore_conflicts=True)
+
+
+def create_synthetic_string_proteins(protein_count):
+    """ Creates genes and STRING proteins for a synthetic links file. Returns their protein ids. """
+    genes = HgncGene.objects.bulk_create([
+        HgncGene(hgnc_id=900000 + number, symbol=f'SYNTH{number}') for number in range(protein_count)
+    ])
+    proteins = StringProtein.objects.bulk_create([
+        StringProtein(protein_id=f'ENSPSYN{number:08d}', hgnc_id=gene.hgnc_id, hgnc_gene=gene)
+        for number, gene in enumerate(genes)
+    ])
+    return [protein.protein_id for protein in proteins]
+
+
+def write_synthetic_string_links(path, protein_ids, line_count, seed=0):
+    """
+    Writes a gzipped STRING links file of random protein pairs. Like the real
+    file, each pair is listed in both directions. Returns the line count.
+    """
+    rng = random.Random(seed)
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=1) as file:
+        file.write('protein1 protein2 combined_score\n')
+        for _ in range(line_count // 2):
+            protein1, protein2 = rng.sample(protein_ids, 2)
+            score = rng.randint(150, 999)
+            file.write(f'9606.{protein1} 9606.{protein2} {score}\n9606.{protein2} 9606.{protein1} {score}\n')
+    return line_count // 2 * 2
+
+
+def write_scaled_hgnc_data(path, scale):
+    """ Writes the sample HGNC data repeated `scale` times, with distinct HGNC ids and symbols. """
+    sample_docs = get_json_from_source(SAMPLE_HGNC_PATH)['response']['docs']
+    id_offset = max(int(doc['hgnc_id'].split(':')[1]) for doc in sample_docs) + 1
+
+    docs = []
+    for copy in range(scale):
+        for doc in sample_docs:
+            docs.append({
+                **doc,
+                'hgnc_id': f"HGNC:{int(doc['hgnc_id'].split(':')[1]) + copy * id_offset}",
+                'symbol': f"{doc['symbol']}-{copy}",
+            })
+
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'response': {'numFound': len(docs), 'docs': docs}}, file)
+    return len(docs)
+
+
+def write_scaled_hmdb_data(path, scale):
+    """ Writes a zip of the sample HMDB metabolites repeated `scale` times, with distinct accessions. """
+    with zipfile.ZipFile(SAMPLE_HMDB_PATH) as zip_file:
+        sample_xml = zip_file.read(HMDB_XML_NAME).decode('utf-8')
+
+    start = sample_xml.index('<ns0:metabolite>')
+    end = sample_xml.rindex('</ns0:metabolite>') + len('</ns0:metabolite>')
+    metabolites = re.findall(r'<ns0:metabolite>.*?</ns0:metabolite>', sample_xml[start:end], flags=re.DOTALL)
+
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        with zip_file.open(HMDB_XML_NAME, 'w') as xml_file:
+            xml_file.write(sample_xml[:start].encode('utf-8'))
+            for copy in range(scale):
+                for metabolite in metabolites:
+                    # The first <accession> is the primary one, e.g. HMDB0000001 -> HMDB0030000001
+                    xml_file.write(re.sub(
+                        r'<ns0:accession>HMDB(\d+)</ns0:accession>',
+                        lambda match: f'<ns0:accession>HMDB{copy:03d}{match.group(1)}</ns0:accession>',
+                        metabolite,
+                        count=1,
+                    ).encode('utf-8'))
+            xml_file.write(sample_xml[end:].encode('utf-8'))
+
+    return scale * len(metabolites)
+
+
+@contextmanager
+def throwaway_database(stdout):
+    """
+    Points the default connection at a new, migrated database for the
+    benchmarks, created and destroyed the way the test runner does, so they
+    never write to or lock the tables of the configured database.
+    """
+    old_name = connection.settings_dict['NAME']
+    old_test_settings = connection.settings_dict.get('TEST', {})
+    if connection.vendor != 'sqlite':
+        # SQLite's test databases are in memory, others are named after the configured one
+        connection.settings_dict['TEST'] = {**old_test_settings, 'NAME': f'benchmark_{old_name}'}
+    stdout.write('Creating a throwaway database for the benchmarks...')
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        connection.settings_dict['TEST'] = old_test_settings
+
+
+class Command(BaseCommand):
+    help = 'Times importers on scaled-up sample data, comparing them with the implementations they replaced'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'database',
+            type=str,
+            choices=['hgnc', 'hmdb', 'hmdb-parser', 'string'],
+            help="Which importer to benchmark, or 'hmdb-parser' to time only HMDB XML parsing"
+        )
+        parser.add_argument(
+            '--scale',
+            type=int,
+            default=1000,
+            help="How many times to repeat the sample data, or thousands of synthetic STRING links"
+        )
+        parser.add_argument(
+            '--in-place',
+            action='store_true',
+            help="Run in the configured database instead of a throwaway one. Only allowed while the benchmarked tables are empty."
+        )
+
+    def handle(self, *args, **kwargs):
+        database = kwargs['database']
+        scale = kwargs['scale']
+
+        if database == 'hmdb-parser':
+            database_context = nullcontext()
+        elif kwargs['in_place']:
+            database_context = nullcontext()
+            for model in BENCHMARKED_MODELS[database]:
+                if model.objects.exists():
+                    raise CommandError(
+                        f'{model._meta.db_table} is not empty. Benchmark in a throwaway database by leaving out --in-place.'
+                    )
+        else:
+            database_context = throwaway_database(self.stdout)
+
+        with tempfile.TemporaryDirectory() as temp_dir, database_context:
+            if database == 'hgnc':
+                data_path = os.path.join(temp_dir, 'hgnc.json')
+                record_count = write_scaled_hgnc_data(data_path, scale)
+                self.stdout.write(f'HGNC: {record_count} genes')
+
+                self.run_benchmark('legacy', HgncGene, record_count, lambda: legacy_update_hgnc_data([data_path]))
+                self.run_benchmark('bulk', HgncGene, record_count, lambda: update_hgnc_data([data_path]))
+
+            elif database == 'hmdb':
+                data_path = os.path.join(temp_dir, 'hmdb.zip')
+                record_count = write_scaled_hmdb_data(data_path, scale)
+                self.stdout.write(f'HMDB: {record_count} metabolites')
+
+                self.run_benchmark('legacy', HmdbMetabolite, record_count, lambda: legacy_update_hmdb_data(data_path, HMDB_XML_NAME))
+                self.run_benchmark('batched', HmdbMetabolite, record_count, lambda: update_hmdb_data(data_path, HMDB_XML_NAME))
+
+            elif database == 'hmdb-parser':
+                data_path = os.path.join(temp_dir, 'hmdb.zip')
+                record_count = write_scaled_hmdb_data(data_path, scale)
+                element_count = count_xml_elements(data_path, HMDB_XML_NAME)
+                self.stdout.write(f'HMDB XML: {record_count} metabolites, {element_count} elements')
+
+                self.run_parser_benchmark(
+                    'find()', element_count, lambda: legacy_iter_parsed_metabolites(data_path, HMDB_XML_NAME)
+                )
+                self.run_parser_benchmark(
+                    'single pass', element_count,
+                    lambda: update_hmdb.iter_parsed_metabolites(data_path, HMDB_XML_NAME),
+                )
+
+            elif database == 'string':
+                data_path = os.path.join(temp_dir, 'links.txt.gz')
+                protein_ids = [f'ENSPSYN{number:08d}' for number in range(STRING_PROTEIN_COUNT)]
+                record_count = write_synthetic_string_links(data_path, protein_ids, scale * 1000)
+                self.stdout.write(f'STRING: {record_count} links between {len(protein_ids)} proteins')
+
+                def setup():
+                    create_synthetic_string_proteins(STRING_PROTEIN_COUNT)
+
+                self.run_benchmark(
+                    'legacy', StringInteraction, record_count,
+                    lambda: legacy_process_string_interactions(data_path), setup,
+                )
+                self.run_benchmark(
+                    'copy', StringInteraction, record_count,
+                    lambda: process_string_interactions(data_path, io.StringIO()), setup,
+                )
+
+    def run_benchmark(self, label, model, record_count, run_import, setup=None):
+        """ Runs an import into an empty table, rolling back afterwards. """
+        with transaction.atomic():
+            if setup:
+                setup()
+
+            query_count = 0
+
+            def count_query(execute, sql, params, many, context):
+                nonlocal query_count
+                query_count += 1
+                return execute(sql, params, many, context)
+
+            with connection.execute_wrapper(count_query):
+                start_time = time.perf_counter()
+                run_import()
+                seconds = time.perf_counter() - start_time
+
+            self.stdout.write(
+                f'  {label}: {seconds:.2f}s, {record_count / seconds:.0f} records/s, {query_count} queries'
+            )
+            transaction.set_rollback(True)
+
+    def run_parser_benchmark(self, label, element_count, iter_metabolites):
+        """
+        Consumes a metabolite parser twice: once for its speed, and once with
+        tracemalloc, which slows it down, for its peak memory.
+        """
+        start_time = time.perf_counter()
+        for metabolite_data in iter_metabolites():
+            pass
+        seconds = time.perf_counter() - start_time
+
+        tracemalloc.start()
+        try:
+            for metabolite_data in iter_metabolites():
+                pass
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.stdout.write(
+            f'  {label}: {seconds:.2f}s, {element_count / seconds:.0f} elements/s, '
+            f'peak memory {peak_bytes / 1024 / 1024:.1f} MiB'
+        )
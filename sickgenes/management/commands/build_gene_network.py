@@ -0,0 +1,19 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from sickgenes.gene_network import build_gene_network
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the memory-mapped gene network the graph reads from the imported STRING interactions'
+
+    def handle(self, *args, **kwargs):
+        if not settings.GENE_NETWORK_DIR:
+            raise CommandError('GENE_NETWORK_DIR is not set.')
+
+        start_time = time.perf_counter()
+        network = build_gene_network()
+        self.stdout.write(
+            f'{len(network.genes)} genes, {network.interaction_count} gene interactions, '
+            f'built in {time.perf_counter() - start_time:.2f}s at {network.path}'
+        )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from sickgenes.identifier_index import IdentifierIndex
+from sickgenes.models import HgncGene, HmdbMetabolite, ImportRun
+
+
+class Command(BaseCommand):
+    help = 'Builds the in-process identifier indexes and reports their build time and memory size'
+
+    def handle(self, *args, **kwargs):
+        for model in [HgncGene, HmdbMetabolite]:
+            version = ImportRun.latest_id(model.objects.import_database)
+            index = IdentifierIndex(model, version).build()
+
+            self.stdout.write(
+                f'{model._meta.verbose_name}: '
+                f'{index.entry_count} values, '
+                f'built in {index.build_seconds:.2f}s, '
+                f'~{index.memory_bytes / 1024 / 1024:.1f} MB'
+            )
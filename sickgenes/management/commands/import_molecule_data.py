@@ -1,7 +1,14 @@
 import os
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from sickgenes.importers import update_hgnc_data, update_hmdb_data, update_string_data
+from sickgenes.importers import (
+    update_hgnc_data, update_hgnc_data_incremental, update_hmdb_data, update_hmdb_data_checkpointed,
+    update_string_data,
+)
+from sickgenes.importers.download_cache import DownloadCache
+from sickgenes.importers.update_hmdb import BATCH_SIZE as HMDB_BATCH_SIZE
+import requests
+from sickgenes.models import ImportRun
 
 BASE_DIR = settings.BASE_DIR
 
@@ -32,12 +39,72 @@ class Command(BaseCommand):
             help="Import data from small test files. Used for testing."
            )
 
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help="Only update records that changed since the last import, and remove records no longer in the source. HGNC only."
+        )
+
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=HMDB_BATCH_SIZE,
+            help="Number of records to write to the database together. HMDB only."
+        )
+
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help="Number of processes parsing the data source. HMDB only."
+        )
+
+        parser.add_argument(
+            '--checkpoint',
+            action='store_true',
+            help="Commit progress after each batch so a failed import can be resumed. HMDB only."
+        )
+
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help="Resume the last unfinished checkpointed import. HMDB only."
+        )
+
+        parser.add_argument(
+            '--min-score',
+            type=int,
+            default=0,
+            help="Don't store interactions with a lower combined score. STRING only."
+        )
+
+        parser.add_argument(
+            '--top-k',
+            type=int,
+            default=None,
+            help="Only store interactions among the K highest scoring ones of either protein. STRING only."
+        )
+
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help="Import downloaded HGNC files, or HMDB metabolites, even if they haven't changed since the last import."
+        )
+
     def handle(self, *args, **kwargs):
         database_type = kwargs['database']
         use_test_data = kwargs['test']
-        
+        incremental = kwargs['incremental']
+        force = kwargs['force']
+        batch_size = kwargs['batch_size']
+        workers = kwargs['workers']
+        checkpoint = kwargs['checkpoint']
+        resume = kwargs['resume']
+        min_score = kwargs['min_score']
+        top_k = kwargs['top_k']
 
         if database_type == 'hgnc':
+            source_checksums = {}
             if use_test_data:
                 data_path = os.path.join(
                     BASE_DIR,
@@ -47,15 +114,41 @@ class Command(BaseCommand):
                     raise CommandError(f"Test data file not found: {data_path}")
                 data_paths = [data_path]
             else:
-                data_paths = HGNC_DATA_PATHS
+                try:
+                    cache = DownloadCache(settings.IMPORT_CACHE_DIR)
+                    downloads = [cache.fetch(url) for url in HGNC_DATA_PATHS]
+                except (requests.RequestException, OSError) as e:
+                    raise CommandError(f'Failed to download HGNC data: {e}')
+
+                source_checksums = {download.url: download.sha256 for download in downloads}
+                latest_run = ImportRun.latest('hgnc')
+                if latest_run is not None and latest_run.source_checksums == source_checksums and not force:
+                    self.stdout.write(
+                        'HGNC data has not changed since the last import, skipping it. '
+                        'Use --force to import it anyway.'
+                    )
+                    return
+                data_paths = [download.path for download in downloads]
 
             try:
-                processed_count = update_hgnc_data(data_paths, self.stdout)
+                if incremental:
+                    counts = update_hgnc_data_incremental(data_paths, self.stdout)
+                    processed_count = counts['inserted'] + counts['updated'] + counts['unchanged']
+                    summary = (
+                        f"Inserted {counts['inserted']}, updated {counts['updated']}, "
+                        f"unchanged {counts['unchanged']}, removed {counts['removed']} records"
+                        f" ({counts['kept']} no longer in HGNC kept as findings use them)."
+                    )
+                else:
+                    processed_count = update_hgnc_data(data_paths, self.stdout)
+                    summary = f'Processed {processed_count} records.'
+                ImportRun.objects.create(
+                    database='hgnc', processed_count=processed_count, source_checksums=source_checksums,
+                )
 
                 self.stdout.write(
                     self.style.SUCCESS(
-                        f'HGNC data successfully imported. '
-                        f'Processed {processed_count} records.'
+                        f'HGNC data successfully imported. {summary}'
                     )
                 )
             except CommandError:
@@ -64,6 +157,10 @@ class Command(BaseCommand):
                 raise CommandError(f'Unexpected error during HGNC import: {e}')
             
         elif database_type == 'hmdb':
+            if batch_size < 1:
+                raise CommandError('--batch-size must be at least 1.')
+            if workers < 1:
+                raise CommandError('--workers must be at least 1.')
             if use_test_data:
                 data_path = os.path.join(
                     BASE_DIR,
@@ -75,12 +172,24 @@ class Command(BaseCommand):
                 data_path = HMDB_DATA_PATH
 
             try:
-                processed_count = update_hmdb_data(data_path, HMDB_XML_NAME, self.stdout)
+                if checkpoint or resume:
+                    counts = update_hmdb_data_checkpointed(
+                        data_path, HMDB_XML_NAME, self.stdout, batch_size=batch_size, workers=workers, resume=resume,
+                        skip_unchanged=not force,
+                    )
+                else:
+                    counts = update_hmdb_data(
+                        data_path, HMDB_XML_NAME, self.stdout, batch_size=batch_size, workers=workers,
+                        skip_unchanged=not force,
+                    )
+                    # Only imports that saved metabolites are recorded
+                    if counts['saved']:
+                        ImportRun.objects.create(database='hmdb', processed_count=counts['processed'])
 
                 self.stdout.write(
                     self.style.SUCCESS(
                         f'HMDB data successfully imported. '
-                        f'Processed {processed_count} records.'
+                        f"Processed {counts['processed']} records."
                     )
                 )
             except CommandError:
@@ -90,4 +199,7 @@ class Command(BaseCommand):
             
 
         elif database_type == 'string':
-            update_string_data(self.stdout, use_test_data)
+            if top_k is not None and top_k < 1:
+                raise CommandError('--top-k must be at least 1.')
+            update_string_data(self.stdout, use_test_data, min_score=min_score, top_k=top_k)
+            ImportRun.objects.create(database='string')
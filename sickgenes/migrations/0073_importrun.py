@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-18 01:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0072_study_newest_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('database', models.CharField(choices=[('hgnc', 'HGNC'), ('hmdb', 'HMDB'), ('string', 'STRING')], max_length=10)),
+                ('processed_count', models.IntegerField(default=None, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['database', '-id'], name='importrun_database_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-18 01:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0073_importrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdentifierLookup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('normalized_value', models.CharField(max_length=255)),
+                ('source_field', models.CharField(max_length=30)),
+                ('molecule_type', models.CharField(choices=[('gene', 'Gene'), ('metabolite', 'Metabolite')], max_length=10)),
+                ('molecule_id', models.BigIntegerField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['molecule_type', 'normalized_value', 'source_field', 'molecule_id'], name='identifierlookup_value_idx')],
+            },
+        ),
+    ]
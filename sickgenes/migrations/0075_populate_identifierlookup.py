@@ -0,0 +1,70 @@
+from django.db import migrations
+
+# Searchable fields as of this migration: {model: (fk name, molecule type, own fields, related models)}
+LOOKUP_SOURCES = {
+    'HgncGene': ('gene_id', 'gene', [
+        'hgnc_id', 'symbol', 'name', 'entrez_id', 'ensembl_gene_id', 'vega_id', 'ucsc_id',
+    ], {
+        'ena': 'Ena',
+        'uniprotid': 'UniprotId',
+        'aliassymbol': 'AliasSymbol',
+        'aliasname': 'AliasName',
+        'prevsymbol': 'PrevSymbol',
+        'prevname': 'PrevName',
+        'omimid': 'OmimId',
+    }),
+    'HmdbMetabolite': ('metabolite_id', 'metabolite', [
+        'accession', 'name', 'cas_registry_number', 'drugbank_id', 'foodb_id',
+        'knapsack_id', 'biocyc_id', 'wikipedia_id', 'iupac_name', 'traditional_iupac',
+        'bigg_id', 'pubchem_compound_id', 'chemspider_id', 'chebi_id',
+    ], {
+        'metabolitesynonym': 'MetaboliteSynonym',
+        'secondaryaccession': 'SecondaryAccession',
+    }),
+}
+
+def populate_identifier_lookup(apps, schema_editor):
+    IdentifierLookup = apps.get_model('sickgenes', 'IdentifierLookup')
+
+    for model_name, (fk_name, molecule_type, fields, related_models) in LOOKUP_SOURCES.items():
+        model = apps.get_model('sickgenes', model_name)
+
+        sources = []
+        for field in fields:
+            rows = model.objects.exclude(**{f'{field}__isnull': True}).values_list('pk', field)
+            sources.append((field, rows))
+        for source_field, related_model_name in related_models.items():
+            related_model = apps.get_model('sickgenes', related_model_name)
+            sources.append((source_field, related_model.objects.values_list(fk_name, 'value')))
+
+        batch = []
+        for source_field, rows in sources:
+            for molecule_id, value in rows.iterator(chunk_size=10000):
+                normalized_value = str(value).upper()
+                if not normalized_value or len(normalized_value) > 255:
+                    continue
+                batch.append(IdentifierLookup(
+                    normalized_value=normalized_value,
+                    source_field=source_field,
+                    molecule_type=molecule_type,
+                    molecule_id=molecule_id,
+                ))
+                if len(batch) >= 5000:
+                    IdentifierLookup.objects.bulk_create(batch)
+                    batch = []
+        if batch:
+            IdentifierLookup.objects.bulk_create(batch)
+
+def reverse_migration(apps, schema_editor):
+    IdentifierLookup = apps.get_model('sickgenes', 'IdentifierLookup')
+    IdentifierLookup.objects.all().delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0074_identifierlookup'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_identifier_lookup, reverse_migration),
+    ]
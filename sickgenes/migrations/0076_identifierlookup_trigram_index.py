@@ -0,0 +1,50 @@
+import logging
+from django.db import migrations, transaction, DatabaseError
+
+logger = logging.getLogger(__name__)
+
+# Source fields searched by find_similar_items
+FUZZY_SOURCE_FIELDS = [
+    'symbol', 'name', 'aliassymbol', 'aliasname', 'prevsymbol', 'prevname', 'metabolitesynonym',
+]
+
+def create_trigram_index(apps, schema_editor):
+    """
+    Adds a pg_trgm GIN index for similarity and prefix searches. If the
+    extension can't be installed, similarity searches fall back to an
+    in-process trigram index instead.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except DatabaseError as e:
+        logger.warning(
+            'pg_trgm extension not available, skipping the trigram index; similarity '
+            'searches will use the in-process trigram index instead: %s', e,
+        )
+        return
+
+    source_fields = ', '.join(f"'{source_field}'" for source_field in FUZZY_SOURCE_FIELDS)
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS identifierlookup_value_trgm_idx '
+        'ON sickgenes_identifierlookup USING gin (normalized_value gin_trgm_ops) '
+        f'WHERE source_field IN ({source_fields})'
+    )
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS identifierlookup_value_trgm_idx')
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0075_populate_identifierlookup'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
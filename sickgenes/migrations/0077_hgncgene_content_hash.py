@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 01:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0076_identifierlookup_trigram_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hgncgene',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-18 01:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0077_hgncgene_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importrun',
+            name='checkpoint',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='importrun',
+            name='status',
+            field=models.CharField(choices=[('in_progress', 'In progress'), ('complete', 'Complete')], default='complete', max_length=15),
+        ),
+        migrations.CreateModel(
+            name='StagedMetabolite',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('accession', models.CharField(max_length=15)),
+                ('data', models.JSONField()),
+                ('import_run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='staged_metabolites', to='sickgenes.importrun')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 02:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0078_checkpointed_imports'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hmdbmetabolite',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-18 03:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0079_hmdbmetabolite_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeneInteraction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('combined_score', models.SmallIntegerField()),
+                ('gene_a', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='gene_a_interactions', to='sickgenes.hgncgene')),
+                ('gene_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gene_b_interactions', to='sickgenes.hgncgene')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['gene_a', 'combined_score'], name='geneinteraction_gene_a_idx')],
+                'constraints': [models.UniqueConstraint(fields=('gene_a', 'gene_b'), name='unique_gene_interaction'), models.CheckConstraint(condition=models.Q(('gene_a__lt', models.F('gene_b'))), name='gene_interaction_gene_order')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-18 03:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0080_geneinteraction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeneDiseaseEvidence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('study_count', models.PositiveIntegerField()),
+                ('cohort_count', models.PositiveIntegerField()),
+                ('disease', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='gene_evidence', to='sickgenes.disease')),
+                ('gene', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='disease_evidence', to='sickgenes.hgncgene')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('disease__isnull', False)), fields=('gene', 'disease'), name='unique_gene_disease_evidence'), models.UniqueConstraint(condition=models.Q(('disease__isnull', True)), fields=('gene',), name='unique_gene_total_evidence')],
+            },
+        ),
+    ]
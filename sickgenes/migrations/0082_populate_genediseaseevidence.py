@@ -0,0 +1,54 @@
+from itertools import chain
+from django.db import migrations
+from django.db.models import Count, IntegerField, Value
+
+def populate_gene_disease_evidence(apps, schema_editor):
+    GeneFinding = apps.get_model('sickgenes', 'GeneFinding')
+    GeneDiseaseEvidence = apps.get_model('sickgenes', 'GeneDiseaseEvidence')
+
+    findings = GeneFinding.objects.filter(
+        hgnc_gene__isnull=False,
+        study_cohort__study__not_finished=False,
+        study_cohort__study__newest_version__isnull=True,
+    ).order_by()
+    counts = {
+        'study_count': Count('study_cohort__study', distinct=True),
+        'cohort_count': Count('study_cohort', distinct=True),
+    }
+    disease_rows = findings.filter(
+        study_cohort__disease_tags__isnull=False,
+    ).values('hgnc_gene_id', 'study_cohort__disease_tags').annotate(**counts).values_list(
+        'hgnc_gene_id', 'study_cohort__disease_tags', 'study_count', 'cohort_count',
+    )
+    # A row without a disease holds each gene's totals over all diseases
+    total_rows = findings.values('hgnc_gene_id').annotate(**counts).values_list(
+        'hgnc_gene_id', Value(None, output_field=IntegerField()), 'study_count', 'cohort_count',
+    )
+
+    batch = []
+    for gene_id, disease_id, study_count, cohort_count in chain(disease_rows, total_rows):
+        batch.append(GeneDiseaseEvidence(
+            gene_id=gene_id,
+            disease_id=disease_id,
+            study_count=study_count,
+            cohort_count=cohort_count,
+        ))
+        if len(batch) >= 5000:
+            GeneDiseaseEvidence.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        GeneDiseaseEvidence.objects.bulk_create(batch)
+
+def reverse_migration(apps, schema_editor):
+    GeneDiseaseEvidence = apps.get_model('sickgenes', 'GeneDiseaseEvidence')
+    GeneDiseaseEvidence.objects.all().delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0081_genediseaseevidence'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_gene_disease_evidence, reverse_migration),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.4 on 2026-10-18 04:11
+
+from collections import defaultdict
+from django.db import migrations, models
+
+def populate_study_ids(apps, schema_editor):
+    GeneFinding = apps.get_model('sickgenes', 'GeneFinding')
+    GeneDiseaseEvidence = apps.get_model('sickgenes', 'GeneDiseaseEvidence')
+
+    findings = GeneFinding.objects.filter(
+        hgnc_gene__isnull=False,
+        study_cohort__study__not_finished=False,
+        study_cohort__study__newest_version__isnull=True,
+    ).order_by()
+    # {(gene pk, disease pk or None for all diseases): study ids}
+    study_ids = defaultdict(set)
+    finding_rows = findings.values_list('hgnc_gene_id', 'study_cohort__disease_tags', 'study_cohort__study_id').distinct()
+    for gene_id, disease_id, study_id in finding_rows.iterator(chunk_size=20000):
+        study_ids[gene_id, disease_id].add(study_id)
+        study_ids[gene_id, None].add(study_id)
+
+    batch = []
+    for evidence in GeneDiseaseEvidence.objects.order_by('pk').iterator(chunk_size=5000):
+        evidence.study_ids = sorted(study_ids.get((evidence.gene_id, evidence.disease_id), ()))
+        batch.append(evidence)
+        if len(batch) >= 5000:
+            GeneDiseaseEvidence.objects.bulk_update(batch, ['study_ids'])
+            batch = []
+    if batch:
+        GeneDiseaseEvidence.objects.bulk_update(batch, ['study_ids'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0083_dataversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genediseaseevidence',
+            name='study_ids',
+            field=models.JSONField(default=list),
+        ),
+        migrations.RunPython(populate_study_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 04:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sickgenes', '0084_genediseaseevidence_study_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importrun',
+            name='source_checksums',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -1,3 +1,4 @@
 from .models import *
 from .molecule_models import *
-from .string_models import *
\ No newline at end of file
+from .string_models import *
+from .import_models import *
\ No newline at end of file
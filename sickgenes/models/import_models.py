@@ -0,0 +1,62 @@
+from django.db import models
+
+
+class ImportRun(models.Model):
+    """ A run of the import_molecule_data command. """
+    DATABASE_CHOICES = [
+        ('hgnc', 'HGNC'),
+        ('hmdb', 'HMDB'),
+        ('string', 'STRING'),
+    ]
+
+    IN_PROGRESS = 'in_progress'
+    COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (IN_PROGRESS, 'In progress'),
+        (COMPLETE, 'Complete'),
+    ]
+
+    database = models.CharField(max_length=10, choices=DATABASE_CHOICES)
+    processed_count = models.IntegerField(null=True, default=None)
+    # Checkpointed imports are in progress until their staged data is merged
+    status = models.CharField(max_length=15, choices=STATUS_CHOICES, default=COMPLETE)
+    # The last record a checkpointed import has staged
+    checkpoint = models.CharField(max_length=255, null=True, blank=True)
+    # SHA-256 checksums of the downloaded files imported, by URL
+    source_checksums = models.JSONField(default=dict, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+        indexes = [
+            models.Index(fields=['database', '-id'], name='importrun_database_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_database_display()} import {self.created_at:%Y-%m-%d %H:%M}'
+
+    @classmethod
+    def latest(cls, database):
+        """ Returns the most recent completed import run for a database, or None if there is none. """
+        return cls.objects.filter(database=database, status=cls.COMPLETE).order_by('-id').first()
+
+    @classmethod
+    def latest_id(cls, database):
+        """ Returns the id of the most recent completed import run for a database, or 0 if there is none. """
+        return cls.objects.filter(
+            database=database, status=cls.COMPLETE
+        ).order_by('-id').values_list('id', flat=True).first() or 0
+
+
+class StagedMetabolite(models.Model):
+    """ A parsed HMDB metabolite of a checkpointed import, kept until the import is merged. """
+    import_run = models.ForeignKey(ImportRun, on_delete=models.CASCADE, related_name='staged_metabolites')
+    accession = models.CharField(max_length=15)
+    # The metabolite as returned by update_hmdb.parse_metabolite
+    data = models.JSONField()
+
+    def __str__(self):
+        return self.accession
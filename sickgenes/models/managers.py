@@ -1,5 +1,71 @@
-from django.db import models
+import logging
+from collections import defaultdict
+from itertools import chain
+from django.db import models, connections, transaction
 from django.apps import apps
+from django.conf import settings
+from django.db.models.constants import OnConflict
+
+# Minimum pg_trgm style similarity for a value to be suggested as a close match
+SIMILARITY_THRESHOLD = 0.3
+# Shorter prefixes match too much to be useful suggestions
+MIN_PREFIX_LENGTH = 3
+
+_trigram_search_available = {}
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_identifier(value):
+    """ The form identifier values are stored and compared in: upper-cased text. """
+    return str(value).upper()
+
+
+def insert_rows(model, field_names, rows, batch_size=5000, ignore_conflicts=False, using='default'):
+    """
+    Inserts rows of values for the given fields of a model with multi-row
+    INSERT statements, without creating model instances. Returns the number
+    of rows given.
+    """
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    fields = [model._meta.get_field(field_name) for field_name in field_names]
+    on_conflict = OnConflict.IGNORE if ignore_conflicts else None
+
+    batch_size = max(connection.ops.bulk_batch_size(fields, range(batch_size)), 1)
+    statement = '%s %s (%s) ' % (
+        connection.ops.insert_statement(on_conflict=on_conflict),
+        quote_name(model._meta.db_table),
+        ', '.join(quote_name(field.column) for field in fields),
+    )
+    suffix = connection.ops.on_conflict_suffix_sql(fields, on_conflict, None, None)
+    row_placeholder = ['%s'] * len(fields)
+
+    row_count = 0
+    batch = []
+    with connection.cursor() as cursor:
+        def insert_batch():
+            sql = statement + connection.ops.bulk_insert_sql(fields, [row_placeholder] * len(batch))
+            params = [
+                field.get_db_prep_save(value, connection)
+                for row in batch
+                for field, value in zip(fields, row)
+            ]
+            cursor.execute(f'{sql} {suffix}', params)
+
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                insert_batch()
+                row_count += len(batch)
+                batch = []
+
+        if batch:
+            insert_batch()
+            row_count += len(batch)
+
+    return row_count
+
 
 class BaseMoleculeManager(models.Manager):
     """
@@ -10,10 +76,21 @@ class BaseMoleculeManager(models.Manager):
     int_fields = []
     related_models_to_search = {}
     related_fk_name = None
+    # The import_molecule_data database the items are loaded from
+    import_database = None
+    # Stored as IdentifierLookup.molecule_type
+    molecule_type = None
+    # Source fields that are names rather than accession numbers, searched by find_similar_items
+    fuzzy_fields = []
 
     def find_matching_items(self, search_strings):
         """
         Takes a list of strings and returns a dictionary with search results.
+
+        All search strings are resolved together, so the number of queries
+        does not grow with the number of search strings. Each result includes
+        'matched_fields', the source fields the search string matched on for
+        each matched item.
         """
         search_results = {
             'no_matches': [],
@@ -21,60 +98,203 @@ class BaseMoleculeManager(models.Manager):
             'multiple_matches': [],
         }
 
-        app_label = self.model._meta.app_label
+        search_strings = list(search_strings)
+        matching_ids = self.find_matching_ids(search_strings)
+
+        all_matching_ids = set()
+        for ids in matching_ids.values():
+            all_matching_ids.update(ids)
+
+        items = self.in_bulk(all_matching_ids) if all_matching_ids else {}
 
         for search_string in search_strings:
-            matching_ids = set()
+            ids = matching_ids[search_string]
+            # Ids of items deleted since the lookup rows were built are dropped
+            matched_items = [items[pk] for pk in sorted(ids) if pk in items]
+            matched_fields = {item.pk: sorted(ids[item.pk]) for item in matched_items}
 
-            for field in self.str_fields:
-                qs = self.filter(**{f"{field}__iexact": search_string}).values_list('pk', flat=True)
-                if qs.exists():
-                    matching_ids.update(qs)
+            if not matched_items:
+                search_results['no_matches'].append(search_string)
+            elif len(matched_items) == 1:
+                search_results['one_match'].append({
+                    'search_string': search_string,
+                    'item': matched_items[0],
+                    'matched_fields': matched_fields[matched_items[0].pk],
+                })
+            else:
+                search_results['multiple_matches'].append({
+                    'search_string': search_string,
+                    'items': matched_items,
+                    'matched_fields': matched_fields,
+                })
 
-            try:
-                search_int = int(search_string)
-                for field in self.int_fields:
-                    qs = self.filter(**{f"{field}": search_int}).values_list('pk', flat=True)
-                    if qs.exists():
-                        matching_ids.update(qs)
-            except ValueError:
-                pass
-            
-            # String searches on related models
-            for related_field, model_name in self.related_models_to_search.get('str_fields', {}).items():
+        return search_results
+
+    def find_matching_ids(self, search_strings):
+        """
+        Resolves search strings to primary keys with a single query against
+        IdentifierLookup (or the in-process identifier index, if enabled).
+
+        Returns a dictionary mapping each search string to a dictionary of
+        {pk: set of source fields the search string matched on}.
+        """
+        if settings.IDENTIFIER_INDEX_ENABLED:
+            from sickgenes.identifier_index import get_identifier_index
+            return get_identifier_index(self.model).find_matching_ids(search_strings)
+
+        search_keys = IdentifierSearchKeys(self, search_strings)
+        if search_keys.values:
+            IdentifierLookup = apps.get_model(self.model._meta.app_label, 'IdentifierLookup')
+            search_keys.add_rows(IdentifierLookup.objects.find(self.molecule_type, search_keys.values))
+
+        return search_keys.matching_ids
+
+    def find_similar_items(self, search_string, limit=10):
+        """
+        Returns up to `limit` (item, matched fields) pairs, best first, whose
+        names or aliases start with the search string or are similar to it.
+        """
+        return self.find_similar_items_many([search_string], limit)[search_string]
+
+    def find_similar_items_many(self, search_strings, limit=10):
+        """
+        Returns {search string: list of up to `limit` (item, matched fields)
+        pairs, best first} for each search string, like find_similar_items.
+
+        Uses one query against the pg_trgm index on IdentifierLookup when the
+        extension is installed, or an in-process trigram index otherwise, and
+        one query for the items of all search strings. While this process
+        builds its first trigram index, only prefix matches are found.
+        """
+        values = {}
+        for search_string in search_strings:
+            value = normalize_identifier(search_string.strip())
+            if value:
+                values[search_string] = value
+
+        IdentifierLookup = apps.get_model(self.model._meta.app_label, 'IdentifierLookup')
+        if not values:
+            rows_by_value = {}
+        elif IdentifierLookup.objects.trigram_search_available(self.db):
+            rows_by_value = IdentifierLookup.objects.find_similar(
+                self.molecule_type, self.fuzzy_fields, set(values.values()), limit,
+            )
+        else:
+            from sickgenes.identifier_index import get_trigram_index
+            trigram_index = get_trigram_index(self.model, wait=False)
+            if trigram_index is None:
+                rows_by_value = IdentifierLookup.objects.find_prefixed(
+                    self.molecule_type, self.fuzzy_fields, set(values.values()), limit,
+                )
+            else:
+                rows_by_value = {value: trigram_index.find_similar(value, limit) for value in set(values.values())}
+
+        ranked_ids_by_value = {}
+        matched_fields = defaultdict(lambda: defaultdict(list))
+        for value, rows in rows_by_value.items():
+            ranked_ids = ranked_ids_by_value[value] = []
+            for source_field, pk in rows:
+                if pk not in matched_fields[value] and len(ranked_ids) >= limit:
+                    continue
+                if pk not in matched_fields[value]:
+                    ranked_ids.append(pk)
+                if source_field not in matched_fields[value][pk]:
+                    matched_fields[value][pk].append(source_field)
+
+        items = self.in_bulk(set(chain.from_iterable(ranked_ids_by_value.values())))
+        similar_items = {}
+        for search_string in search_strings:
+            value = values.get(search_string)
+            similar_items[search_string] = [
+                (items[pk], matched_fields[value][pk])
+                for pk in ranked_ids_by_value.get(value, []) if pk in items
+            ]
+        return similar_items
+
+    def int_source_fields(self):
+        """ Source fields whose values are matched as integers rather than as text. """
+        return {
+            *self.int_fields,
+            *(related_field.split('__')[0] for related_field in self.related_models_to_search.get('int_fields', {})),
+        }
+
+    def source_field_label(self, source_field):
+        """ A readable name for a source field, e.g. 'ensembl gene id' or 'alias symbol'. """
+        for field_type, related_fields in self.related_models_to_search.items():
+            for related_field, model_name in related_fields.items():
+                if related_field.split('__')[0] == source_field:
+                    model = apps.get_model(self.model._meta.app_label, model_name)
+                    return str(model._meta.verbose_name)
+        return str(self.model._meta.get_field(source_field).verbose_name)
+
+    def identifier_rows(self, molecule_ids=None):
+        """
+        Yields (normalized value, source field, pk) for every searchable value
+        of the items, or only of the given item ids.
+        """
+        app_label = self.model._meta.app_label
+
+        queryset = self.order_by()
+        if molecule_ids is not None:
+            queryset = queryset.filter(pk__in=molecule_ids)
+
+        for field in self.str_fields + self.int_fields:
+            rows = queryset.exclude(**{f"{field}__isnull": True}).values_list('pk', field)
+            for pk, value in rows.iterator(chunk_size=10000):
+                if value != '':
+                    yield normalize_identifier(value), field, pk
+
+        for field_type, related_fields in self.related_models_to_search.items():
+            for related_field, model_name in related_fields.items():
                 # Resolve the model class at runtime instead of import time
                 model = apps.get_model(app_label=app_label, model_name=model_name)
-                related_ids = model.objects.filter(
-                    value__iexact=search_string
-                ).values_list(self.related_fk_name, flat=True)
-                matching_ids.update(related_ids)
+                related_queryset = model.objects.order_by()
+                if molecule_ids is not None:
+                    related_queryset = related_queryset.filter(**{f"{self.related_fk_name}__in": molecule_ids})
+
+                field_name = related_field.split('__')[0]
+                rows = related_queryset.values_list(self.related_fk_name, 'value')
+                for pk, value in rows.iterator(chunk_size=10000):
+                    if value != '':
+                        yield normalize_identifier(value), field_name, pk
+
+
+class IdentifierSearchKeys:
+    """
+    The lookup values for a set of search strings, and the collection of
+    matching (value, source field, pk) rows back into per-string results.
+
+    Text fields are matched case-insensitively, so a search string is looked
+    up by its upper-cased form. Integer fields are matched on the integer
+    value, so '0123' also looks up '123' (for integer source fields only).
+    """
+    def __init__(self, manager, search_strings):
+        self.int_source_fields = manager.int_source_fields()
+        self.matching_ids = {search_string: defaultdict(set) for search_string in search_strings}
+        self.strings_by_upper = defaultdict(list)
+        self.strings_by_int = defaultdict(list)
 
-            # Integer searches on related models
+        for search_string in self.matching_ids:
+            self.strings_by_upper[normalize_identifier(search_string)].append(search_string)
             try:
                 search_int = int(search_string)
-                for related_field, model_name in self.related_models_to_search.get('int_fields', {}).items():
-                    # Resolve the model class at runtime
-                    model = apps.get_model(app_label=app_label, model_name=model_name)
-                    related_ids = model.objects.filter(
-                        value=search_int
-                    ).values_list(self.related_fk_name, flat=True)
-                    matching_ids.update(related_ids)
             except ValueError:
-                pass
-
-            if not matching_ids:
-                search_results['no_matches'].append(search_string)
                 continue
-            
-            items = list(self.filter(pk__in=matching_ids))
-            count = len(items)
+            self.strings_by_int[normalize_identifier(search_int)].append(search_string)
+
+    @property
+    def values(self):
+        return list(self.strings_by_upper.keys() | self.strings_by_int.keys())
 
-            if count == 1:
-                search_results['one_match'].append({'search_string': search_string, 'item': items[0]})
+    def add_rows(self, rows):
+        for value, source_field, pk in rows:
+            if source_field in self.int_source_fields:
+                search_strings = self.strings_by_int.get(value, [])
             else:
-                search_results['multiple_matches'].append({'search_string': search_string, 'items': items})
+                search_strings = self.strings_by_upper.get(value, [])
 
-        return search_results
+            for search_string in search_strings:
+                self.matching_ids[search_string][pk].add(source_field)
 
 
 class HgncGeneManager(BaseMoleculeManager):
@@ -84,6 +304,9 @@ class HgncGeneManager(BaseMoleculeManager):
     ]
 
     related_fk_name = 'gene_id'
+    import_database = 'hgnc'
+    molecule_type = 'gene'
+    fuzzy_fields = ['symbol', 'name', 'aliassymbol', 'aliasname', 'prevsymbol', 'prevname']
 
     related_models_to_search = {
         'str_fields': {
@@ -111,10 +334,209 @@ class HmdbMetaboliteManager(BaseMoleculeManager):
     ]
 
     related_fk_name = 'metabolite_id'
+    import_database = 'hmdb'
+    molecule_type = 'metabolite'
+    fuzzy_fields = ['name', 'metabolitesynonym']
 
     related_models_to_search = {
         'str_fields': {
             'metabolitesynonym__value': 'MetaboliteSynonym',
             'secondaryaccession__value': 'SecondaryAccession',
         }
-    }
\ No newline at end of file
+    }
+
+
+class IdentifierLookupManager(models.Manager):
+    """ Manager for IdentifierLookup, keeps it in step with the molecule tables. """
+    batch_size = 5000
+
+    def find(self, molecule_type, values):
+        """ Returns (normalized value, source field, molecule id) rows for any of the values. """
+        return self.filter(
+            molecule_type=molecule_type,
+            normalized_value__in=values,
+        ).order_by().values_list('normalized_value', 'source_field', 'molecule_id')
+
+    def find_similar(self, molecule_type, source_fields, values, limit):
+        """
+        Returns {value: list of (source field, molecule id) rows} of the rows
+        whose value starts with or is trigram-similar to each of the values,
+        prefix matches first and then by similarity. All values are searched
+        in one query. Requires the pg_trgm extension.
+        """
+        values = list(values)
+        # LIKE patterns matching the values as prefixes, or none for short values
+        prefix_patterns = [
+            value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            if len(value) >= MIN_PREFIX_LENGTH else None
+            for value in values
+        ]
+        table = self.model._meta.db_table
+        connection = connections[self.db]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT terms.value, matches.source_field, matches.molecule_id
+                FROM unnest(%s::text[], %s::text[]) AS terms(value, prefix_pattern)
+                CROSS JOIN LATERAL (
+                    SELECT source_field, molecule_id
+                    FROM {connection.ops.quote_name(table)}
+                    WHERE molecule_type = %s
+                    AND source_field = ANY(%s)
+                    AND (normalized_value %% terms.value OR normalized_value LIKE terms.prefix_pattern)
+                    ORDER BY
+                        normalized_value LIKE terms.prefix_pattern IS TRUE DESC,
+                        similarity(normalized_value, terms.value) DESC,
+                        normalized_value
+                    LIMIT %s
+                ) matches
+                """,
+                [values, prefix_patterns, molecule_type, list(source_fields), limit * 5],
+            )
+            rows = cursor.fetchall()
+
+        rows_by_value = {value: [] for value in values}
+        for value, source_field, molecule_id in rows:
+            rows_by_value[value].append((source_field, molecule_id))
+        return rows_by_value
+
+    def find_prefixed(self, molecule_type, source_fields, values, limit):
+        """
+        Returns {value: list of (source field, molecule id) rows} of up to
+        `limit` rows whose value starts with each of the values, in one query.
+        Stands in for find_similar while no trigram search is available.
+        """
+        values = [value for value in values if len(value) >= MIN_PREFIX_LENGTH]
+        rows_by_value = {value: [] for value in values}
+        if not values:
+            return rows_by_value
+
+        prefix_filter = models.Q()
+        for value in values:
+            prefix_filter |= models.Q(normalized_value__startswith=value)
+        rows = self.filter(
+            prefix_filter, molecule_type=molecule_type, source_field__in=source_fields,
+        ).order_by('normalized_value').values_list('normalized_value', 'source_field', 'molecule_id')
+
+        for normalized_value, source_field, molecule_id in rows[:limit * len(values)]:
+            for value in values:
+                if normalized_value.startswith(value) and len(rows_by_value[value]) < limit:
+                    rows_by_value[value].append((source_field, molecule_id))
+        return rows_by_value
+
+    def trigram_search_available(self, using='default'):
+        """ Whether the pg_trgm extension is installed, checked once per process. """
+        if using not in _trigram_search_available:
+            connection = connections[using]
+            available = False
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+                    available = cursor.fetchone() is not None
+                if not available:
+                    logger.warning(
+                        'The pg_trgm extension is not installed in database %r; similarity searches '
+                        'use the slower in-process trigram index.', using,
+                    )
+            _trigram_search_available[using] = available
+        return _trigram_search_available[using]
+
+    def rebuild(self, model, molecule_ids=None):
+        """
+        Replaces the lookup rows of a molecule model, or only those of the
+        given molecule ids. Returns the number of rows created.
+        """
+        molecule_type = model.objects.molecule_type
+        max_length = self.model._meta.get_field('normalized_value').max_length
+
+        existing_rows = self.filter(molecule_type=molecule_type)
+        if molecule_ids is not None:
+            molecule_ids = list(molecule_ids)
+            existing_rows = existing_rows.filter(molecule_id__in=molecule_ids)
+        existing_rows.delete()
+
+        return insert_rows(
+            self.model,
+            ['normalized_value', 'source_field', 'molecule_type', 'molecule_id'],
+            (
+                (normalized_value, source_field, molecule_type, molecule_id)
+                for normalized_value, source_field, molecule_id in model.objects.identifier_rows(molecule_ids)
+                if len(normalized_value) <= max_length
+            ),
+            batch_size=self.batch_size,
+            using=self.db,
+        )
+
+
+class GeneDiseaseEvidenceManager(models.Manager):
+    """ Manager for GeneDiseaseEvidence, keeps it in step with the gene findings. """
+
+    def counted_findings(self):
+        """ The gene findings the evidence counts: those in finished, newest-version studies. """
+        GeneFinding = apps.get_model('sickgenes', 'GeneFinding')
+        return GeneFinding.objects.filter(
+            hgnc_gene__isnull=False,
+            study_cohort__study__not_finished=False,
+            study_cohort__study__newest_version__isnull=True,
+        ).order_by()
+
+    def study_counts(self, gene_ids, disease_ids):
+        """
+        Returns {gene pk: number of studies} of the given genes, counting each
+        study with a cohort tagged with any of the diseases once. Summing the
+        per-disease study counts would count a study tagged with several of
+        the diseases more than once, so the stored study ids are combined.
+        """
+        study_ids = defaultdict(set)
+        for gene_id, disease_study_ids in self.filter(
+            gene_id__in=gene_ids, disease_id__in=disease_ids,
+        ).values_list('gene_id', 'study_ids').iterator():
+            study_ids[gene_id].update(disease_study_ids)
+        return {gene_id: len(ids) for gene_id, ids in study_ids.items()}
+
+    def refresh(self, gene_ids=None):
+        """
+        Recounts the evidence of the given genes, or of all genes, from their
+        findings in finished, newest-version studies, and bumps the data
+        version. Returns the number of rows created.
+        """
+        findings = self.counted_findings()
+
+        existing_rows = self.all()
+        if gene_ids is not None:
+            gene_ids = {gene_id for gene_id in gene_ids if gene_id is not None}
+            if not gene_ids:
+                return 0
+            findings = findings.filter(hgnc_gene_id__in=gene_ids)
+            existing_rows = existing_rows.filter(gene_id__in=gene_ids)
+
+        # {(gene pk, disease pk or None for all diseases): (study ids, cohort ids)}
+        evidence = defaultdict(lambda: (set(), set()))
+        finding_rows = findings.values_list(
+            'hgnc_gene_id', 'study_cohort__disease_tags', 'study_cohort__study_id', 'study_cohort_id',
+        ).distinct()
+        for gene_id, disease_id, study_id, cohort_id in finding_rows.iterator(chunk_size=20000):
+            for key in {(gene_id, disease_id), (gene_id, None)}:
+                evidence[key][0].add(study_id)
+                evidence[key][1].add(cohort_id)
+
+        with transaction.atomic(using=self.db):
+            existing_rows.delete()
+            row_count = insert_rows(
+                self.model,
+                ['gene', 'disease', 'study_count', 'cohort_count', 'study_ids'],
+                (
+                    (gene_id, disease_id, len(study_ids), len(cohort_ids), sorted(study_ids))
+                    for (gene_id, disease_id), (study_ids, cohort_ids) in evidence.items()
+                ),
+                using=self.db,
+            )
+            apps.get_model('sickgenes', 'DataVersion').bump()
+        return row_count
+
+    def refresh_findings(self, **filters):
+        """ Recounts the evidence of the genes of the findings matching the filters. """
+        GeneFinding = apps.get_model('sickgenes', 'GeneFinding')
+        return self.refresh(
+            GeneFinding.objects.filter(**filters).values_list('hgnc_gene_id', flat=True).distinct()
+        )
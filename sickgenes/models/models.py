@@ -8,6 +8,7 @@ from datetime import date
 from solo.models import SingletonModel
 from django.utils.text import slugify
 from django.db import transaction
+from .managers import GeneDiseaseEvidenceManager
 import re
 
 class SiteConfiguration(SingletonModel):
@@ -21,6 +22,24 @@ class SiteConfiguration(SingletonModel):
     class Meta:
         verbose_name = "Site Configuration"
 
+class DataVersion(SingletonModel):
+    """
+    Counts changes to the data the gene graph shows: findings, studies and
+    cohorts, and imported genes and interactions. Cached graph responses
+    are keyed by it, so bumping it invalidates them.
+    """
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Data version {self.version}"
+
+    @classmethod
+    def bump(cls):
+        """ Increments the version, in the current transaction if there is one. """
+        updated = cls.objects.filter(pk=cls.singleton_instance_id).update(version=models.F('version') + 1)
+        if not updated:
+            cls.objects.create(pk=cls.singleton_instance_id, version=1)
+
 class Study(models.Model):
     title = models.CharField(max_length=500, verbose_name="Title")
     doi = models.CharField(max_length=255, verbose_name="DOI URL", unique=True, null=True, blank=True)
@@ -69,6 +88,7 @@ class Study(models.Model):
             self.newest_version = newest_study
             self.save(update_fields=["newest_version"])
             Study.objects.filter(newest_version=models.F('pk')).update(newest_version=None)
+            GeneDiseaseEvidence.objects.refresh_findings(study_cohort__study__in=[self, newest_study])
 
 
     @staticmethod
@@ -172,6 +192,34 @@ class GeneFinding(models.Model):
 
     def __str__(self):
         return f"[{self.study_cohort.study.title[:20]}]... - {self.hgnc_gene}"
+
+class GeneDiseaseEvidence(models.Model):
+    """
+    How many finished, newest-version studies and cohorts found a gene for
+    a disease, maintained from GeneFinding so views don't count findings per
+    request. The row without a disease counts across all of them.
+    """
+    gene = models.ForeignKey('HgncGene', on_delete=models.CASCADE, related_name='disease_evidence')
+    disease = models.ForeignKey(Disease, on_delete=models.CASCADE, null=True, related_name='gene_evidence')
+    study_count = models.PositiveIntegerField()
+    cohort_count = models.PositiveIntegerField()
+    # The counted studies, so a count over several diseases can count a study tagged with more than one once
+    study_ids = models.JSONField(default=list)
+
+    objects = GeneDiseaseEvidenceManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['gene', 'disease'], condition=models.Q(disease__isnull=False), name='unique_gene_disease_evidence',
+            ),
+            models.UniqueConstraint(
+                fields=['gene'], condition=models.Q(disease__isnull=True), name='unique_gene_total_evidence',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.gene} - {self.disease or 'all diseases'}: {self.study_count} studies"
     
 class MetaboliteFinding(models.Model):
     study_cohort = models.ForeignKey(StudyCohort, on_delete=models.CASCADE, related_name="metabolite_findings")
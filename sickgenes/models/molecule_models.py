@@ -1,5 +1,5 @@
 from django.db import models
-from .managers import HgncGeneManager, HmdbMetaboliteManager
+from .managers import HgncGeneManager, HmdbMetaboliteManager, IdentifierLookupManager
 from django.db.models.functions import Upper
 from django.urls import reverse
 
@@ -12,6 +12,8 @@ class HgncGene(models.Model):
     ensembl_gene_id = models.CharField(max_length=20, null=True)
     vega_id = models.CharField(max_length=25, null=True)
     ucsc_id = models.CharField(max_length=15, null=True)
+    # Hash of the imported record, to skip unchanged genes on incremental imports
+    content_hash = models.CharField(max_length=64, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True, null=True)
     updated_at = models.DateTimeField(auto_now=True, null=True)
 
@@ -87,6 +89,8 @@ class HmdbMetabolite(models.Model):
     pubchem_compound_id = models.IntegerField(default=None, null=True)
     chemspider_id = models.IntegerField(default=None, null=True)
     chebi_id = models.IntegerField(default=None, null=True)
+    # Hash of the imported record, to skip unchanged metabolites on re-imports
+    content_hash = models.CharField(max_length=64, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True, null=True)
     updated_at = models.DateTimeField(auto_now=True, null=True)
 
@@ -142,4 +146,34 @@ class SecondaryAccession(models.Model):
         ]
 
     def __str__(self):
-        return self.value
\ No newline at end of file
+        return self.value
+
+
+class IdentifierLookup(models.Model):
+    """
+    One searchable identifier value of a gene or metabolite, denormalized from
+    the molecule tables and their alias tables at import time so any
+    identifier resolves with a single index probe.
+    """
+    MOLECULE_TYPE_CHOICES = [
+        ('gene', 'Gene'),
+        ('metabolite', 'Metabolite'),
+    ]
+
+    normalized_value = models.CharField(max_length=255)
+    source_field = models.CharField(max_length=30)
+    molecule_type = models.CharField(max_length=10, choices=MOLECULE_TYPE_CHOICES)
+    molecule_id = models.BigIntegerField()
+
+    objects = IdentifierLookupManager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['molecule_type', 'normalized_value', 'source_field', 'molecule_id'],
+                name='identifierlookup_value_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.normalized_value} ({self.molecule_type} {self.molecule_id}: {self.source_field})'
\ No newline at end of file
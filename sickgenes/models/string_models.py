@@ -23,4 +23,25 @@ class StringInteraction(models.Model):
             models.Index(fields=['protein2'], name='stringinteraction_protein2_idx'),
         ]
 
-        unique_together = ['protein1', 'protein2']
\ No newline at end of file
+        unique_together = ['protein1', 'protein2']
+class GeneInteraction(models.Model):
+    """
+    A STRING interaction between two genes, with the highest combined score
+    of their proteins' interactions. Each pair is stored once, with the
+    smaller gene pk as gene_a.
+    """
+    gene_a = models.ForeignKey(HgncGene, on_delete=models.CASCADE, related_name='gene_a_interactions', db_index=False)
+    gene_b = models.ForeignKey(HgncGene, on_delete=models.CASCADE, related_name='gene_b_interactions')
+    combined_score = models.SmallIntegerField()
+
+    def __str__(self):
+        return f'{str(self.gene_a)} - {str(self.gene_b)}: {self.combined_score}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['gene_a', 'combined_score'], name='geneinteraction_gene_a_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['gene_a', 'gene_b'], name='unique_gene_interaction'),
+            models.CheckConstraint(condition=models.Q(gene_a__lt=models.F('gene_b')), name='gene_interaction_gene_order'),
+        ]
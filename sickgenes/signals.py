@@ -0,0 +1,113 @@
+"""
+Keeps GeneDiseaseEvidence in step with the findings, cohorts and studies it
+counts. Bulk writes that bypass these signals, such as bulk_create of
+findings or queryset updates of studies, refresh the evidence themselves.
+"""
+import threading
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from sickgenes.models import DataVersion, Disease, GeneDiseaseEvidence, GeneFinding, Study, StudyCohort
+
+# Genes whose evidence is refreshed when the current transaction commits
+_pending_genes = threading.local()
+
+
+def refresh_evidence_on_commit(gene_ids):
+    """
+    Refreshes the evidence of the genes once the transaction commits,
+    together with any others queued in it, so deleting a study or cohort
+    refreshes each of its genes once rather than once per finding.
+    """
+    pending = getattr(_pending_genes, 'gene_ids', None)
+    if pending is None:
+        pending = _pending_genes.gene_ids = set()
+    pending.update(gene_id for gene_id in gene_ids if gene_id is not None)
+    # Every call adds a callback, as the callbacks of a rolled back
+    # transaction are dropped; the first to run refreshes all pending genes
+    transaction.on_commit(_refresh_pending_evidence)
+
+
+def _refresh_pending_evidence():
+    gene_ids = getattr(_pending_genes, 'gene_ids', None)
+    if gene_ids:
+        _pending_genes.gene_ids = set()
+        GeneDiseaseEvidence.objects.refresh(gene_ids)
+
+
+@receiver(pre_save, sender=GeneFinding)
+def remember_finding_gene(sender, instance, raw=False, **kwargs):
+    """ Keeps the gene a changed finding had, whose evidence changes too. """
+    if instance.pk and not raw:
+        instance._previous_gene_id = (
+            GeneFinding.objects.filter(pk=instance.pk).values_list('hgnc_gene_id', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=GeneFinding)
+def refresh_saved_finding_evidence(sender, instance, raw=False, **kwargs):
+    if not raw:
+        GeneDiseaseEvidence.objects.refresh([instance.hgnc_gene_id, getattr(instance, '_previous_gene_id', None)])
+
+
+@receiver(post_delete, sender=GeneFinding)
+def refresh_deleted_finding_evidence(sender, instance, **kwargs):
+    refresh_evidence_on_commit([instance.hgnc_gene_id])
+
+
+@receiver(pre_delete, sender=Study)
+def refresh_older_version_evidence(sender, instance, **kwargs):
+    """ Deleting a study makes its older versions the newest again, without saving them. """
+    refresh_evidence_on_commit(
+        GeneFinding.objects.filter(study_cohort__study__newest_version=instance).values_list('hgnc_gene_id', flat=True)
+    )
+
+
+@receiver(pre_save, sender=Study)
+def remember_study_status(sender, instance, raw=False, **kwargs):
+    """ Keeps the fields that decide whether a changed study's findings count. """
+    if instance.pk and not raw:
+        instance._previous_status = (
+            Study.objects.filter(pk=instance.pk).values_list('not_finished', 'newest_version_id').first()
+        )
+
+
+@receiver(post_save, sender=Study)
+def refresh_study_evidence(sender, instance, created=False, raw=False, **kwargs):
+    """ A study's findings count only while it is finished and the newest version. """
+    if created or raw:
+        return
+    if getattr(instance, '_previous_status', None) != (instance.not_finished, instance.newest_version_id):
+        GeneDiseaseEvidence.objects.refresh_findings(study_cohort__study=instance)
+
+
+@receiver(m2m_changed, sender=StudyCohort.disease_tags.through)
+def refresh_disease_tag_evidence(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # The cohorts a disease is removed from are unknown after it is cleared
+        instance._cleared_gene_ids = list(
+            GeneFinding.objects.filter(study_cohort__disease_tags=instance).values_list('hgnc_gene_id', flat=True)
+        )
+    elif reverse and action == 'post_clear':
+        GeneDiseaseEvidence.objects.refresh(instance._cleared_gene_ids)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            GeneDiseaseEvidence.objects.refresh_findings(study_cohort__in=pk_set)
+        else:
+            GeneDiseaseEvidence.objects.refresh_findings(study_cohort=instance)
+
+
+@receiver(post_save, sender=StudyCohort)
+def refresh_cohort_evidence(sender, instance, created=False, raw=False, **kwargs):
+    """ A cohort moved to another study changes which study its findings count for. """
+    if not created and not raw:
+        GeneDiseaseEvidence.objects.refresh_findings(study_cohort=instance)
+
+
+@receiver(post_delete, sender=Disease)
+def bump_deleted_disease_version(sender, instance, **kwargs):
+    """
+    A deleted disease's evidence rows and cohort tags are deleted by cascade,
+    without signals, so cached graphs that included it are invalidated here.
+    """
+    DataVersion.bump()
@@ -1,6 +1,9 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.urls import reverse
-from sickgenes.models import Study, StudyCohort, Disease, GeneFinding, HgncGene
+from sickgenes.models import Study, StudyCohort, Disease, GeneFinding, HgncGene, AliasSymbol, IdentifierLookup
+from sickgenes.views.api import resolve
+from unittest.mock import patch
 import gzip
 import json
 
@@ -434,4 +437,113 @@ class DatabaseDumpJsonTestV2(TestCase):
         # 3. Assert
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(data["studies"]), 0)
-        self.assertEqual(len(data["genes"]), 0)
\ No newline at end of file
+        self.assertEqual(len(data["genes"]), 0)
+
+
+class ResolveIdentifiersTest(TestCase):
+    """
+    Tests for the resolve_identifiers view.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.gene1 = HgncGene.objects.create(hgnc_id=1, symbol="GENE1")
+        cls.gene2 = HgncGene.objects.create(hgnc_id=2, symbol="GENE2")
+        AliasSymbol.objects.create(gene=cls.gene1, value="SHARED")
+        AliasSymbol.objects.create(gene=cls.gene2, value="SHARED")
+        IdentifierLookup.objects.rebuild(HgncGene)
+        cls.url = reverse('sickgenes:resolve_identifiers', args=['gene'])
+
+    def setUp(self):
+        # Clears the clients' rate limit counts
+        cache.clear()
+
+    def _get_lines(self, response):
+        content = b''.join(response.streaming_content).decode('utf-8')
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_json_identifiers(self):
+        response = self.client.post(
+            self.url,
+            json.dumps({"identifiers": ["shared", "gene1", "MISSING"]}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        lines = self._get_lines(response)
+        self.assertEqual([line['identifier'] for line in lines], ["shared", "gene1", "MISSING"])
+
+        self.assertEqual(lines[0]['status'], 'multiple_matches')
+        self.assertEqual(lines[0]['candidates'], [
+            {'id': self.gene1.id, 'label': 'GENE1', 'matched_fields': ['aliassymbol']},
+            {'id': self.gene2.id, 'label': 'GENE2', 'matched_fields': ['aliassymbol']},
+        ])
+        self.assertEqual(lines[1]['status'], 'one_match')
+        self.assertEqual(lines[1]['candidates'], [
+            {'id': self.gene1.id, 'label': 'GENE1', 'matched_fields': ['symbol']},
+        ])
+        self.assertEqual(lines[2], {'identifier': 'MISSING', 'status': 'no_match', 'candidates': []})
+
+    def test_newline_delimited_identifiers(self):
+        response = self.client.post(self.url, "gene2\n\n  gene2 \nGENE1\n", content_type='text/plain')
+        lines = self._get_lines(response)
+        self.assertEqual([line['identifier'] for line in lines], ["gene2", "GENE1"])
+        self.assertEqual(lines[0]['candidates'][0]['id'], self.gene2.id)
+
+    def test_resolved_in_one_batch(self):
+        identifiers = [f"ID{i}" for i in range(499)] + ["GENE1"]
+        # One lookup query and one query for the matched genes
+        with self.assertNumQueries(2):
+            response = self.client.post(self.url, json.dumps(identifiers), content_type='application/json')
+            lines = self._get_lines(response)
+        self.assertEqual(len(lines), 500)
+
+    def test_batches_are_streamed_as_they_are_resolved(self):
+        with patch.object(resolve, 'RESOLVE_BATCH_SIZE', 2):
+            response = self.client.post(self.url, "gene1\nMISSING\nshared", content_type='text/plain')
+            with patch.object(HgncGene.objects, 'find_matching_items', wraps=HgncGene.objects.find_matching_items) as find:
+                content = iter(response.streaming_content)
+                first_lines = [json.loads(next(content)) for _ in range(2)]
+                # The second batch isn't looked up until its lines are read
+                find.assert_called_once_with(['gene1', 'MISSING'])
+                last_line = json.loads(next(content))
+
+        self.assertEqual([line['identifier'] for line in first_lines], ['gene1', 'MISSING'])
+        self.assertEqual(last_line['status'], 'multiple_matches')
+
+    @override_settings(RESOLVE_RATE_LIMIT=3)
+    def test_rate_limited_per_client(self):
+        self.assertEqual(self.client.post(self.url, "A\nB", content_type='text/plain').status_code, 200)
+
+        response = self.client.post(self.url, "C\nD", content_type='text/plain')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], str(resolve.RESOLVE_RATE_WINDOW))
+
+        other_client = self.client.post(self.url, "C\nD", content_type='text/plain', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(other_client.status_code, 200)
+
+    @override_settings(RESOLVE_RATE_LIMIT=3, USE_X_FORWARDED_FOR=True)
+    def test_rate_limited_per_forwarded_client(self):
+        forwarded_for = {'HTTP_X_FORWARDED_FOR': '203.0.113.1, 10.0.0.1'}
+        self.client.post(self.url, "A\nB", content_type='text/plain', **forwarded_for)
+        self.assertEqual(self.client.post(self.url, "C\nD", content_type='text/plain', **forwarded_for).status_code, 429)
+        self.assertEqual(self.client.post(self.url, "C\nD", content_type='text/plain', HTTP_X_FORWARDED_FOR='10.0.0.2').status_code, 200)
+
+    def test_invalid_json(self):
+        response = self.client.post(self.url, '{"identifiers": ', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(self.url, json.dumps({"identifiers": [["GENE1"]]}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_too_many_identifiers(self):
+        with patch.object(resolve, 'MAX_RESOLVE_IDENTIFIERS', 2):
+            response = self.client.post(self.url, "A\nB\nC", content_type='text/plain')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_not_allowed(self):
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+
+    def test_unknown_model_type(self):
+        url = reverse('sickgenes:resolve_identifiers', args=['protein'])
+        self.assertEqual(self.client.post(url, "GENE1", content_type='text/plain').status_code, 404)
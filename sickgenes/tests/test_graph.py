@@ -1,13 +1,24 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from sickgenes.gene_network import build_gene_network, get_gene_network, clear_gene_network
+from sickgenes.graph_layout import exact_repulsion, force_layout, mesh_repulsion
 
 from sickgenes.models import (
     Study, Disease, StudyCohort, GeneFinding, HgncGene, 
-    StringProtein, StringInteraction
+    StringProtein, StringInteraction, GeneInteraction, DataVersion
 )
 
 
+@override_settings(GENE_NETWORK_DIR=None)
 class GeneGraphAPITestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -58,10 +69,15 @@ class GeneGraphAPITestCase(TestCase):
         
         # Interaction between TP53 and BRCA1
         cls.interaction = StringInteraction.objects.create(protein1=protein1, protein2=protein2, combined_score=999)
+        gene_a, gene_b = sorted([cls.gene1, cls.gene2], key=lambda gene: gene.pk)
+        GeneInteraction.objects.create(gene_a=gene_a, gene_b=gene_b, combined_score=999)
 
         # The URL for the view
         cls.url = reverse('sickgenes:gene_network_data')
 
+    def setUp(self):
+        cache.clear()
+
     def test_successful_request_with_common_genes_and_interaction(self):
         """
         Test with two diseases where TP53 and BRCA1 are common, and an interaction exists.
@@ -87,10 +103,29 @@ class GeneGraphAPITestCase(TestCase):
 
         # Check edges
         edge = data['edges'][0]
-        self.assertEqual(edge['key'], f'e{self.interaction.id}')
+        self.assertEqual(edge['key'], f'e{min(self.gene1.pk, self.gene2.pk)}-{max(self.gene1.pk, self.gene2.pk)}')
         self.assertIn(edge['source'], {'TP53', 'BRCA1'})
         self.assertIn(edge['target'], {'TP53', 'BRCA1'})
 
+    def test_study_tagged_with_both_diseases_counts_once(self):
+        study = Study.objects.create(title='Study E on EGFR in Cancer and Neuro')
+        cohort = StudyCohort.objects.create(study=study)
+        cohort.disease_tags.add(self.disease1, self.disease2)
+        GeneFinding.objects.create(study_cohort=cohort, hgnc_gene=self.gene3)
+
+        response = self.client.get(self.url, {'disease_ids': [self.disease1.id, self.disease2.id]})
+
+        sizes = {node['key']: node['size'] for node in json.loads(response.content)['nodes']}
+        # EGFR is in Study 3 (Cancer) and Study E (Cancer and Neuro)
+        self.assertEqual(sizes['EGFR'], 2)
+        self.assertEqual(sizes['TP53'], 2)
+
+    def test_multiple_diseases_read_only_precomputed_evidence(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'disease_ids': [self.disease1.id, self.disease2.id]})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries.captured_queries if 'sickgenes_genefinding' in query['sql']])
+
     def test_request_with_no_common_genes(self):
         """
         Test with diseases that have no genes in common.
@@ -120,6 +155,76 @@ class GeneGraphAPITestCase(TestCase):
         data = json.loads(response.content)
         self.assertEqual(len(data['nodes']), 3)
 
+    def test_response_is_cached_until_findings_change(self):
+        """
+        Test that a repeated request is answered from the cache, and that a new finding invalidates it.
+        """
+        params = {'disease_ids': [self.disease1.id, self.disease2.id]}
+        response = self.client.get(self.url, params)
+        self.assertEqual(len(json.loads(response.content)['nodes']), 2)
+
+        # Duplicated and reordered disease ids get the same cached response
+        with self.assertNumQueries(1):
+            cached_response = self.client.get(
+                self.url, {'disease_ids': [self.disease2.id, self.disease1.id, self.disease2.id]}
+            )
+        self.assertEqual(cached_response.content, response.content)
+
+        new_gene = HgncGene.objects.create(symbol='NEWGENE', hgnc_id=12345)
+        GeneFinding.objects.create(study_cohort=StudyCohort.objects.get(study=self.study1), hgnc_gene=new_gene)
+        GeneFinding.objects.create(study_cohort=StudyCohort.objects.get(study=self.study2), hgnc_gene=new_gene)
+
+        response = self.client.get(self.url, params)
+        self.assertEqual(len(json.loads(response.content)['nodes']), 3)
+
+    def test_response_is_cached_until_data_version_changes(self):
+        params = {'disease_ids': [self.disease1.id, self.disease2.id]}
+        self.client.get(self.url, params)
+        GeneInteraction.objects.all().delete()
+        self.assertEqual(len(json.loads(self.client.get(self.url, params).content)['edges']), 1)
+
+        DataVersion.bump()
+        self.assertEqual(len(json.loads(self.client.get(self.url, params).content)['edges']), 0)
+
+    def test_unchanged_graph_is_not_modified(self):
+        """
+        Test that revalidating with the response's ETag gets a 304 until the data changes.
+        """
+        params = {'disease_ids': [self.disease1.id, self.disease2.id]}
+        response = self.client.get(self.url, params)
+        etag = response['ETag']
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        response = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # Another confidence threshold is another graph
+        response = self.client.get(self.url, {**params, 'confidence_threshold': 400}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        DataVersion.bump()
+        response = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_deleting_a_disease_changes_the_etag(self):
+        params = {'disease_ids': [self.disease1.id, self.disease3.id]}
+        etag = self.client.get(self.url, params)['ETag']
+
+        self.disease3.delete()
+        response = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_nodes_are_laid_out_the_same_way_every_time(self):
+        params = {'disease_ids': [self.disease1.id]}
+        nodes = json.loads(self.client.get(self.url, params).content)['nodes']
+        cache.clear()
+        self.assertEqual(json.loads(self.client.get(self.url, params).content)['nodes'], nodes)
+        for node in nodes:
+            self.assertTrue(0 <= node['x'] <= 1 and 0 <= node['y'] <= 1)
+
     def test_request_with_no_disease_ids(self):
         """
         Test that sending no IDs returns a 400 Bad Request error.
@@ -138,4 +243,149 @@ class GeneGraphAPITestCase(TestCase):
         self.assertEqual(response.status_code, 400)
         data = json.loads(response.content)
         self.assertIn('error', data)
-        self.assertEqual(data['error'], 'Invalid disease ID provided.')
\ No newline at end of file
+        self.assertEqual(data['error'], 'Invalid disease ID provided.')
+
+    def test_request_with_invalid_confidence_threshold(self):
+        """
+        Test that a non-integer confidence threshold returns a 400 Bad Request error.
+        """
+        response = self.client.get(self.url, {'disease_ids': [self.disease1.id], 'confidence_threshold': 'high'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['error'], 'Invalid confidence threshold provided.')
+
+
+class GraphLayoutTestCase(TestCase):
+    def setUp(self):
+        # Two groups of five genes, linked within each group and once between them
+        self.sources = [0, 0, 1, 2, 3, 5, 5, 6, 7, 8, 4]
+        self.targets = [1, 2, 3, 4, 4, 6, 7, 8, 9, 9, 5]
+
+    def test_layout_is_deterministic_and_scaled(self):
+        positions = force_layout(10, self.sources, self.targets)
+        np.testing.assert_array_equal(force_layout(10, self.sources, self.targets), positions)
+        self.assertEqual(positions.shape, (10, 2))
+        self.assertEqual(positions.min(), 0)
+        self.assertEqual(positions.max(), 1)
+
+    def test_groups_are_laid_out_apart(self):
+        positions = force_layout(10, self.sources, self.targets)
+        groups = [positions[:5].mean(axis=0), positions[5:].mean(axis=0)]
+        for node, position in enumerate(positions):
+            own_group, other_group = groups[node // 5], groups[1 - node // 5]
+            self.assertLess(np.linalg.norm(position - own_group), np.linalg.norm(position - other_group))
+
+    def test_warm_start_places_missing_nodes(self):
+        initial = np.full((10, 2), np.nan)
+        initial[:9] = force_layout(10, self.sources, self.targets)[:9]
+        positions = force_layout(10, self.sources, self.targets, initial=initial)
+        self.assertFalse(np.isnan(positions).any())
+        self.assertLess(np.linalg.norm(positions[9] - positions[8]), np.linalg.norm(positions[9] - positions[0]))
+
+    def test_mesh_repulsion_approximates_exact_repulsion(self):
+        positions = np.random.default_rng(0).random((1000, 2))
+        exact = exact_repulsion(positions, 0.03)
+        errors = np.linalg.norm(mesh_repulsion(positions, 0.03) - exact, axis=1) / np.linalg.norm(exact, axis=1)
+        self.assertLess(np.median(errors), 0.05)
+
+
+class GeneNetworkTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.genes = [HgncGene.objects.create(symbol=f'G{number}', hgnc_id=number) for number in range(4)]
+        g0, g1, g2, g3 = cls.genes
+        GeneInteraction.objects.create(gene_a=g0, gene_b=g1, combined_score=800)
+        GeneInteraction.objects.create(gene_a=g0, gene_b=g2, combined_score=700)
+        GeneInteraction.objects.create(gene_a=g2, gene_b=g3, combined_score=900)
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        settings_override = override_settings(GENE_NETWORK_DIR=temp_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        clear_gene_network()
+        self.addCleanup(clear_gene_network)
+        cache.clear()
+
+    def test_interactions_between_genes(self):
+        g0, g1, g2, g3 = (gene.pk for gene in self.genes)
+        network = build_gene_network()
+
+        self.assertEqual(network.interaction_count, 3)
+        self.assertCountEqual(
+            network.interactions([g0, g1, g2, g3]),
+            [(g0, g1, 800), (g0, g2, 700), (g2, g3, 900)],
+        )
+        self.assertCountEqual(network.interactions([g0, g1, g2], min_score=750), [(g0, g1, 800)])
+        self.assertEqual(network.interactions([g1, g3, 123456]), [])
+
+    def test_neighbors_are_strongest_first(self):
+        network = build_gene_network()
+        position = list(network.genes).index(self.genes[0].pk)
+        scores = network.scores[network.offsets[position]:network.offsets[position + 1]]
+        self.assertEqual(scores.tolist(), [800, 700])
+
+    def test_loads_newer_build(self):
+        self.assertIsNone(get_gene_network())
+        build_gene_network()
+        network = get_gene_network()
+        self.assertIs(get_gene_network(), network)
+
+        GeneInteraction.objects.filter(combined_score=900).delete()
+        build_gene_network()
+
+        self.assertIsNot(get_gene_network(), network)
+        self.assertEqual(get_gene_network().interaction_count, 2)
+
+    def test_keeps_previous_build(self):
+        first = build_gene_network()
+        second = build_gene_network()
+        self.assertTrue(os.path.exists(first.path))
+
+        third = build_gene_network()
+        self.assertFalse(os.path.exists(first.path))
+        self.assertTrue(os.path.exists(second.path))
+        self.assertTrue(os.path.exists(third.path))
+
+    def test_missing_build_falls_back_to_database(self):
+        network = build_gene_network()
+        shutil.rmtree(network.path)
+        with self.assertLogs('sickgenes.gene_network', 'WARNING'):
+            self.assertIsNone(get_gene_network())
+
+        disease = Disease.objects.create(name='Cancer')
+        cohort = StudyCohort.objects.create(study=Study.objects.create(title='Study'))
+        cohort.disease_tags.add(disease)
+        for gene in self.genes[:2]:
+            GeneFinding.objects.create(study_cohort=cohort, hgnc_gene=gene)
+        with self.assertLogs('sickgenes.gene_network', 'WARNING'):
+            response = self.client.get(reverse('sickgenes:gene_network_data'), {'disease_ids': [disease.id]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['edges']), 1)
+
+    def test_layout_positions(self):
+        network = build_gene_network()
+        gene_pks = [gene.pk for gene in self.genes] + [123456]
+        positions = network.layout_positions(gene_pks)
+
+        self.assertFalse(np.isnan(positions[:4]).any())
+        self.assertTrue(np.isnan(positions[4]).all())
+        # G0 is linked to G1 and G2, but not G3
+        self.assertLess(np.linalg.norm(positions[0] - positions[1]), np.linalg.norm(positions[0] - positions[3]))
+
+    def test_graph_reads_gene_network(self):
+        disease = Disease.objects.create(name='Cancer')
+        cohort = StudyCohort.objects.create(study=Study.objects.create(title='Study'))
+        cohort.disease_tags.add(disease)
+        for gene in self.genes[:3]:
+            GeneFinding.objects.create(study_cohort=cohort, hgnc_gene=gene)
+        build_gene_network()
+
+        response = self.client.get(
+            reverse('sickgenes:gene_network_data'), {'disease_ids': [disease.id], 'confidence_threshold': 750}
+        )
+
+        edges = json.loads(response.content)['edges']
+        self.assertEqual(len(edges), 1)
+        self.assertEqual(edges[0]['key'], f'e{self.genes[0].pk}-{self.genes[1].pk}')
+        self.assertEqual((edges[0]['source'], edges[0]['target'], edges[0]['size']), ('G0', 'G1', 800))
@@ -0,0 +1,150 @@
+import threading
+from unittest import mock
+from django.test import TestCase, override_settings
+from sickgenes.identifier_index import (
+    TrigramIndex, get_identifier_index, get_trigram_index, clear_identifier_indexes, warm_identifier_indexes,
+)
+from sickgenes.models import (
+    HgncGene, AliasSymbol, OmimId, HmdbMetabolite, MetaboliteSynonym, ImportRun, IdentifierLookup
+)
+
+
+@override_settings(IDENTIFIER_INDEX_ENABLED=True)
+class IdentifierIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.gene1 = HgncGene.objects.create(hgnc_id=1, symbol="G1", name="gene one", entrez_id=101)
+        AliasSymbol.objects.create(gene=cls.gene1, value="G1-ALIAS")
+        OmimId.objects.create(gene=cls.gene1, value=123)
+
+        cls.gene2 = HgncGene.objects.create(hgnc_id=2, symbol="G2", name="gene two", entrez_id=102)
+        OmimId.objects.create(gene=cls.gene2, value=123)
+
+        cls.metabolite = HmdbMetabolite.objects.create(accession="HMDB0000001", name="1-Methylhistidine", chebi_id=50212)
+        MetaboliteSynonym.objects.create(metabolite=cls.metabolite, value="Pi-methylhistidine")
+
+        IdentifierLookup.objects.rebuild(HgncGene)
+        IdentifierLookup.objects.rebuild(HmdbMetabolite)
+
+    def setUp(self):
+        clear_identifier_indexes()
+
+    def tearDown(self):
+        clear_identifier_indexes()
+
+    def test_index_matches_database_search(self):
+        search_strings = ['g1', 'g1-alias', '123', '1', '01', 'NOTHING']
+
+        with override_settings(IDENTIFIER_INDEX_ENABLED=False):
+            database_ids = HgncGene.objects.find_matching_ids(search_strings)
+        index_ids = HgncGene.objects.find_matching_ids(search_strings)
+
+        self.assertEqual(index_ids, database_ids)
+
+    def test_find_matching_items_uses_index(self):
+        get_identifier_index(HgncGene)
+
+        # The index version was just checked, so only the matched genes are fetched
+        with self.assertNumQueries(1):
+            results = HgncGene.objects.find_matching_items(['G1-alias', '123', 'NOTHING'])
+
+        self.assertEqual(results['one_match'][0]['item'], self.gene1)
+        self.assertCountEqual(results['multiple_matches'][0]['items'], [self.gene1, self.gene2])
+        self.assertEqual(results['no_matches'], ['NOTHING'])
+
+    def test_metabolite_index(self):
+        results = HmdbMetabolite.objects.find_matching_items(['pi-methylhistidine', '50212'])
+        self.assertEqual(len(results['one_match']), 2)
+
+    @override_settings(IDENTIFIER_INDEX_CHECK_SECONDS=0)
+    def test_index_rebuilt_after_import_run(self):
+        index = get_identifier_index(HgncGene)
+        self.assertIs(get_identifier_index(HgncGene), index)
+
+        gene3 = HgncGene.objects.create(hgnc_id=3, symbol="G3")
+        IdentifierLookup.objects.rebuild(HgncGene, [gene3.pk])
+        # Not visible until the next import run is recorded
+        self.assertEqual(HgncGene.objects.find_matching_items(['G3'])['no_matches'], ['G3'])
+
+        ImportRun.objects.create(database='hgnc')
+        results = HgncGene.objects.find_matching_items(['G3'])
+        self.assertEqual(results['one_match'][0]['item'], gene3)
+        self.assertIsNot(get_identifier_index(HgncGene), index)
+
+    def test_import_run_checked_for_at_most_every_check_interval(self):
+        index = get_identifier_index(HgncGene)
+        ImportRun.objects.create(database='hgnc')
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_identifier_index(HgncGene), index)
+
+        with override_settings(IDENTIFIER_INDEX_CHECK_SECONDS=0):
+            self.assertIsNot(get_identifier_index(HgncGene), index)
+
+    @override_settings(IDENTIFIER_INDEX_CHECK_SECONDS=0)
+    def test_import_run_for_other_database_does_not_rebuild(self):
+        index = get_identifier_index(HgncGene)
+        ImportRun.objects.create(database='hmdb')
+        self.assertIs(get_identifier_index(HgncGene), index)
+
+    def test_index_reports_build_time_and_memory(self):
+        index = get_identifier_index(HgncGene)
+        self.assertGreaterEqual(index.build_seconds, 0)
+        self.assertGreater(index.memory_bytes, 0)
+        self.assertGreater(index.entry_count, 0)
+
+
+class TrigramIndexBuildTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.gene = HgncGene.objects.create(hgnc_id=1, symbol="ABCD1", name="gene one")
+        IdentifierLookup.objects.rebuild(HgncGene)
+
+    def setUp(self):
+        clear_identifier_indexes()
+        if IdentifierLookup.objects.trigram_search_available():
+            self.skipTest('Similarity searches use pg_trgm instead of the trigram index')
+
+    def tearDown(self):
+        clear_identifier_indexes()
+
+    def block_builds(self):
+        """ Makes trigram index builds wait until the returned event is set. """
+        release = threading.Event()
+
+        def build(index):
+            release.wait(5)
+            return index
+
+        patcher = mock.patch.object(TrigramIndex, 'build', autospec=True, side_effect=build)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(release.set)
+        return release
+
+    @override_settings(IDENTIFIER_INDEX_CHECK_SECONDS=0)
+    def test_outdated_index_served_while_rebuilt_in_background(self):
+        index = get_trigram_index(HgncGene)
+        ImportRun.objects.create(database='hgnc')
+        release = self.block_builds()
+
+        self.assertIs(get_trigram_index(HgncGene, wait=False), index)
+        self.assertEqual(HgncGene.objects.find_similar_items('ABCE1')[0][0], self.gene)
+
+        release.set()
+        # Waits for the background build rather than starting another
+        rebuilt_index = get_trigram_index(HgncGene)
+        self.assertIsNot(rebuilt_index, index)
+        self.assertEqual(TrigramIndex.build.call_count, 1)
+
+    def test_prefix_matches_found_while_first_index_builds(self):
+        release = self.block_builds()
+        warm_identifier_indexes()
+
+        self.assertIsNone(get_trigram_index(HgncGene, wait=False))
+        results = HgncGene.objects.find_similar_items_many(['abc', 'ABCE1'])
+        self.assertEqual(results['abc'], [(self.gene, ['symbol'])])
+        self.assertEqual(results['ABCE1'], [])
+
+        release.set()
+        self.assertIsNotNone(get_trigram_index(HgncGene))
@@ -2,11 +2,33 @@ import gzip
 import io
 from unittest.mock import patch
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction, IntegrityError
+from unittest import skipUnless
 from django.core.management.base import CommandError
-from sickgenes.models import HgncGene, StringProtein, StringInteraction
+from sickgenes.models import HgncGene, StringProtein, StringInteraction, GeneInteraction, DataVersion, ImportRun
 from django.core.management import call_command
 from unittest.mock import patch, ANY
 
+from sickgenes.importers.helper_functions import JsonStream, iter_json_items
+from sickgenes.management.commands.benchmark_importers import write_scaled_hgnc_data, SAMPLE_HGNC_PATH
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.test import override_settings
+from sickgenes.importers.download_cache import DownloadCache
+from sickgenes.importers.table_swap import CopyFile, TableReplacement, replace_table_rows
+from sickgenes.importers.update_hmdb import iter_metabolite_chunks, parse_metabolite_chunk, iter_parsed_metabolites
+from sickgenes.management.commands.benchmark_importers import (
+    SAMPLE_HMDB_PATH, HMDB_XML_NAME, legacy_iter_parsed_metabolites,
+)
+from sickgenes.models import HmdbMetabolite
+import zipfile
+
 from sickgenes.importers.update_string import (
     process_string_aliases,
     process_string_interactions,
@@ -29,7 +51,7 @@ class ImportDataCommandTests(TestCase):
         call_command('import_molecule_data', 'string', '--test')
 
         # Assert
-        mock_update_string_data.assert_called_once_with(ANY, True)
+        mock_update_string_data.assert_called_once_with(ANY, True, min_score=0, top_k=None)
 
     @patch(COMMAND_PATH)
     def test_command_calls_string_importer_without_test_flag(self, mock_update_string_data):
@@ -40,7 +62,39 @@ class ImportDataCommandTests(TestCase):
         call_command('import_molecule_data', 'string')
 
         # Assert
-        mock_update_string_data.assert_called_once_with(ANY, False)
+        mock_update_string_data.assert_called_once_with(ANY, False, min_score=0, top_k=None)
+
+    @patch(COMMAND_PATH)
+    def test_command_passes_string_pruning_options(self, mock_update_string_data):
+        """
+        Verify the command passes the minimum score and top-k options on.
+        """
+        call_command('import_molecule_data', 'string', '--test', '--min-score', '400', '--top-k', '25')
+
+        mock_update_string_data.assert_called_once_with(ANY, True, min_score=400, top_k=25)
+
+    @patch(COMMAND_PATH)
+    def test_command_rejects_top_k_below_one(self, mock_update_string_data):
+        with self.assertRaisesMessage(CommandError, '--top-k must be at least 1.'):
+            call_command('import_molecule_data', 'string', '--top-k', '0')
+
+        mock_update_string_data.assert_not_called()
+
+    @patch('sickgenes.management.commands.import_molecule_data.update_hmdb_data')
+    def test_command_rejects_batch_size_below_one(self, mock_update_hmdb_data):
+        for batch_size in ['0', '-5']:
+            with self.assertRaisesMessage(CommandError, '--batch-size must be at least 1.'):
+                call_command('import_molecule_data', 'hmdb', '--test', '--batch-size', batch_size)
+
+        mock_update_hmdb_data.assert_not_called()
+
+    @patch('sickgenes.management.commands.import_molecule_data.update_hmdb_data')
+    def test_command_rejects_workers_below_one(self, mock_update_hmdb_data):
+        for workers in ['0', '-2']:
+            with self.assertRaisesMessage(CommandError, '--workers must be at least 1.'):
+                call_command('import_molecule_data', 'hmdb', '--test', '--workers', workers)
+
+        mock_update_hmdb_data.assert_not_called()
 
     def test_command_fails_with_invalid_database(self):
         """
@@ -124,9 +178,42 @@ class StringDataImportTests(TestCase):
         output = self.stdout.getvalue()
         self.assertIn("String alias import completed", output)
         self.assertIn("Records created: 3", output)
-        self.assertIn("Warning: HgncGene with ID 99999 not found", output)
+        self.assertIn("Warning: 1 HGNC IDs have no HgncGene: 99999 (protein ENSP_NONEXISTENT)", output)
         self.assertIn("Errors: 1", output)
 
+    @patch('sickgenes.importers.update_string.gzip.open')
+    @patch('sickgenes.importers.update_string.os.path.exists', return_value=True)
+    def test_process_string_aliases_uses_one_gene_query(self, mock_exists, mock_gzip_open):
+        """
+        Verify that genes are looked up once rather than per alias line.
+        """
+        mock_file = self._create_mock_gzip_file(MOCK_ALIAS_CONTENT)
+        mock_gzip_open.return_value.__enter__.return_value = mock_file
+
+        with CaptureQueriesContext(connection) as queries:
+            process_string_aliases('dummy_path.gz', self.stdout)
+
+        gene_queries = [query for query in queries.captured_queries if 'FROM "sickgenes_hgncgene"' in query['sql']]
+        self.assertEqual(len(gene_queries), 1)
+
+    @patch('sickgenes.importers.update_string.gzip.open')
+    @patch('sickgenes.importers.update_string.os.path.exists', return_value=True)
+    def test_process_string_aliases_empties_interactions(self, mock_exists, mock_gzip_open):
+        """
+        Verify that a standalone alias import removes the interactions of the old proteins.
+        """
+        mock_gzip_open.return_value = self._create_mock_gzip_file(MOCK_ALIAS_CONTENT)
+        p1 = StringProtein.objects.create(protein_id="OLD_PROTEIN1", hgnc_id=5, hgnc_gene=self.hgnc_5)
+        p2 = StringProtein.objects.create(protein_id="OLD_PROTEIN2", hgnc_id=5, hgnc_gene=self.hgnc_5)
+        StringInteraction.objects.create(protein1=p1, protein2=p2, combined_score=500)
+        GeneInteraction.objects.create(gene_a=self.hgnc_5, gene_b=self.hgnc_13, combined_score=500)
+
+        process_string_aliases('dummy_path.gz', self.stdout)
+
+        self.assertEqual(StringInteraction.objects.count(), 0)
+        self.assertEqual(GeneInteraction.objects.count(), 0)
+        self.assertFalse(StringProtein.objects.filter(protein_id__startswith='OLD_PROTEIN').exists())
+
     @patch('sickgenes.importers.update_string.os.path.exists', return_value=False)
     def test_process_string_aliases_file_not_found(self, mock_exists):
         """
@@ -180,6 +267,106 @@ class StringDataImportTests(TestCase):
         self.assertIn("interactions created: 2", output)
         self.assertIn("missing protein IDs encountered: 3", output)
 
+    @patch('sickgenes.importers.update_string.gzip.open')
+    @patch('sickgenes.importers.update_string.os.path.exists', return_value=True)
+    def test_process_string_interactions_deduplicates_pairs(self, mock_exists, mock_gzip_open):
+        """
+        Verify that a pair listed in both directions, or more than once, is
+        stored once with its highest score.
+        """
+        mock_gzip_open.return_value.__enter__.return_value = self._create_mock_gzip_file(
+            "protein1 protein2 combined_score\n"
+            "9606.ENSP00000269305 9606.ENSP00000371583 400\n"
+            "9606.ENSP00000371583 9606.ENSP00000269305 700\n"
+            "9606.ENSP00000269305 9606.ENSP00000371583 500\n"
+            "9606.ENSP00000269305 9606.ENSP00000269305 300\n"
+            "9606.ENSP00000269305 9606.ENSP00000371583 5000\n"
+        )
+        p1 = StringProtein.objects.create(protein_id="ENSP00000269305", hgnc_id=5, hgnc_gene=self.hgnc_5)
+        p2 = StringProtein.objects.create(protein_id="ENSP00000371583", hgnc_id=13, hgnc_gene=self.hgnc_13)
+
+        process_string_interactions('dummy_path.gz', self.stdout)
+
+        self.assertEqual(
+            set(StringInteraction.objects.values_list('protein1', 'protein2', 'combined_score')),
+            {(p1.id, p2.id, 700), (p1.id, p1.id, 300)},
+        )
+        output = self.stdout.getvalue()
+        self.assertIn("Skipping malformed line 6", output)
+        self.assertIn("Skipped (duplicate, malformed, missing protein): 3", output)
+
+    @patch('sickgenes.importers.update_string.gzip.open')
+    @patch('sickgenes.importers.update_string.os.path.exists', return_value=True)
+    def test_process_string_interactions_creates_gene_interactions(self, mock_exists, mock_gzip_open):
+        """
+        Verify that interactions are collapsed to one per gene pair, with the
+        smaller gene pk first and the highest score, leaving out pairs within a gene.
+        """
+        mock_gzip_open.return_value.__enter__.return_value = self._create_mock_gzip_file(
+            "protein1 protein2 combined_score\n"
+            "9606.P13 9606.P5A 400\n"
+            "9606.P5B 9606.P13 800\n"
+            "9606.P5A 9606.P5B 900\n"
+            "9606.P14 9606.P13 600\n"
+        )
+        StringProtein.objects.create(protein_id="P5A", hgnc_id=5, hgnc_gene=self.hgnc_5)
+        StringProtein.objects.create(protein_id="P5B", hgnc_id=5, hgnc_gene=self.hgnc_5)
+        StringProtein.objects.create(protein_id="P13", hgnc_id=13, hgnc_gene=self.hgnc_13)
+        StringProtein.objects.create(protein_id="P14", hgnc_id=14, hgnc_gene=self.hgnc_14)
+        GeneInteraction.objects.create(gene_a=self.hgnc_5, gene_b=self.hgnc_14, combined_score=100)
+
+        process_string_interactions('dummy_path.gz', self.stdout)
+
+        self.assertEqual(StringInteraction.objects.count(), 4)
+        self.assertEqual(
+            set(GeneInteraction.objects.values_list('gene_a', 'gene_b', 'combined_score')),
+            {(self.hgnc_5.id, self.hgnc_13.id, 800), (self.hgnc_13.id, self.hgnc_14.id, 600)},
+        )
+        self.assertIn("Gene interactions created: 2", self.stdout.getvalue())
+
+    @patch('sickgenes.importers.update_string.gzip.open')
+    @patch('sickgenes.importers.update_string.os.path.exists', return_value=True)
+    def test_process_string_interactions_min_score(self, mock_exists, mock_gzip_open):
+        """
+        Verify that interactions below the minimum score are not stored.
+        """
+        mock_gzip_open.return_value.__enter__.return_value = self._create_mock_gzip_file(MOCK_INTERACTION_CONTENT)
+        StringProtein.objects.create(protein_id="ENSP00000269305", hgnc_id=5, hgnc_gene=self.hgnc_5)
+        StringProtein.objects.create(protein_id="ENSP00000371583", hgnc_id=13, hgnc_gene=self.hgnc_13)
+        StringProtein.objects.create(protein_id="ENSP00000216171", hgnc_id=14, hgnc_gene=self.hgnc_14)
+
+        process_string_interactions('dummy_path.gz', self.stdout, min_score=960)
+
+        self.assertEqual(list(StringInteraction.objects.values_list('combined_score', flat=True)), [999])
+        self.assertIn("Below the minimum score of 960: 3", self.stdout.getvalue())
+
+    @patch('sickgenes.importers.update_string.gzip.open')
+    @patch('sickgenes.importers.update_string.os.path.exists', return_value=True)
+    def test_process_string_interactions_top_k(self, mock_exists, mock_gzip_open):
+        """
+        Verify that only interactions among the strongest of either protein are stored.
+        """
+        mock_gzip_open.return_value.__enter__.return_value = self._create_mock_gzip_file(
+            "protein1 protein2 combined_score\n"
+            "9606.ENSPA 9606.ENSPB 900\n"
+            "9606.ENSPA 9606.ENSPC 800\n"
+            "9606.ENSPA 9606.ENSPD 700\n"
+            "9606.ENSPB 9606.ENSPC 100\n"
+        )
+        proteins = {
+            name: StringProtein.objects.create(protein_id=f"ENSP{name}", hgnc_id=5, hgnc_gene=self.hgnc_5)
+            for name in 'ABCD'
+        }
+
+        process_string_interactions('dummy_path.gz', self.stdout, top_k=1)
+
+        # B-C is neither B's nor C's strongest interaction
+        self.assertEqual(
+            set(StringInteraction.objects.values_list('protein1', 'protein2')),
+            {(proteins['A'].id, proteins[name].id) for name in 'BCD'},
+        )
+        self.assertIn("Pruned, not among the top 1 of either protein: 1", self.stdout.getvalue())
+
     @patch('sickgenes.importers.update_string.os.path.exists', return_value=False)
     def test_process_string_interactions_file_not_found(self, mock_exists):
         """
@@ -197,10 +384,13 @@ class StringDataImportTests(TestCase):
         """
         mock_process_aliases.return_value = True
         mock_process_interactions.return_value = True
+        version = DataVersion.get_solo().version
 
         result = update_string_data(self.stdout, use_test_data=True)
 
         self.assertTrue(result)
+        # Cached graphs of the old interactions are invalidated
+        self.assertEqual(DataVersion.get_solo().version, version + 1)
         mock_process_aliases.assert_called_once()
         mock_process_interactions.assert_called_once()
         
@@ -209,4 +399,394 @@ class StringDataImportTests(TestCase):
         self.assertIn('sample_data', args[0])
         
         args, _ = mock_process_interactions.call_args
-        self.assertIn('sample_data', args[0])
\ No newline at end of file
+        self.assertIn('sample_data', args[0])
+
+
+class TableSwapTests(TestCase):
+    """
+    Tests replacing a table's rows through COPY into a shadow table.
+    """
+    def setUp(self):
+        gene = HgncGene.objects.create(hgnc_id=5, symbol="A1BG")
+        self.proteins = [
+            StringProtein.objects.create(protein_id=f"ENSP{number}", hgnc_id=5, hgnc_gene=gene)
+            for number in range(3)
+        ]
+        StringInteraction.objects.create(protein1=self.proteins[0], protein2=self.proteins[1], combined_score=100)
+
+    def test_copy_file_encodes_rows(self):
+        copy_file = CopyFile([(1, 'a\tb', None), (2, 'back\\slash\nnewline', True)])
+
+        data = b''
+        while chunk := copy_file.read(5):
+            data += chunk
+
+        self.assertEqual(data, b'1\ta\\tb\t\\N\n2\tback\\\\slash\\nnewline\tt\n')
+        self.assertEqual(copy_file.row_count, 2)
+
+    def test_replace_table_rows(self):
+        p1, p2, p3 = (protein.id for protein in self.proteins)
+
+        row_count = replace_table_rows(
+            StringInteraction, ['protein1', 'protein2', 'combined_score'], [(p1, p3, 900), (p2, p3, 800)]
+        )
+
+        self.assertEqual(row_count, 2)
+        self.assertEqual(
+            set(StringInteraction.objects.values_list('protein1', 'protein2', 'combined_score')),
+            {(p1, p3, 900), (p2, p3, 800)},
+        )
+
+    @skipUnless(connection.vendor == 'postgresql', 'Shadow tables are PostgreSQL only')
+    def test_swapped_table_keeps_constraints_and_indexes(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, StringInteraction._meta.db_table)
+        p1, p2, p3 = (protein.id for protein in self.proteins)
+
+        replace_table_rows(StringInteraction, ['protein1', 'protein2', 'combined_score'], [(p1, p3, 900)])
+
+        with connection.cursor() as cursor:
+            swapped_constraints = connection.introspection.get_constraints(cursor, StringInteraction._meta.db_table)
+        self.assertEqual(swapped_constraints, constraints)
+
+        # The primary key keeps generating ids, and the unique pair constraint is enforced
+        StringInteraction.objects.create(protein1=self.proteins[1], protein2=self.proteins[2], combined_score=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            StringInteraction.objects.create(protein1=self.proteins[0], protein2=self.proteins[2], combined_score=1)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Shadow tables are PostgreSQL only')
+    def test_replaces_related_tables_together(self):
+        gene = self.proteins[0].hgnc_gene
+        replacement = TableReplacement()
+        replacement.load(StringProtein, ['protein_id', 'hgnc_id', 'hgnc_gene'], [('NEW1', 5, gene.id), ('NEW2', 5, gene.id)])
+        protein_pks = dict(replacement.values_list(StringProtein, ['protein_id', 'id']))
+        replacement.load(
+            StringInteraction, ['protein1', 'protein2', 'combined_score'], [(protein_pks['NEW1'], protein_pks['NEW2'], 700)]
+        )
+
+        # Nothing changes until the replacement is committed
+        self.assertEqual(StringProtein.objects.count(), 3)
+        replacement.commit()
+
+        self.assertEqual(set(StringProtein.objects.values_list('protein_id', flat=True)), {'NEW1', 'NEW2'})
+        interaction = StringInteraction.objects.get()
+        self.assertEqual((interaction.protein1.protein_id, interaction.protein2.protein_id), ('NEW1', 'NEW2'))
+
+        # The interactions' foreign keys refer to the swapped in proteins table
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            StringInteraction.objects.create(protein1_id=max(protein_pks.values()) + 1, protein2_id=protein_pks['NEW1'], combined_score=1)
+            connection.check_constraints()
+        with connection.cursor() as cursor:
+            tables = connection.introspection.table_names(cursor)
+        self.assertFalse([table for table in tables if table.endswith(('__old', '__shadow'))])
+
+    @skipUnless(connection.vendor == 'postgresql', 'Shadow tables are PostgreSQL only')
+    def test_refuses_to_replace_a_referenced_table_alone(self):
+        replacement = TableReplacement()
+        replacement.load(StringProtein, ['protein_id', 'hgnc_id', 'hgnc_gene'], [])
+
+        with self.assertRaises(ValueError):
+            replacement.commit()
+
+
+class StreamingJsonTests(TestCase):
+    """
+    Tests iter_json_items, which reads JSON arrays in bounded memory.
+    """
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+
+    def write_json(self, content):
+        path = os.path.join(self.temp_dir, 'data.json')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        return path
+
+    def test_items_match_json_load(self):
+        with open(SAMPLE_HGNC_PATH, encoding='utf-8') as file:
+            expected_docs = json.load(file)['response']['docs']
+
+        # Small chunks split values, strings and numbers across chunk boundaries
+        for chunk_size in [1, 7, 64, 65536]:
+            with self.subTest(chunk_size=chunk_size):
+                docs = list(iter_json_items(SAMPLE_HGNC_PATH, ('response', 'docs'), chunk_size=chunk_size))
+                self.assertEqual(docs, expected_docs)
+
+    def test_skips_other_keys(self):
+        path = self.write_json('{"header": {"docs": [0]}, "numbers": [1, 2], "response": {"numFound": 2, "docs": [12345, {"a": "]"}]}}')
+        self.assertEqual(list(iter_json_items(path, ('response', 'docs'), chunk_size=3)), [12345, {"a": "]"}])
+
+    def test_empty_array(self):
+        path = self.write_json('{"response": {"docs": [ ]}}')
+        self.assertEqual(list(iter_json_items(path, ('response', 'docs'))), [])
+
+    def test_missing_key(self):
+        path = self.write_json('{"response": {"numFound": 0}}')
+        with self.assertRaises(ValueError):
+            list(iter_json_items(path, ('response', 'docs')))
+
+    def test_truncated_document(self):
+        path = self.write_json('{"response": {"docs": [{"symbol": "A1BG"}, {"symbol": ')
+        with self.assertRaises(ValueError):
+            list(iter_json_items(path, ('response', 'docs')))
+
+    def test_literals_and_escapes_split_across_chunks(self):
+        items = [True, False, None, -1.5e-3, 'café 😀', {'a': [True, 'x"y']}]
+        path = self.write_json('{"docs": ' + json.dumps(items) + '}')
+        for chunk_size in [1, 2, 3, 5]:
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(list(iter_json_items(path, ('docs',), chunk_size=chunk_size)), items)
+
+    def test_malformed_value_raises_without_reading_to_the_end(self):
+        file = io.StringIO('[{"a": x}, ' + '{"a": 1}, ' * 10000 + '{"a": 1}]')
+        stream = JsonStream(file, chunk_size=64)
+        stream.expect('[')
+        with self.assertRaises(json.JSONDecodeError):
+            stream.read_value()
+        self.assertEqual(file.tell(), 64)
+
+    def test_peak_memory_stays_flat_as_input_grows(self):
+        """
+        Reading ten times as many documents shouldn't need noticeably more
+        memory, while json.load needs about ten times as much.
+        """
+        def peak_memory(read):
+            tracemalloc.start()
+            try:
+                read()
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        def stream(path):
+            for doc in iter_json_items(path, ('response', 'docs')):
+                pass
+
+        def load(path):
+            with open(path, encoding='utf-8') as file:
+                json.load(file)
+
+        small_path = os.path.join(self.temp_dir, 'small.json')
+        large_path = os.path.join(self.temp_dir, 'large.json')
+        write_scaled_hgnc_data(small_path, 300)
+        write_scaled_hgnc_data(large_path, 3000)
+
+        small_peak = peak_memory(lambda: stream(small_path))
+        large_peak = peak_memory(lambda: stream(large_path))
+        self.assertLess(large_peak, small_peak * 1.5)
+
+        self.assertGreater(peak_memory(lambda: load(large_path)), large_peak * 5)
+
+
+class SampleDataHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for a data source server: serves the files in `files`, with an
+    ETag, and answers conditional GETs with 304 Not Modified.
+    """
+    files = {}
+    statuses = []
+
+    def do_GET(self):
+        content = self.files.get(self.path)
+        if content is None:
+            self.statuses.append(404)
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        etag = f'"{hashlib.sha256(content).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.statuses.append(200)
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadCacheTests(TestCase):
+    """
+    Tests the download cache and the HGNC import skipping unchanged downloads,
+    against a local HTTP server.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), SampleDataHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/hgnc.json'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        with open(SAMPLE_HGNC_PATH, 'rb') as file:
+            self.sample_content = file.read()
+        SampleDataHandler.files = {'/hgnc.json': self.sample_content}
+        SampleDataHandler.statuses = []
+
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache_dir = temp_dir.name
+        self.cache = DownloadCache(self.cache_dir)
+
+    def test_download_is_cached_with_metadata(self):
+        download = self.cache.fetch(self.url)
+
+        with open(download.path, 'rb') as file:
+            self.assertEqual(file.read(), self.sample_content)
+        self.assertEqual(download.sha256, hashlib.sha256(self.sample_content).hexdigest())
+        self.assertEqual(self.cache.get(self.url).meta['etag'], download.meta['etag'])
+
+    def test_unchanged_download_is_not_fetched_again(self):
+        self.cache.fetch(self.url)
+        download = self.cache.fetch(self.url)
+
+        self.assertEqual(SampleDataHandler.statuses, [200, 304])
+        self.assertEqual(download.sha256, hashlib.sha256(self.sample_content).hexdigest())
+
+    def test_changed_download_is_fetched_again(self):
+        self.cache.fetch(self.url)
+        SampleDataHandler.files['/hgnc.json'] = b'{"response": {"docs": []}}'
+
+        download = self.cache.fetch(self.url)
+
+        self.assertEqual(SampleDataHandler.statuses, [200, 200])
+        self.assertEqual(download.sha256, hashlib.sha256(b'{"response": {"docs": []}}').hexdigest())
+        with open(download.path, 'rb') as file:
+            self.assertEqual(file.read(), b'{"response": {"docs": []}}')
+
+    def test_import_skipped_when_source_unchanged(self):
+        with override_settings(IMPORT_CACHE_DIR=self.cache_dir), \
+                patch('sickgenes.management.commands.import_molecule_data.HGNC_DATA_PATHS', [self.url]):
+            out = io.StringIO()
+            call_command('import_molecule_data', 'hgnc', stdout=out)
+            self.assertIn('HGNC data successfully imported', out.getvalue())
+            self.assertEqual(HgncGene.objects.count(), 3)
+
+            out = io.StringIO()
+            call_command('import_molecule_data', 'hgnc', stdout=out)
+            self.assertIn('has not changed since the last import', out.getvalue())
+
+            out = io.StringIO()
+            call_command('import_molecule_data', 'hgnc', force=True, stdout=out)
+            self.assertIn('HGNC data successfully imported', out.getvalue())
+
+        self.assertEqual(SampleDataHandler.statuses, [200, 304, 304])
+
+    def test_unchanged_source_imported_into_database_without_it(self):
+        with override_settings(IMPORT_CACHE_DIR=self.cache_dir), \
+                patch('sickgenes.management.commands.import_molecule_data.HGNC_DATA_PATHS', [self.url]):
+            call_command('import_molecule_data', 'hgnc', stdout=io.StringIO())
+            self.assertEqual(
+                ImportRun.latest('hgnc').source_checksums,
+                {self.url: hashlib.sha256(self.sample_content).hexdigest()},
+            )
+
+            # As in a fresh or restored database, with the download cache kept
+            HgncGene.objects.all().delete()
+            ImportRun.objects.all().delete()
+
+            out = io.StringIO()
+            call_command('import_molecule_data', 'hgnc', stdout=out)
+            self.assertIn('HGNC data successfully imported', out.getvalue())
+
+        self.assertEqual(SampleDataHandler.statuses, [200, 304])
+        self.assertEqual(HgncGene.objects.count(), 3)
+
+    def test_failed_download_raises_command_error(self):
+        with override_settings(IMPORT_CACHE_DIR=self.cache_dir), \
+                patch('sickgenes.management.commands.import_molecule_data.HGNC_DATA_PATHS', [self.url + '.missing']):
+            with self.assertRaises(CommandError):
+                call_command('import_molecule_data', 'hgnc', stdout=io.StringIO())
+
+
+class HmdbPipelineTests(TestCase):
+    """
+    Tests parsing HMDB XML in chunks of <metabolite> elements and importing
+    through the parse/save pipeline.
+    """
+    def test_chunks_parse_like_the_whole_document(self):
+        expected = list(iter_parsed_metabolites(SAMPLE_HMDB_PATH, HMDB_XML_NAME))
+
+        for metabolites_per_chunk, read_size in [(1, 100), (2, 4096), (100, 1024 * 1024)]:
+            with self.subTest(metabolites_per_chunk=metabolites_per_chunk, read_size=read_size):
+                with zipfile.ZipFile(SAMPLE_HMDB_PATH) as zip_file, zip_file.open(HMDB_XML_NAME) as xml_file:
+                    chunks = list(iter_metabolite_chunks(xml_file, metabolites_per_chunk, read_size=read_size))
+
+                parsed = [metabolite for chunk in chunks for metabolite in parse_metabolite_chunk(*chunk)]
+                self.assertEqual(parsed, expected)
+                self.assertEqual(len(chunks), -(-len(expected) // metabolites_per_chunk))
+
+    def test_single_pass_parser_matches_find_based_parser(self):
+        expected = list(legacy_iter_parsed_metabolites(SAMPLE_HMDB_PATH, HMDB_XML_NAME))
+
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(list(iter_parsed_metabolites(SAMPLE_HMDB_PATH, HMDB_XML_NAME)), expected)
+
+    def test_parser_uses_first_child_with_each_tag(self):
+        xml = (
+            b'<hmdb xmlns="http://www.hmdb.ca"><metabolite>'
+            b'<accession>HMDB0000001</accession><name>First</name><name>Second</name>'
+            b'<secondary_accessions><accession>HMDB01</accession><other>x</other></secondary_accessions>'
+            b'</metabolite></hmdb>'
+        )
+        [metabolite] = parse_metabolite_chunk(b'', b'', xml)
+
+        self.assertEqual(metabolite['accession'], 'HMDB0000001')
+        self.assertEqual(metabolite['fields']['name'], 'First')
+        self.assertEqual(metabolite['related'], {'secondary_accessions': ['HMDB01']})
+
+    def test_parser_benchmark(self):
+        out = io.StringIO()
+        call_command('benchmark_importers', 'hmdb-parser', scale=1, stdout=out)
+
+        self.assertIn('HMDB XML: 3 metabolites', out.getvalue())
+        self.assertIn('elements/s', out.getvalue())
+        self.assertIn('peak memory', out.getvalue())
+
+    def test_chunks_keep_default_namespace(self):
+        xml = (
+            b'<?xml version="1.0"?>\n<hmdb xmlns="http://www.hmdb.ca">'
+            b'<metabolite><accession>HMDB0000001</accession><name>One</name></metabolite>'
+            b'<metabolite><accession>HMDB0000002</accession><name>Two</name></metabolite>'
+            b'</hmdb>'
+        )
+        chunks = list(iter_metabolite_chunks(io.BytesIO(xml), 1, read_size=16))
+
+        parsed = [metabolite for chunk in chunks for metabolite in parse_metabolite_chunk(*chunk)]
+        self.assertEqual([metabolite['fields']['name'] for metabolite in parsed], ['One', 'Two'])
+
+    def test_import_with_worker_processes(self):
+        out = io.StringIO()
+        call_command('import_molecule_data', 'hmdb', test=True, workers=2, stdout=out)
+
+        self.assertIn('HMDB data successfully imported', out.getvalue())
+        self.assertIn('database writes', out.getvalue())
+        self.assertEqual(HmdbMetabolite.objects.count(), 3)
+        self.assertEqual(HmdbMetabolite.objects.get(accession='HMDB0000005').synonyms.count(), 44)
+
+    def test_parse_error_stops_import(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'hmdb.zip')
+            with zipfile.ZipFile(SAMPLE_HMDB_PATH) as zip_file:
+                xml = zip_file.read(HMDB_XML_NAME)
+            with zipfile.ZipFile(path, 'w') as zip_file:
+                zip_file.writestr(HMDB_XML_NAME, xml[:len(xml) // 2])
+
+            with patch('sickgenes.management.commands.import_molecule_data.HMDB_DATA_PATH', path):
+                with self.assertRaises(CommandError):
+                    call_command('import_molecule_data', 'hmdb', stdout=io.StringIO())
@@ -1,5 +1,6 @@
+from unittest.mock import patch
 from django.test import TestCase
-from sickgenes.models import Study
+from sickgenes.models import Disease, GeneDiseaseEvidence, GeneFinding, HgncGene, Study, StudyCohort
 
 class StudyTest(TestCase):
 
@@ -22,4 +23,139 @@ class StudyTest(TestCase):
 
         self.assertEqual(short_authors1, 'Lewis et al.')
         self.assertEqual(short_authors2, 'Allen')
-        self.assertEqual(short_authors3, '')
\ No newline at end of file
+        self.assertEqual(short_authors3, '')
+
+class GeneDiseaseEvidenceTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.disease1 = Disease.objects.create(name='Cardiomyopathy')
+        cls.disease2 = Disease.objects.create(name='Epilepsy')
+        cls.gene_ttn = HgncGene.objects.create(symbol='TTN')
+        cls.gene_scn1a = HgncGene.objects.create(symbol='SCN1A')
+
+        cls.study1 = Study.objects.create(title='Cardio Study A')
+        cls.study2 = Study.objects.create(title='Multi-disease Study B')
+        cls.cohort1 = StudyCohort.objects.create(study=cls.study1)
+        cls.cohort1.disease_tags.add(cls.disease1)
+        cls.cohort2 = StudyCohort.objects.create(study=cls.study2)
+        cls.cohort2.disease_tags.add(cls.disease1, cls.disease2)
+        cls.cohort3 = StudyCohort.objects.create(study=cls.study2)
+        cls.cohort3.disease_tags.add(cls.disease2)
+
+        GeneFinding.objects.create(hgnc_gene=cls.gene_ttn, study_cohort=cls.cohort1)
+        GeneFinding.objects.create(hgnc_gene=cls.gene_ttn, study_cohort=cls.cohort2)
+        GeneFinding.objects.create(hgnc_gene=cls.gene_ttn, study_cohort=cls.cohort3)
+        GeneFinding.objects.create(hgnc_gene=cls.gene_scn1a, study_cohort=cls.cohort3)
+
+    def evidence(self, gene):
+        """ {disease pk: (study count, cohort count)} of a gene, None for its totals. """
+        return {
+            disease_id: (study_count, cohort_count)
+            for disease_id, study_count, cohort_count in GeneDiseaseEvidence.objects.filter(
+                gene=gene,
+            ).values_list('disease_id', 'study_count', 'cohort_count')
+        }
+
+    def test_counts_studies_and_cohorts_per_disease(self):
+        self.assertEqual(self.evidence(self.gene_ttn), {
+            self.disease1.pk: (2, 2),
+            self.disease2.pk: (1, 2),
+            None: (2, 3),
+        })
+        self.assertEqual(self.evidence(self.gene_scn1a), {self.disease2.pk: (1, 1), None: (1, 1)})
+        self.assertEqual(
+            GeneDiseaseEvidence.objects.get(gene=self.gene_ttn, disease=self.disease1).study_ids,
+            sorted([self.study1.pk, self.study2.pk]),
+        )
+
+    def test_refresh_matches_maintained_rows(self):
+        rows = set(GeneDiseaseEvidence.objects.values_list('gene', 'disease', 'study_count', 'cohort_count'))
+        GeneDiseaseEvidence.objects.all().delete()
+        GeneDiseaseEvidence.objects.refresh()
+        self.assertEqual(
+            set(GeneDiseaseEvidence.objects.values_list('gene', 'disease', 'study_count', 'cohort_count')),
+            rows,
+        )
+
+    def test_finding_changes_refresh_evidence(self):
+        gene_brca1 = HgncGene.objects.create(symbol='BRCA1')
+        finding = GeneFinding.objects.get(hgnc_gene=self.gene_scn1a)
+        finding.hgnc_gene = gene_brca1
+        finding.save()
+        self.assertEqual(self.evidence(self.gene_scn1a), {})
+        self.assertEqual(self.evidence(gene_brca1), {self.disease2.pk: (1, 1), None: (1, 1)})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            GeneFinding.objects.filter(hgnc_gene=self.gene_ttn, study_cohort=self.cohort1).delete()
+        self.assertEqual(self.evidence(self.gene_ttn), {
+            self.disease1.pk: (1, 1),
+            self.disease2.pk: (1, 2),
+            None: (1, 2),
+        })
+
+    def test_unfinished_study_is_not_counted(self):
+        self.study2.not_finished = True
+        self.study2.save()
+        self.assertEqual(self.evidence(self.gene_ttn), {self.disease1.pk: (1, 1), None: (1, 1)})
+        self.assertEqual(self.evidence(self.gene_scn1a), {})
+
+        self.study2.not_finished = False
+        self.study2.save()
+        self.assertEqual(self.evidence(self.gene_scn1a), {self.disease2.pk: (1, 1), None: (1, 1)})
+
+    def test_disease_tag_changes_refresh_evidence(self):
+        self.cohort1.disease_tags.remove(self.disease1)
+        self.assertEqual(self.evidence(self.gene_ttn)[self.disease1.pk], (1, 1))
+
+        self.cohort1.disease_tags.add(self.disease2)
+        self.assertEqual(self.evidence(self.gene_ttn)[self.disease2.pk], (2, 3))
+
+        self.disease2.study_cohorts.clear()
+        self.assertNotIn(self.disease2.pk, self.evidence(self.gene_ttn))
+        self.assertEqual(self.evidence(self.gene_scn1a), {None: (1, 1)})
+
+    def test_older_study_version_is_not_counted(self):
+        newer_study = Study.objects.create(title='Cardio Study A, corrected')
+        newer_cohort = StudyCohort.objects.create(study=newer_study)
+        newer_cohort.disease_tags.add(self.disease1)
+        GeneFinding.objects.create(hgnc_gene=self.gene_scn1a, study_cohort=newer_cohort)
+
+        self.study1.set_newest_version(newer_study)
+        self.assertEqual(self.evidence(self.gene_ttn)[self.disease1.pk], (1, 1))
+        self.assertEqual(self.evidence(self.gene_scn1a)[self.disease1.pk], (1, 1))
+
+    def test_study_delete_refreshes_each_gene_once(self):
+        with patch.object(GeneDiseaseEvidence.objects, 'refresh', wraps=GeneDiseaseEvidence.objects.refresh) as refresh:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.study2.delete()
+
+        refresh.assert_called_once_with({self.gene_ttn.pk, self.gene_scn1a.pk})
+        self.assertEqual(self.evidence(self.gene_ttn), {self.disease1.pk: (1, 1), None: (1, 1)})
+        self.assertEqual(self.evidence(self.gene_scn1a), {})
+
+    def test_deleting_newest_version_counts_older_version_again(self):
+        newer_study = Study.objects.create(title='Cardio Study A, corrected')
+        self.study1.set_newest_version(newer_study)
+        self.assertNotIn(self.disease1.pk, self.evidence(self.gene_scn1a))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            newer_study.delete()
+        self.assertEqual(self.evidence(self.gene_ttn)[self.disease1.pk], (2, 2))
+
+    def test_study_save_refreshes_only_when_counting_changes(self):
+        with patch.object(GeneDiseaseEvidence.objects, 'refresh_findings') as refresh_findings:
+            self.study1.title = 'Cardio Study A, retitled'
+            self.study1.save()
+            refresh_findings.assert_not_called()
+
+            self.study1.not_finished = True
+            self.study1.save()
+            refresh_findings.assert_called_once_with(study_cohort__study=self.study1)
+
+    def test_study_counts_count_each_study_once(self):
+        # Study B has a cohort tagged with both diseases and one with the second
+        self.assertEqual(
+            GeneDiseaseEvidence.objects.study_counts([self.gene_ttn.pk], [self.disease1.pk, self.disease2.pk]),
+            {self.gene_ttn.pk: 2},
+        )
@@ -1,13 +1,22 @@
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from sickgenes.models import HgncGene, Study, Disease, StudyCohort, HmdbMetabolite
 from io import StringIO
+import os
+from django.conf import settings
 from django.utils import timezone
 from django.urls import reverse
 from sickgenes.forms import StudyForm, SetNewestStudyVersionForm
+from sickgenes.forms.match_forms import MAX_SUGGESTED_TERMS, similar_match_results
+from sickgenes.identifier_index import clear_identifier_indexes
+from sickgenes.importers import update_hgnc_data
 from sickgenes.models import (
     HgncGene, Ena, UniprotId, OmimId, AliasSymbol, AliasName, PrevSymbol, PrevName,
-    HmdbMetabolite, MetaboliteSynonym, SecondaryAccession, GeneFinding, SiteConfiguration
+    HmdbMetabolite, MetaboliteSynonym, SecondaryAccession, GeneFinding, SiteConfiguration,
+    ImportRun, IdentifierLookup, StagedMetabolite,
 )
 from unittest.mock import patch, Mock, mock_open
 import requests
@@ -459,6 +468,17 @@ class ImportHgncTest(TestCase):
         genes = HgncGene.objects.all()
         self.assertEqual(genes.count(), 3)
 
+    def test_identifier_lookup_is_populated(self):
+        gene = HgncGene.objects.get(hgnc_id=5)
+        lookup_rows = IdentifierLookup.objects.filter(molecule_type='gene', molecule_id=gene.pk)
+        self.assertIn(('A1BG', 'symbol'), lookup_rows.values_list('normalized_value', 'source_field'))
+        self.assertIn(('138670', 'omimid'), lookup_rows.values_list('normalized_value', 'source_field'))
+        self.assertEqual(HgncGene.objects.find_matching_items(['a1bg'])['one_match'][0]['item'], gene)
+
+    def test_import_run_is_recorded(self):
+        import_run = ImportRun.objects.get(database='hgnc')
+        self.assertEqual(import_run.processed_count, 3)
+
     def test_all_hgnc_fields_are_saved(self):
         gene = HgncGene.objects.get(hgnc_id=5)
 
@@ -490,6 +510,100 @@ class ImportHgncTest(TestCase):
 
         self.assertEqual(HgncGene.objects.count(), initial_count)
 
+    def test_reimport_replaces_related_values(self):
+        gene = HgncGene.objects.get(hgnc_id=5)
+        AliasSymbol.objects.create(gene=gene, value='stale_alias_symbol')
+
+        call_command('import_molecule_data', 'hgnc', test=True, stdout=StringIO())
+
+        self.assertCountEqual(gene.aliassymbol_set.values_list('value', flat=True), ['fake_alias_symbol'])
+        self.assertEqual(HgncGene.objects.find_matching_items(['stale_alias_symbol'])['no_matches'], ['stale_alias_symbol'])
+
+    def test_import_batches_do_not_change_result(self):
+        update_hgnc_data([os.path.join(settings.BASE_DIR, 'sample_data/sample_hgnc.json')], batch_size=2)
+
+        gene = HgncGene.objects.get(hgnc_id=5)
+        self.assertEqual(HgncGene.objects.count(), 3)
+        self.assertCountEqual(gene.prevsymbol_set.values_list('value', flat=True), ['fake_prev_symbol', 'string, including comma'])
+
+    def test_benchmark_refuses_to_run_in_place_on_data(self):
+        with self.assertRaisesMessage(CommandError, 'sickgenes_hgncgene is not empty'):
+            call_command('benchmark_importers', 'hgnc', scale=2, in_place=True, stdout=StringIO())
+
+    def test_benchmark_rolls_back(self):
+        out = StringIO()
+        HgncGene.objects.all().delete()
+        IdentifierLookup.objects.all().delete()
+
+        call_command('benchmark_importers', 'hgnc', scale=2, in_place=True, stdout=out)
+
+        self.assertIn('HGNC: 6 genes', out.getvalue())
+        self.assertIn('bulk:', out.getvalue())
+        self.assertEqual(HgncGene.objects.count(), 0)
+
+class ImportHgncIncrementalTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command('import_molecule_data', 'hgnc', test=True, incremental=True, stdout=StringIO())
+
+    def import_incremental(self):
+        out = StringIO()
+        call_command('import_molecule_data', 'hgnc', test=True, incremental=True, stdout=out)
+        return out.getvalue()
+
+    def test_first_import_inserts_all_genes(self):
+        self.assertEqual(HgncGene.objects.count(), 3)
+        self.assertTrue(all(HgncGene.objects.values_list('content_hash', flat=True)))
+
+    def test_unchanged_genes_are_not_touched(self):
+        updated_at = dict(HgncGene.objects.values_list('hgnc_id', 'updated_at'))
+
+        output = self.import_incremental()
+
+        self.assertIn('Inserted 0, updated 0, unchanged 3, removed 0 records', output)
+        self.assertEqual(dict(HgncGene.objects.values_list('hgnc_id', 'updated_at')), updated_at)
+
+    def test_changed_gene_is_updated(self):
+        gene = HgncGene.objects.get(hgnc_id=5)
+        HgncGene.objects.filter(pk=gene.pk).update(symbol='OLD', content_hash='outdated')
+        AliasSymbol.objects.create(gene=gene, value='stale_alias_symbol')
+
+        output = self.import_incremental()
+
+        self.assertIn('Inserted 0, updated 1, unchanged 2', output)
+        gene.refresh_from_db()
+        self.assertEqual(gene.symbol, 'A1BG')
+        self.assertCountEqual(gene.aliassymbol_set.values_list('value', flat=True), ['fake_alias_symbol'])
+
+    def test_withdrawn_genes_are_removed_unless_used(self):
+        withdrawn_gene = HgncGene.objects.create(hgnc_id=99998, symbol='WITHDRAWN')
+        used_gene = HgncGene.objects.create(hgnc_id=99999, symbol='USED')
+        study_cohort = StudyCohort.objects.create(study=Study.objects.create(title='Study'))
+        GeneFinding.objects.create(study_cohort=study_cohort, hgnc_gene=used_gene)
+        IdentifierLookup.objects.rebuild(HgncGene)
+
+        output = self.import_incremental()
+
+        self.assertIn('removed 1 records (1 no longer in HGNC kept as findings use them)', output)
+        self.assertFalse(HgncGene.objects.filter(pk=withdrawn_gene.pk).exists())
+        self.assertTrue(HgncGene.objects.filter(pk=used_gene.pk).exists())
+        self.assertFalse(IdentifierLookup.objects.filter(molecule_type='gene', molecule_id=withdrawn_gene.pk).exists())
+
+    def test_full_import_records_content_hash(self):
+        HgncGene.objects.update(content_hash=None)
+        call_command('import_molecule_data', 'hgnc', test=True, stdout=StringIO())
+
+        self.assertIn('unchanged 3', self.import_incremental())
+
+    def test_full_import_empties_fields_missing_from_source(self):
+        # A1BG-AS1 has no OMIM id in the sample data
+        gene = HgncGene.objects.get(hgnc_id=37133)
+        OmimId.objects.create(gene=gene, value=999999)
+        call_command('import_molecule_data', 'hgnc', test=True, stdout=StringIO())
+
+        self.assertFalse(gene.omimid_set.exists())
+        self.assertIn('unchanged 3', self.import_incremental())
+
 class ImportHmdbTest(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -559,6 +673,136 @@ class ImportHmdbTest(TestCase):
 
         self.assertEqual(HmdbMetabolite.objects.count(), initial_count)
 
+    def test_import_batches_do_not_change_result(self):
+        molecule = HmdbMetabolite.objects.get(accession='HMDB0000005')
+        synonyms = set(molecule.synonyms.values_list('value', flat=True))
+        MetaboliteSynonym.objects.create(metabolite=molecule, value='stale synonym')
+
+        call_command('import_molecule_data', 'hmdb', test=True, batch_size=1, force=True, stdout=StringIO())
+
+        self.assertEqual(HmdbMetabolite.objects.count(), 3)
+        self.assertEqual(set(molecule.synonyms.values_list('value', flat=True)), synonyms)
+
+    def test_reimport_of_unchanged_data_does_not_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            out = StringIO()
+            call_command('import_molecule_data', 'hmdb', test=True, stdout=out)
+
+        writes = [
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))
+        ]
+        self.assertEqual(writes, [])
+        self.assertEqual(ImportRun.objects.filter(database='hmdb').count(), 1)
+        self.assertIn('Saved 0 new or changed metabolites, skipped 3.', out.getvalue())
+
+    def test_reimport_saves_changed_metabolites(self):
+        HmdbMetabolite.objects.filter(accession='HMDB0000005').update(name='Outdated', content_hash='outdated')
+        unchanged = HmdbMetabolite.objects.get(accession='HMDB0000002')
+
+        out = StringIO()
+        call_command('import_molecule_data', 'hmdb', test=True, stdout=out)
+
+        self.assertEqual(HmdbMetabolite.objects.get(accession='HMDB0000005').name, '2-Ketobutyric acid')
+        self.assertEqual(HmdbMetabolite.objects.get(accession='HMDB0000002').updated_at, unchanged.updated_at)
+        self.assertIn('Saved 1 new or changed metabolites, skipped 2.', out.getvalue())
+
+    def test_force_rewrites_unchanged_metabolites(self):
+        out = StringIO()
+        call_command('import_molecule_data', 'hmdb', test=True, force=True, stdout=out)
+
+        self.assertIn('Saved 3 new or changed metabolites, skipped 0.', out.getvalue())
+
+    def test_benchmark_rolls_back(self):
+        out = StringIO()
+        HmdbMetabolite.objects.all().delete()
+        IdentifierLookup.objects.all().delete()
+
+        call_command('benchmark_importers', 'hmdb', scale=2, in_place=True, stdout=out)
+
+        self.assertIn('HMDB: 6 metabolites', out.getvalue())
+        self.assertIn('records/s', out.getvalue())
+        self.assertEqual(HmdbMetabolite.objects.count(), 0)
+
+
+class ImportHmdbCheckpointTest(TestCase):
+    def interrupt_after_first_batch(self):
+        """ Runs a checkpointed import that fails while staging its second batch. """
+        bulk_create = StagedMetabolite.objects.bulk_create
+        calls = []
+
+        def failing_bulk_create(objs, *args, **kwargs):
+            calls.append(objs)
+            if len(calls) > 1:
+                raise RuntimeError('connection lost')
+            return bulk_create(objs, *args, **kwargs)
+
+        with patch.object(StagedMetabolite.objects, 'bulk_create', side_effect=failing_bulk_create):
+            with self.assertRaises(CommandError):
+                call_command('import_molecule_data', 'hmdb', test=True, checkpoint=True, batch_size=1, stdout=StringIO())
+
+    def test_checkpointed_import_saves_all_metabolites(self):
+        out = StringIO()
+        call_command('import_molecule_data', 'hmdb', test=True, checkpoint=True, batch_size=2, stdout=out)
+
+        self.assertIn('HMDB data successfully imported', out.getvalue())
+        self.assertEqual(HmdbMetabolite.objects.count(), 3)
+        self.assertTrue(HmdbMetabolite.objects.get(accession='HMDB0000005').synonyms.exists())
+        self.assertFalse(StagedMetabolite.objects.exists())
+        self.assertEqual(ImportRun.objects.get(database='hmdb').status, ImportRun.COMPLETE)
+
+    def test_interrupted_import_records_checkpoint_without_changing_live_data(self):
+        self.interrupt_after_first_batch()
+
+        import_run = ImportRun.objects.get(database='hmdb')
+        self.assertEqual(import_run.status, ImportRun.IN_PROGRESS)
+        self.assertEqual(import_run.processed_count, 1)
+        self.assertEqual(import_run.checkpoint, StagedMetabolite.objects.get().accession)
+        self.assertFalse(HmdbMetabolite.objects.exists())
+        self.assertEqual(ImportRun.latest_id('hmdb'), 0)
+
+    def test_resume_completes_interrupted_import(self):
+        self.interrupt_after_first_batch()
+        import_run = ImportRun.objects.get(database='hmdb')
+
+        with patch.object(StagedMetabolite.objects, 'bulk_create', wraps=StagedMetabolite.objects.bulk_create) as bulk_create:
+            call_command('import_molecule_data', 'hmdb', test=True, resume=True, batch_size=1, stdout=StringIO())
+
+        # Only the metabolites after the checkpoint are staged again
+        self.assertEqual(bulk_create.call_count, 2)
+        self.assertEqual(HmdbMetabolite.objects.count(), 3)
+        import_run.refresh_from_db()
+        self.assertEqual(import_run.status, ImportRun.COMPLETE)
+        self.assertEqual(import_run.processed_count, 3)
+        self.assertEqual(ImportRun.latest_id('hmdb'), import_run.id)
+
+    def test_resume_rejects_changed_source(self):
+        self.interrupt_after_first_batch()
+        ImportRun.objects.filter(database='hmdb').update(checkpoint='HMDB9999999')
+
+        with self.assertRaisesMessage(CommandError, 'HMDB data changed since the interrupted import'):
+            call_command('import_molecule_data', 'hmdb', test=True, resume=True, stdout=StringIO())
+
+    def test_checkpointed_reimport_of_unchanged_data_is_not_recorded(self):
+        call_command('import_molecule_data', 'hmdb', test=True, checkpoint=True, stdout=StringIO())
+        import_run_id = ImportRun.latest_id('hmdb')
+
+        call_command('import_molecule_data', 'hmdb', test=True, checkpoint=True, stdout=StringIO())
+
+        self.assertEqual(list(ImportRun.objects.filter(database='hmdb').values_list('id', flat=True)), [import_run_id])
+
+    def test_resume_without_unfinished_import_fails(self):
+        with self.assertRaisesMessage(CommandError, 'There is no unfinished HMDB import to resume.'):
+            call_command('import_molecule_data', 'hmdb', test=True, resume=True, stdout=StringIO())
+
+    def test_new_checkpointed_import_replaces_unfinished_one(self):
+        self.interrupt_after_first_batch()
+
+        call_command('import_molecule_data', 'hmdb', test=True, checkpoint=True, stdout=StringIO())
+
+        self.assertEqual(ImportRun.objects.filter(database='hmdb').count(), 1)
+        self.assertEqual(HmdbMetabolite.objects.count(), 3)
+
 
 
 
@@ -607,6 +851,8 @@ class FindMatchingHgncGenesTests(TestCase):
             entrez_id="103",
         )
 
+        IdentifierLookup.objects.rebuild(HgncGene)
+
 
     def search_genes(self, search_strings):
         return HgncGene.objects.find_matching_items(search_strings)
@@ -617,6 +863,12 @@ class FindMatchingHgncGenesTests(TestCase):
         self.assertEqual(len(results['one_match']), 0)
         self.assertEqual(len(results['multiple_matches']), 0)
 
+    def test_deleted_gene_with_stale_lookup_rows_is_no_match(self):
+        # The lookup rows of the deleted gene aren't rebuilt
+        HgncGene.objects.filter(pk=self.gene3.pk).delete()
+        results = self.search_genes(['G3'])
+        self.assertEqual(results, {'no_matches': ['G3'], 'one_match': [], 'multiple_matches': []})
+
     # Test individual plain string fields
     def test_search_by_hgnc_id(self):
         results = self.search_genes(['1'])
@@ -713,6 +965,47 @@ class FindMatchingHgncGenesTests(TestCase):
         results = self.search_genes(['item, comma'])
         self.assertEqual(results['one_match'][0]['item'], self.gene2)
 
+    # Test batch resolution
+    def test_search_many_strings_at_once(self):
+        results = self.search_genes(['g1-alias', '123', 'G3', 'NOTHING', '789'])
+        self.assertEqual(results['no_matches'], ['NOTHING'])
+        self.assertEqual(
+            [(result['search_string'], result['item']) for result in results['one_match']],
+            [('g1-alias', self.gene1), ('G3', self.gene3), ('789', self.gene2)],
+        )
+        self.assertEqual(results['multiple_matches'][0]['search_string'], '123')
+        self.assertCountEqual(results['multiple_matches'][0]['items'], [self.gene1, self.gene2])
+
+    def test_search_reports_matched_fields(self):
+        results = self.search_genes(['G1-ALIAS', '123'])
+        self.assertEqual(results['one_match'][0]['matched_fields'], ['aliassymbol'])
+        self.assertEqual(
+            results['multiple_matches'][0]['matched_fields'],
+            {self.gene1.pk: ['omimid'], self.gene2.pk: ['omimid']},
+        )
+
+    def test_integer_column_only_matches_exact_digits(self):
+        results = self.search_genes(['01', ' 1'])
+        self.assertCountEqual(results['no_matches'], ['01', ' 1'])
+
+    def test_query_count_does_not_grow_with_number_of_search_strings(self):
+        few_search_strings = ['G1', '123', 'NOTHING']
+        many_search_strings = (
+            few_search_strings
+            + [f'NOTHING{i}' for i in range(1000)]
+            + [str(i) for i in range(1000, 2000)]
+        )
+
+        with CaptureQueriesContext(connection) as few_queries:
+            self.search_genes(few_search_strings)
+
+        with CaptureQueriesContext(connection) as many_queries:
+            results = self.search_genes(many_search_strings)
+
+        self.assertEqual(len(many_queries), len(few_queries))
+        self.assertEqual(len(results['no_matches']), 2001)
+        self.assertEqual(results['one_match'][0]['item'], self.gene1)
+
 
 class FindMatchingHmdbMetabolitesTests(TestCase):
     @classmethod
@@ -757,6 +1050,8 @@ class FindMatchingHmdbMetabolitesTests(TestCase):
         MetaboliteSynonym.objects.create(metabolite=cls.metabolite2, value="Tau-methylhistidine")
         SecondaryAccession.objects.create(metabolite=cls.metabolite2, value="SECACC002")
 
+        IdentifierLookup.objects.rebuild(HmdbMetabolite)
+
 
     def search_metabolites(self, search_strings):
         return HmdbMetabolite.objects.find_matching_items(search_strings)
@@ -875,6 +1170,154 @@ class FindMatchingHmdbMetabolitesTests(TestCase):
         self.assertEqual(results['multiple_matches'][0]['search_string'], '50212')
         self.assertCountEqual(results['multiple_matches'][0]['items'], [self.metabolite1, self.metabolite2])
 
+class FindSimilarItemsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.gene_tnf = HgncGene.objects.create(hgnc_id=11892, symbol="TNF", name="tumor necrosis factor")
+        cls.gene_il6 = HgncGene.objects.create(hgnc_id=6018, symbol="IL6", name="interleukin 6")
+        AliasSymbol.objects.create(gene=cls.gene_il6, value="IFNB2")
+        cls.gene_il6r = HgncGene.objects.create(hgnc_id=6019, symbol="IL6R", name="interleukin 6 receptor")
+        IdentifierLookup.objects.rebuild(HgncGene)
+
+        cls.metabolite = HmdbMetabolite.objects.create(accession="HMDB0000005", name="2-Ketobutyric acid")
+        MetaboliteSynonym.objects.create(metabolite=cls.metabolite, value="alpha-Ketobutyrate")
+        IdentifierLookup.objects.rebuild(HmdbMetabolite)
+
+    def setUp(self):
+        clear_identifier_indexes()
+
+    def tearDown(self):
+        clear_identifier_indexes()
+
+    def test_typo_suggests_gene(self):
+        similar_items = HgncGene.objects.find_similar_items('TNFA')
+        self.assertEqual(similar_items[0][0], self.gene_tnf)
+        self.assertEqual(similar_items[0][1], ['symbol'])
+
+    def test_differently_punctuated_name_suggests_gene(self):
+        similar_items = HgncGene.objects.find_similar_items('Interleukin-6')
+        self.assertEqual(similar_items[0][0], self.gene_il6)
+
+    def test_prefix_suggests_genes(self):
+        similar_items = HgncGene.objects.find_similar_items('interleu')
+        self.assertCountEqual([item for item, matched_fields in similar_items], [self.gene_il6, self.gene_il6r])
+
+    def test_accession_fields_are_not_searched(self):
+        self.assertEqual(HgncGene.objects.find_similar_items('11892'), [])
+
+    def test_limit(self):
+        self.assertEqual(len(HgncGene.objects.find_similar_items('interleukin', limit=1)), 1)
+
+    def test_metabolite_synonym_suggestion(self):
+        similar_items = HmdbMetabolite.objects.find_similar_items('alpha ketobutyrat')
+        self.assertEqual(similar_items[0][0], self.metabolite)
+        self.assertEqual(similar_items[0][1][0], 'metabolitesynonym')
+
+    def test_many_terms_are_searched_together(self):
+        HgncGene.objects.find_similar_items('warm up')
+        search_terms = ['TNFA', 'interleu', 'NOTHINGLIKEIT'] + [f'UNKNOWN{i}' for i in range(20)]
+        with CaptureQueriesContext(connection) as queries:
+            similar_items = HgncGene.objects.find_similar_items_many(search_terms)
+        # The trigram search, if in the database, and fetching the genes
+        self.assertLessEqual(len(queries), 2)
+        self.assertEqual(similar_items['TNFA'][0][0], self.gene_tnf)
+        self.assertCountEqual([item for item, matched_fields in similar_items['interleu']], [self.gene_il6, self.gene_il6r])
+        self.assertEqual(similar_items['NOTHINGLIKEIT'], [])
+
+    def test_suggestions_are_capped(self):
+        search_terms = [f'UNKNOWN{i}' for i in range(MAX_SUGGESTED_TERMS)] + ['TNFA']
+        with patch.object(HgncGene.objects, 'find_similar_items_many', wraps=HgncGene.objects.find_similar_items_many) as find:
+            results = similar_match_results(HgncGene, search_terms)
+        find.assert_called_once_with(search_terms[:MAX_SUGGESTED_TERMS])
+        self.assertEqual([result['search_string'] for result in results], search_terms)
+        self.assertEqual(results[-1]['items'], [])
+
+    def test_identify_view_suggests_close_matches(self):
+        response = self.client.post(reverse('sickgenes:identify_molecules', args=('gene',)), {
+            'search_terms': 'TNFA\nNOTHINGLIKEIT',
+            'suggest_similar': 'on',
+            'no_matches-TOTAL_FORMS': 0, 'no_matches-INITIAL_FORMS': 0,
+            'multiple_matches-TOTAL_FORMS': 0, 'multiple_matches-INITIAL_FORMS': 0,
+            'one_match-TOTAL_FORMS': 0, 'one_match-INITIAL_FORMS': 0,
+        })
+
+        multiple_matches_formset = response.context['search_multiple_matches_formset']
+        self.assertEqual(len(multiple_matches_formset.forms), 1)
+        self.assertEqual(multiple_matches_formset.forms[0].initial['search_term'], 'TNFA')
+        self.assertIn(self.gene_tnf.id, dict(multiple_matches_formset.forms[0].fields['item_id'].choices))
+
+        no_matches_formset = response.context['search_no_matches_formset']
+        self.assertEqual([form.initial['search_term'] for form in no_matches_formset.forms], ['NOTHINGLIKEIT'])
+
+class IdentifyMoleculesResolutionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.gene1 = HgncGene.objects.create(hgnc_id=1, symbol="GENE1")
+        cls.gene2 = HgncGene.objects.create(hgnc_id=2, symbol="GENE2")
+        AliasSymbol.objects.create(gene=cls.gene1, value="SHARED")
+        AliasSymbol.objects.create(gene=cls.gene2, value="SHARED")
+        AliasSymbol.objects.create(gene=cls.gene1, value="OTHER")
+        AliasSymbol.objects.create(gene=cls.gene2, value="OTHER")
+        IdentifierLookup.objects.rebuild(HgncGene)
+        cls.url = reverse('sickgenes:identify_molecules', args=('gene',))
+
+    def post_multiple_matches(self, token, search_terms='', multiple_matches=()):
+        data = {
+            'search_terms': search_terms,
+            'resolution_token': token,
+            'no_matches-TOTAL_FORMS': 0, 'no_matches-INITIAL_FORMS': 0,
+            'multiple_matches-TOTAL_FORMS': len(multiple_matches), 'multiple_matches-INITIAL_FORMS': 0,
+            'one_match-TOTAL_FORMS': 0, 'one_match-INITIAL_FORMS': 0,
+        }
+        for i, (search_term, item_id) in enumerate(multiple_matches):
+            data[f'multiple_matches-{i}-search_term'] = search_term
+            data[f'multiple_matches-{i}-item_id'] = item_id
+        return self.client.post(self.url, data)
+
+    def test_multiple_match_choices_reused_from_session(self):
+        response = self.post_multiple_matches('', 'SHARED')
+        token = response.context['search_initial_form'].initial['resolution_token']
+        self.assertTrue(token)
+
+        with patch.object(HgncGene.objects, 'find_matching_items', wraps=HgncGene.objects.find_matching_items) as find:
+            response = self.post_multiple_matches(token, 'OTHER', [('SHARED', '')])
+
+        # Only the newly added term was searched for
+        find.assert_called_once_with({'OTHER'})
+        formset = response.context['search_multiple_matches_formset']
+        self.assertEqual([form.initial['search_term'] for form in formset.forms], ['SHARED', 'OTHER'])
+        for form in formset.forms:
+            self.assertCountEqual(
+                [item_id for item_id, label in form.fields['item_id'].choices if item_id],
+                [self.gene1.id, self.gene2.id],
+            )
+
+    def test_selection_uses_stored_choices(self):
+        response = self.post_multiple_matches('', 'SHARED')
+        token = response.context['search_initial_form'].initial['resolution_token']
+
+        with patch.object(HgncGene.objects, 'find_matching_items', wraps=HgncGene.objects.find_matching_items) as find:
+            response = self.post_multiple_matches(token, multiple_matches=[('SHARED', self.gene2.id)])
+
+        find.assert_called_once_with(set())
+        self.assertRedirects(response, f"{reverse('sickgenes:gene_list')}?symbol=GENE2", fetch_redirect_response=False)
+
+    def test_unknown_token_resolves_choices_again(self):
+        response = self.post_multiple_matches('not-a-token', multiple_matches=[('SHARED', self.gene1.id)])
+        self.assertRedirects(response, f"{reverse('sickgenes:gene_list')}?symbol=GENE1", fetch_redirect_response=False)
+
+    def test_one_match_term_offers_its_match_without_suggestions(self):
+        with patch.object(HgncGene.objects, 'find_similar_items_many', wraps=HgncGene.objects.find_similar_items_many) as find:
+            response = self.post_multiple_matches('not-a-token', multiple_matches=[('GENE1', ''), ('NOTHINGLIKEIT', '')])
+
+        find.assert_called_once_with(['NOTHINGLIKEIT'])
+        formset = response.context['search_multiple_matches_formset']
+        choices = {
+            form.initial['search_term']: [item_id for item_id, label in form.fields['item_id'].choices if item_id]
+            for form in formset.forms
+        }
+        self.assertEqual(choices['GENE1'], [self.gene1.id])
+
 class AddGenesView(TestCase):
     @classmethod
     def setUpTestData(cls):
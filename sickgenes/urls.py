@@ -31,5 +31,6 @@ urlpatterns = [
 
     path('api/v1/dump/', views.database_dump_json_v1, name="database_dump_json_v1"),
     path('api/v2/sickgenes_database.json.gz', views.database_dump_json_v2, name="database_dump_json_v2"),
+    path('api/v2/resolve/<str:model_type>/', views.resolve_identifiers, name="resolve_identifiers"),
 
 ]
\ No newline at end of file
@@ -1,2 +1,3 @@
 from .api import *
-from .old_versions import *
\ No newline at end of file
+from .old_versions import *
+from .resolve import resolve_identifiers
@@ -0,0 +1,143 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.http import StreamingHttpResponse, JsonResponse, Http404
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from sickgenes.views.views import MODEL_CONFIG
+import json
+import time
+
+# Upper bound on identifiers per request
+MAX_RESOLVE_IDENTIFIERS = 5000
+# Identifiers resolved per lookup query, whose lines are streamed before the next batch is looked up
+RESOLVE_BATCH_SIZE = 500
+# Seconds over which RESOLVE_RATE_LIMIT identifiers per client are allowed
+RESOLVE_RATE_WINDOW = 60
+
+
+def parse_identifiers(request):
+    """
+    Reads the identifiers from a resolve request body: either JSON, as
+    {"identifiers": [...]} or a bare list, or newline-delimited text.
+    Returns the stripped, de-duplicated identifiers in their original order.
+    Raises ValueError if the body is malformed.
+    """
+    body = request.body.decode('utf-8')
+
+    if request.content_type == 'application/json':
+        data = json.loads(body)
+        identifiers = data.get('identifiers') if isinstance(data, dict) else data
+        if not isinstance(identifiers, list) or not all(isinstance(identifier, (str, int)) for identifier in identifiers):
+            raise ValueError('Expected "identifiers" to be a list of strings.')
+    else:
+        identifiers = body.splitlines()
+
+    identifiers = [str(identifier).strip() for identifier in identifiers]
+    return list(dict.fromkeys(identifier for identifier in identifiers if identifier))
+
+
+def client_address(request):
+    """
+    The address of the client, from the last X-Forwarded-For entry when
+    USE_X_FORWARDED_FOR says a trusted proxy appends it there.
+    """
+    forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    if settings.USE_X_FORWARDED_FOR and forwarded_for:
+        return forwarded_for.split(',')[-1].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def rate_limit_exceeded(request, identifier_count):
+    """
+    Counts the identifiers towards the client's RESOLVE_RATE_LIMIT for the
+    current window, and returns whether the limit is now exceeded.
+    """
+    window = int(time.time() // RESOLVE_RATE_WINDOW)
+    key = f'resolve_rate:{client_address(request)}:{window}'
+    cache.add(key, 0, RESOLVE_RATE_WINDOW * 2)
+    try:
+        resolved_count = cache.incr(key, identifier_count)
+    except ValueError:
+        # The count expired between add and incr
+        cache.set(key, identifier_count, RESOLVE_RATE_WINDOW * 2)
+        resolved_count = identifier_count
+    return resolved_count > settings.RESOLVE_RATE_LIMIT
+
+
+def resolution_stream(model, identifiers):
+    """ Yields the lines of resolution_lines, looking the identifiers up RESOLVE_BATCH_SIZE at a time. """
+    for start in range(0, len(identifiers), RESOLVE_BATCH_SIZE):
+        batch = identifiers[start:start + RESOLVE_BATCH_SIZE]
+        yield from resolution_lines(batch, model.objects.find_matching_items(batch))
+
+
+def resolution_lines(identifiers, search_results):
+    """ Yields one JSON line per identifier, in the order they were given. """
+    results_by_identifier = {}
+    for search_string in search_results['no_matches']:
+        results_by_identifier[search_string] = ('no_match', [], {})
+    for result in search_results['one_match']:
+        results_by_identifier[result['search_string']] = (
+            'one_match', [result['item']], {result['item'].pk: result['matched_fields']}
+        )
+    for result in search_results['multiple_matches']:
+        results_by_identifier[result['search_string']] = (
+            'multiple_matches', result['items'], result['matched_fields']
+        )
+
+    for identifier in identifiers:
+        status, items, matched_fields = results_by_identifier[identifier]
+        line = {
+            'identifier': identifier,
+            'status': status,
+            'candidates': [
+                {
+                    'id': item.pk,
+                    'label': str(item),
+                    'matched_fields': matched_fields[item.pk],
+                }
+                for item in items
+            ],
+        }
+        yield json.dumps(line) + '\n'
+
+
+@csrf_exempt
+@require_POST
+def resolve_identifiers(request, model_type):
+    """
+    Resolves a list of identifiers to genes or metabolites, using the same
+    search as identify_molecules. Responds with newline-delimited JSON, one
+    line per identifier, holding its status ('one_match', 'multiple_matches'
+    or 'no_match') and candidate items with the fields the identifier
+    matched on. Identifiers are looked up and streamed in batches, and each
+    client may resolve at most RESOLVE_RATE_LIMIT identifiers per minute.
+    """
+    config = MODEL_CONFIG.get(model_type)
+    if not config:
+        raise Http404(f"Model type '{model_type}' is not supported.")
+    model = config['source_model']
+
+    try:
+        identifiers = parse_identifiers(request)
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({'error': f'Invalid request body: {e}'}, status=400)
+
+    if len(identifiers) > MAX_RESOLVE_IDENTIFIERS:
+        return JsonResponse(
+            {'error': f'Too many identifiers: {len(identifiers)} given, at most {MAX_RESOLVE_IDENTIFIERS} allowed.'},
+            status=400,
+        )
+
+    if rate_limit_exceeded(request, len(identifiers)):
+        response = JsonResponse(
+            {'error': f'Too many identifiers resolved; at most {settings.RESOLVE_RATE_LIMIT} are allowed per minute.'},
+            status=429,
+        )
+        response['Retry-After'] = RESOLVE_RATE_WINDOW
+        return response
+
+    return StreamingHttpResponse(
+        resolution_stream(model, identifiers),
+        content_type='application/x-ndjson',
+    )
@@ -1,8 +1,14 @@
-import random
-from django.http import JsonResponse
+import hashlib
+import os
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
-from django.db.models import Count, Q
-from sickgenes.models import HgncGene, StringInteraction
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_cache_control, quote_etag
+from sickgenes.gene_network import get_gene_network
+from sickgenes.graph_layout import force_layout
+from sickgenes.models import DataVersion, GeneDiseaseEvidence, GeneInteraction
 
 
 def gene_network_data(request):
@@ -15,10 +21,20 @@ def gene_network_data(request):
     Example GET request: /api/graph-data/?disease_ids=1&disease_ids=5
 
     It returns a JSON object with 'nodes' and 'edges':
-    - Nodes: Genes found in studies for ALL specified diseases.
-      - 'size' attribute corresponds to the number of unique studies the gene was found in.
-    - Edges: STRING DB interactions between the identified genes.
+    - Nodes: Genes found in finished, newest-version studies for ALL specified diseases.
+      - 'size' attribute corresponds to the number of unique studies the gene was found in (across those diseases).
+    - Edges: STRING DB interactions between the identified genes, one per gene pair.
       - 'size' attribute corresponds to the 'combined_score'.
+      - Read from the memory-mapped gene network when it has been built,
+        or else from GeneInteraction.
+    - Node positions come from a seeded force-directed layout, started from
+      the genes' positions in the gene network's layout when it has one, so
+      the same graph is always drawn the same way.
+
+    Responses are cached by the sorted, de-duplicated disease ids and the
+    confidence threshold, along with the DataVersion and gene network build
+    they were made from, so data changes invalidate them. Their ETag is the
+    cache key, letting browsers revalidate a graph without downloading it.
     """
     disease_ids_str = request.GET.getlist('disease_ids')
     if not disease_ids_str:
@@ -26,81 +42,129 @@ def gene_network_data(request):
 
     try:
         # Convert all provided IDs to integers and remove duplicates
-        disease_ids = list(set(int(id) for id in disease_ids_str))
-        num_diseases = len(disease_ids)
+        disease_ids = sorted(set(int(id) for id in disease_ids_str))
 
     except ValueError:
         return JsonResponse({'error': 'Invalid disease ID provided.'}, status=400)
     
-    confidence_threshold = request.GET.get('confidence_threshold', 700)
+    try:
+        confidence_threshold = int(request.GET.get('confidence_threshold', 700))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid confidence threshold provided.'}, status=400)
+
+    gene_network = get_gene_network()
+    graph_hash = graph_data_hash(disease_ids, confidence_threshold, gene_network)
+    cache_key = f'gene_network_data:{graph_hash}'
+    etag = quote_etag(graph_hash)
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified['ETag'] = etag
+        return not_modified
+
+    content = cache.get(cache_key)
+    if content is None:
+        graph_data = build_graph_data(disease_ids, confidence_threshold, gene_network)
+        content = JsonResponse(graph_data).content
+        cache.set(cache_key, content, settings.GRAPH_CACHE_TIMEOUT)
+
+    response = HttpResponse(content, content_type='application/json')
+    response['Content-Disposition'] = 'attachment; filename=sickgenes-network.json'
+    response['ETag'] = etag
+    # Browsers keep the graph but check it is current before reusing it
+    patch_cache_control(response, no_cache=True)
+
+    return response
 
+def graph_data_hash(disease_ids, confidence_threshold, gene_network):
+    """ Identifies a graph's data, changing whenever the data it shows does. """
+    build_name = os.path.basename(gene_network.path) if gene_network is not None else ''
+    parameters = [DataVersion.get_solo().version, build_name, confidence_threshold, *disease_ids]
+    return hashlib.md5(':'.join(map(str, parameters)).encode('utf-8')).hexdigest()
+
+def build_graph_data(disease_ids, confidence_threshold, gene_network):
+    """ The nodes and edges of the graph of the genes found for all of the diseases. """
     # 2. Find genes associated with ALL specified diseases
-    # We annotate each gene with two counts:
+    # From the precomputed evidence matrix, each gene is annotated with:
     #  - disease_count: How many of the *input diseases* this gene is linked to.
-    #  - study_count: How many *unique studies* this gene is linked to (across those diseases).
+    #  - study_count: Its studies for the disease, when there is just one.
     # Then, we filter for genes where disease_count matches the number of diseases we're looking for.
-    common_genes_qs = HgncGene.objects.filter(
-        genefinding__study_cohort__disease_tags__id__in=disease_ids
+    common_genes_qs = GeneDiseaseEvidence.objects.filter(
+        disease_id__in=disease_ids
+    ).values(
+        'gene_id', 'gene__symbol'
     ).annotate(
-        disease_count=Count(
-            'genefinding__study_cohort__disease_tags',
-            filter=Q(genefinding__study_cohort__disease_tags__id__in=disease_ids),
-            distinct=True
-        ),
-        study_count=Count('genefinding__study_cohort__study', distinct=True)
+        disease_count=Count('disease_id'),
+        study_count=Max('study_count'),
     ).filter(
-        disease_count=num_diseases
-    )
+        disease_count=len(disease_ids)
+    ).order_by('gene_id')
+    common_genes = list(common_genes_qs)
+
+    # A study may have cohorts tagged with several of the diseases, so the
+    # evidence rows' study ids are combined rather than their counts summed
+    if len(disease_ids) > 1 and common_genes:
+        study_counts = GeneDiseaseEvidence.objects.study_counts(
+            [gene['gene_id'] for gene in common_genes], disease_ids,
+        )
+        for gene in common_genes:
+            gene['study_count'] = study_counts.get(gene['gene_id'], 0)
 
     # 3. Prepare nodes for Sigma.js
     nodes = []
-    # We need a quick lookup of gene IDs for the next step
+    # We need a quick lookup of gene IDs and symbols for the next step
     common_gene_pks = []
+    gene_symbols = {}
     
     # Assuming your HgncGene model has a 'symbol' field for the gene name
-    for gene in common_genes_qs:
+    for gene in common_genes:
         nodes.append({
-            'key': gene.symbol,  # Use a unique, readable identifier
-            'label': gene.symbol,
-            'x': random.random(), # Assign random coordinates for initial layout
-            'y': random.random(),
-            'size': gene.study_count, # Size node by study count
+            'key': gene['gene__symbol'],  # Use a unique, readable identifier
+            'label': gene['gene__symbol'],
+            'size': gene['study_count'], # Size node by study count
             'type': 'circle'
         })
-        common_gene_pks.append(gene.pk)
+        common_gene_pks.append(gene['gene_id'])
+        gene_symbols[gene['gene_id']] = gene['gene__symbol']
 
     # 4. Find interactions (edges) between these common genes
     edges = []
+    interactions = []
     if common_gene_pks:
-        interactions = StringInteraction.objects.filter(
-            protein1__hgnc_gene_id__in=common_gene_pks,
-            protein2__hgnc_gene_id__in=common_gene_pks,
-            combined_score__gte=confidence_threshold,
-        ).select_related('protein1__hgnc_gene', 'protein2__hgnc_gene')
-
-        for interaction in interactions:
-            # Ensure the source/target IDs match the node IDs
-            source_gene_symbol = interaction.protein1.hgnc_gene.symbol
-            target_gene_symbol = interaction.protein2.hgnc_gene.symbol
-            
-            # Avoid self-loops if they exist and only add edges for nodes in our graph
-            if source_gene_symbol != target_gene_symbol:
-                 edges.append({
-                    'key': f'e{interaction.id}',
-                    'source': source_gene_symbol,
-                    'target': target_gene_symbol,
-                    'size': interaction.combined_score,
-                    'type': 'line',
-                    'color': '#ccc'
-                })
-
-    # 5. Combine and return as JSON
-    graph_data = {'nodes': nodes, 'edges': edges}
-    
-    response = JsonResponse(graph_data)
-    response['Content-Disposition'] = 'attachment; filename=sickgenes-network.json'
+        if gene_network is not None:
+            interactions = gene_network.interactions(common_gene_pks, confidence_threshold)
+        else:
+            interactions = list(GeneInteraction.objects.filter(
+                gene_a_id__in=common_gene_pks,
+                gene_b_id__in=common_gene_pks,
+                combined_score__gte=confidence_threshold,
+            ).values_list('gene_a_id', 'gene_b_id', 'combined_score'))
 
-    return response
+        # Each gene pair has one interaction, so the pair is the edge key
+        for gene_pk1, gene_pk2, combined_score in interactions:
+            edges.append({
+                'key': f'e{gene_pk1}-{gene_pk2}',
+                'source': gene_symbols[gene_pk1],
+                'target': gene_symbols[gene_pk2],
+                'size': combined_score,
+                'type': 'line',
+                'color': '#ccc'
+            })
+
+    # 5. Lay the genes out, starting from their places in the whole network's layout
+    gene_indexes = {gene_pk: index for index, gene_pk in enumerate(common_gene_pks)}
+    positions = force_layout(
+        len(common_gene_pks),
+        [gene_indexes[gene_pk1] for gene_pk1, _, _ in interactions],
+        [gene_indexes[gene_pk2] for _, gene_pk2, _ in interactions],
+        weights=[combined_score / 1000 for _, _, combined_score in interactions],
+        initial=gene_network.layout_positions(common_gene_pks) if gene_network is not None else None,
+    )
+    for node, (x, y) in zip(nodes, positions.tolist()):
+        node['x'] = round(x, 4)
+        node['y'] = round(y, 4)
+
+    # 6. Combine them for JSON
+    return {'nodes': nodes, 'edges': edges}
 
 def graph_display(request):
     return render(request, 'sickgenes/network_display.html')
\ No newline at end of file
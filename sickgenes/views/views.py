@@ -2,10 +2,11 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.urls import reverse
 from django.http import JsonResponse, Http404
 from sickgenes.forms import prepare_identifiers
-from sickgenes.models import HgncGene, GeneFinding, Study, StudyCohort, HmdbMetabolite, MetaboliteFinding, SiteConfiguration
+from sickgenes.models import HgncGene, GeneFinding, GeneDiseaseEvidence, Study, StudyCohort, HmdbMetabolite, MetaboliteFinding, SiteConfiguration
 from sickgenes.forms import StudyForm, StudyCohortForm, GeneFilterForm, SetNewestStudyVersionForm
 from django.db import transaction
-from django.db.models import Prefetch, Count, Q
+from django.db.models import Prefetch, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from sickgenes.tables import GeneTable, StudyTable
@@ -130,32 +131,16 @@ def gene_list(request):
     
     form = GeneFilterForm(request.GET)
     
-    if form.is_valid() and form.cleaned_data.get('phenotype'):
-        disease = form.cleaned_data['phenotype']
-        
-        genes = base_queryset.annotate(
-            study_count=Count(
-                'genefinding__study_cohort__study',
-                filter=Q(
-                    genefinding__study_cohort__study__not_finished=False,
-                    genefinding__study_cohort__study__newest_version__isnull=True,
-                    genefinding__study_cohort__disease_tags=disease
-                ),
-                distinct=True,
-            )
-        ).distinct()
-
-    else:
-        genes = base_queryset.annotate(
-            study_count=Count(
-                'genefinding__study_cohort__study',
-                filter=Q(
-                    genefinding__study_cohort__study__not_finished=False,
-                    genefinding__study_cohort__study__newest_version__isnull=True,
-                    ),
-                distinct=True,
-            )
+    # Without a phenotype, the evidence row without a disease counts studies of any disease
+    disease = form.cleaned_data.get('phenotype') if form.is_valid() else None
+    genes = base_queryset.annotate(
+        study_count=Coalesce(
+            Subquery(
+                GeneDiseaseEvidence.objects.filter(gene=OuterRef('pk'), disease=disease).values('study_count')
+            ),
+            0,
         )
+    )
 
     genes_table = GeneTable(genes)
     RequestConfig(request, paginate={"per_page": 25}).configure(genes_table)
@@ -315,6 +300,9 @@ def insert_findings(request, study_cohort_id, model_type):
             findings_to_insert.append(finding_model(**instance_data))
 
         finding_model.objects.bulk_create(findings_to_insert, ignore_conflicts=True)
+        if finding_model is GeneFinding:
+            # bulk_create doesn't send the signals that keep the evidence counts up to date
+            GeneDiseaseEvidence.objects.refresh(finding.hgnc_gene_id for finding in findings_to_insert)
         study = Study.objects.get(study_cohorts__id=study_cohort_id)
         return redirect(study)
 